@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Benchmark batch processing of many logs against the number of workers
+
+Copies the test log, padded with noise lines, into a temporary directory
+and summarizes all copies through run_batch with a growing process pool.
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+import shutil
+import tempfile
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import simplejson as json
+from mtga_batch import run_batch, summarize_log
+
+LOGS = 16
+NOISE_LINES = 100000
+
+
+def make_logs(directory):
+    with open(os.path.join(ROOT, 'tests', 'test_mtga_output_log.txt')) as logfile:
+        content = logfile.read()
+    noise = ''.join('[UnityCrossThreadLogger]noise line %d\n' % i for i in range(NOISE_LINES))
+    log_files = []
+    for i in range(LOGS):
+        log_file = os.path.join(directory, 'Player%02d.log' % i)
+        with open(log_file, 'w') as out:
+            out.write(noise + content)
+        log_files.append(log_file)
+    return log_files
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        log_files = make_logs(directory)
+        results = []
+        workers = 1
+        while workers <= (os.cpu_count() or 1):
+            start = timeit.default_timer()
+            summaries = list(run_batch(log_files, summarize_log, workers=workers))
+            seconds = timeit.default_timer() - start
+            assert not any(summary['error'] for summary in summaries)
+            results.append({'workers': workers, 'seconds': seconds, 'logs_per_second': LOGS / seconds})
+            workers *= 2
+    finally:
+        shutil.rmtree(directory)
+
+    print(json.dumps({'logs': LOGS, 'noise_lines': NOISE_LINES, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Benchmark collection resolution against collection size
+
+Resolves collections of growing size through MtgaLog.lookup_cards and
+prints the time per card, which should stay flat (O(n) in total).
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+import random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simplejson as json
+from mtga_log import MtgaLog, get_card_index
+
+SIZES = [250, 500, 1000, 2000, 4000]
+REPEAT = 5
+
+
+def collection_of_size(mtga_ids, size):
+    """Collection of size entries, 1% of them unknown to python-mtga"""
+    pairs = []
+    for i in range(size):
+        if i % 100 == 99:
+            pairs.append((str(900000 + i), "1"))
+        else:
+            pairs.append((str(mtga_ids[i % len(mtga_ids)]), str(1 + i % 4)))
+    return pairs
+
+
+def main():
+    log_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'test_mtga_output_log.txt')
+    mlog = MtgaLog(log_filename)
+    mlog.scryfall_fallback(False)
+
+    start = timeit.default_timer()
+    mtga_ids = sorted(get_card_index())
+    random.Random(0).shuffle(mtga_ids)
+    index_time = timeit.default_timer() - start
+
+    results = []
+    for size in SIZES:
+        pairs = collection_of_size(mtga_ids, size)
+        seconds = min(timeit.repeat(lambda: list(mlog.lookup_cards(pairs)), number=1, repeat=REPEAT))
+        results.append({'size': size, 'seconds': seconds, 'us_per_card': seconds / size * 1e6})
+
+    print(json.dumps({'index_build_seconds': index_time, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Benchmark memory and diff time of collection representations
+
+Compares the json payload (dict of str counts), the list of
+[mtga_id, card, count] triples and MtgaCollection for collections of
+growing size.
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simplejson as json
+from mtga_log import MtgaCollection, get_card_index
+
+SIZES = [1000, 5000, 20000]
+
+
+def allocated(factory):
+    """Bytes allocated by the object factory() returns"""
+    tracemalloc.start()
+    value = factory()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del value
+    return size
+
+
+def main():
+    mtga_ids = sorted(get_card_index())
+    results = []
+    for size in SIZES:
+        ids = [mtga_ids[i % len(mtga_ids)] + (i // len(mtga_ids)) * 1000000 for i in range(size)]
+        text = json.dumps(dict((str(mtga_id), str(1 + i % 4)) for i, mtga_id in enumerate(ids)))
+        payload = json.loads(text)
+        collection = MtgaCollection(payload.items())
+        changed = MtgaCollection((mtga_id, count + (mtga_id % 7 == 0)) for mtga_id, count in collection.items())
+
+        results.append({
+            'size': size,
+            'payload_bytes_per_card': allocated(lambda: json.loads(text)) / float(size),
+            'triples_bytes_per_card': allocated(lambda: [
+                [mtga_id, None, count] for mtga_id, count in payload.items()
+            ]) / float(size),
+            'collection_bytes_per_card': allocated(lambda: MtgaCollection(payload.items())) / float(size),
+            'diff_seconds': min(timeit.repeat(lambda: collection.diff(changed), number=1, repeat=5)),
+        })
+
+    print(json.dumps({'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Benchmark the Scryfall fallback for unknown cards
+
+Resolves a collection of cards unknown to python-mtga against a local
+fake Scryfall server with simulated latency, for a growing number of
+worker threads.
+"""
+from __future__ import print_function
+import os
+import sys
+import timeit
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+import simplejson as json
+import scryfall
+from mtga_log import MtgaLog
+from fake_scryfall import FakeScryfallServer, card_json
+
+UNKNOWN_CARDS = 40
+LATENCY = 0.05
+WORKERS = [1, 2, 4, 8, 16]
+
+
+def main():
+    arena_ids = list(range(900000, 900000 + UNKNOWN_CARDS))
+    pairs = [(str(arena_id), 1) for arena_id in arena_ids]
+    mlog = MtgaLog(os.path.join(ROOT, 'tests', 'test_mtga_output_log.txt'))
+    scryfall.set_cache(None)
+
+    results = []
+    with FakeScryfallServer(dict((i, card_json(i)) for i in arena_ids), latency=LATENCY) as server:
+        scryfall.SCRYFALL_CARDS_API = server.url + '/cards'
+        for rate in [1000, scryfall.SCRYFALL_RATE_LIMIT]:
+            for workers in WORKERS:
+                scryfall.set_client(scryfall.ScryfallClient(rate=rate))
+                mlog.scryfall_workers = workers
+                start = timeit.default_timer()
+                list(mlog.lookup_cards(pairs))
+                results.append({
+                    'rate_limit': rate,
+                    'workers': workers,
+                    'seconds': timeit.default_timer() - start,
+                    'client': scryfall.get_client().stats()
+                })
+
+    print(json.dumps({'unknown_cards': UNKNOWN_CARDS, 'latency': LATENCY, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
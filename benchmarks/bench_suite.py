@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""End-to-end benchmark on a synthetic Player.log
+
+Generates a log of the requested size (see log_generator.py) and times
+keyword scanning, collection parsing, the Scryfall fallback and every
+export path of mtga-export.py main(). Cards unknown to python-mtga are
+served by a local fake Scryfall server and on-disk caches live in a
+temporary directory, so runs are comparable between machines and
+commits.
+
+Prints JSON with per-stage seconds and MB/s, and the peak RSS of the
+whole run. ru_maxrss is a process-wide high-water mark, so it can not be
+attributed to single stages.
+
+Usage: bench_suite.py [--size 10MB] [--repeat N] [--scryfall_rate N] [--log FILE] [--output FILE]
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import importlib.util
+import timeit
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+import simplejson as json
+try:
+    import resource
+except ImportError:
+    resource = None
+
+MB = 1024.0 * 1024.0
+EXPORTS = [
+    ('goldfish', '-gf'),
+    ('deckstats', '-ds'),
+    ('custom', '-e name set count'),
+    ('completiontracker', '-ct'),
+    ('inventoryjson', '-ij'),
+    ('decksjson', '--decksjson'),
+    ('decknames', '--decknames'),
+    ('deckexport', '--deckexport "Deck 0"'),
+    ('collection', '-c'),
+    ('inventory', '-i'),
+    ('decks', '--decks'),
+]
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, None when unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def load_mtga_export():
+    """Import mtga-export.py as a module"""
+    spec = importlib.util.spec_from_file_location('mtga_export', os.path.join(ROOT, 'mtga-export.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Stages(object):
+    """Collect timings of benchmark stages"""
+
+    def __init__(self, log_size):
+        self.log_size = log_size
+        self.results = []
+
+    def run(self, name, function, scanned=None, repeat=1):
+        """Time function() as stage name, best of repeat runs
+        Args:
+            scanned (int): Bytes processed by the stage, defaults to the log size
+        Returns: result of the last run
+        """
+        scanned = self.log_size if scanned is None else scanned
+        best = None
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            result = function()
+            seconds = timeit.default_timer() - start
+            best = seconds if best is None else min(best, seconds)
+        self.results.append({
+            'stage': name,
+            'seconds': best,
+            'mb_per_second': scanned / MB / best if scanned and best else None,
+        })
+        return result
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discard stdout, e.g. of mtga-export.py main()"""
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def fake_server_data(card_ids, unknown_ids):
+    """Card json of the unknown cards and set json of all python-mtga sets"""
+    from mtga_log import get_card_index
+    from fake_scryfall import card_json, set_json
+    card_index = get_card_index()
+    sets = set(card_index[mtga_id].set for mtga_id in card_ids) | {'tst'}
+    return (
+        dict((mtga_id, card_json(mtga_id)) for mtga_id in unknown_ids),
+        dict((code, set_json(code, 300)) for code in sets),
+    )
+
+
+def run_suite(log_file, work_dir, card_ids, unknown_ids, repeat=1, scryfall_rate=None):
+    import scryfall
+    from mtga_log import MtgaLog, MTGA_COLLECTION_KEYWORD, MTGA_RESPONSE_PREFIX
+    from fake_scryfall import FakeScryfallServer
+
+    log_size = os.path.getsize(log_file)
+    stages = Stages(log_size)
+    keyword = MTGA_RESPONSE_PREFIX + MTGA_COLLECTION_KEYWORD
+
+    stages.run('get_last_keyword_block_forward',
+               lambda: MtgaLog(log_file, use_index=False).get_last_keyword_block(keyword), repeat=repeat)
+    stages.run('get_last_keyword_block_reverse',
+               lambda: MtgaLog(log_file, use_index=False, reverse_scan=True).get_last_keyword_block(keyword),
+               scanned=0, repeat=repeat)
+    mlog = MtgaLog(log_file)
+    stages.run('build_keyword_index', mlog.build_keyword_index)
+    stages.run('get_last_keyword_block_indexed', lambda: mlog.get_last_keyword_block(keyword),
+               scanned=0, repeat=repeat)
+
+    cards, sets = fake_server_data(card_ids, unknown_ids)
+    with FakeScryfallServer(cards, sets=sets) as server:
+        scryfall.SCRYFALL_CARDS_API = server.url + '/cards'
+        scryfall.SCRYFALL_SETS_API = server.url + '/sets'
+        scryfall.set_cache(None)
+        scryfall.set_client(scryfall.ScryfallClient(rate=scryfall_rate or scryfall.SCRYFALL_RATE_LIMIT))
+
+        stages.run('scryfall_fallback',
+                   lambda: list(mlog.lookup_cards((mtga_id, 1) for mtga_id in unknown_ids)), scanned=0)
+        stages.run('get_collection', lambda: list(MtgaLog(log_file).get_collection()), repeat=repeat)
+
+        mtga_export = load_mtga_export()
+        output_file = os.path.join(work_dir, 'export.txt')
+        argv = sys.argv
+        sys.argv = [argv[0], 'bench']
+        try:
+            for name, flags in EXPORTS:
+                args = '-l "%s" --nocache -f "%s" %s' % (log_file, output_file, flags)
+                with quiet():
+                    stages.run('export_' + name, lambda: mtga_export.main(args), repeat=repeat)
+        finally:
+            sys.argv = argv
+        scryfall_requests = len(server.requests)
+
+    return stages.results, scryfall_requests
+
+
+def main():
+    from log_generator import generate_log, known_card_ids, parse_size, UNKNOWN_ID_START
+
+    parser = argparse.ArgumentParser(description="Benchmark mtga-export on a synthetic log")
+    parser.add_argument("--size", default="10MB", help="Size of the generated log, e.g. 10MB or 5GB")
+    parser.add_argument("--cards", type=int, default=3000, help="Number of known cards in the collection")
+    parser.add_argument("--unknown", type=int, default=20, help="Number of cards unknown to python-mtga")
+    parser.add_argument("--repeat", type=int, default=1, help="Report the best of N runs per stage")
+    parser.add_argument("--scryfall_rate", type=float,
+                        help="Scryfall requests per second [default: the Scryfall rate limit]")
+    parser.add_argument("--log", help="Benchmark an existing log generated with the same options")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='mtga-bench-')
+    os.environ['MTGA_UTILS_CACHE_DIR'] = work_dir
+    try:
+        card_ids = known_card_ids(args.cards)
+        unknown_ids = list(range(UNKNOWN_ID_START, UNKNOWN_ID_START + args.unknown))
+        generation = None
+        log_file = args.log
+        if log_file is None:
+            log_file = os.path.join(work_dir, 'Player.log')
+            start = timeit.default_timer()
+            generate_log(log_file, parse_size(args.size), card_ids, unknown=args.unknown)
+            generation = timeit.default_timer() - start
+
+        results, scryfall_requests = run_suite(
+            log_file, work_dir, card_ids, unknown_ids, args.repeat, args.scryfall_rate
+        )
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'log_bytes': os.path.getsize(log_file),
+            'generation_seconds': generation,
+            'scryfall_requests': scryfall_requests,
+            'peak_rss': peak_rss(),
+            'stages': results,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with io.open(args.output, 'w') as output:
+            output.write(text + u'\n')
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""Generate synthetic Player.log files for benchmarks
+
+The log starts with the detailed logs header and is filled with noise
+lines, repeated GetPlayerCardsV3 (growing collection), GetDeckListsV3 and
+GetPlayerInventory blocks, like a long Arena session.
+
+Usage: log_generator.py FILE [--size 100MB] [--cards 3000] [--unknown 20]
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import random
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import simplejson as json
+
+HEADER = "Initialize engine version: 2019.2.15f1\nDETAILED LOGS: ENABLED\n"
+NOISE_LINES = [
+    "[UnityCrossThreadLogger]Received unhandled GREMessageType: GREMessageType_UIMessage\n",
+    "[UnityCrossThreadLogger]==> Event.GetPlayerCoursesV2 {\"id\":%d,\"request\":\"{}\"}\n",
+    "(Filename: C:\\buildslave\\unity\\build\\Runtime/Export/Debug/Debug.bindings.h Line: 35)\n",
+    "[UnityCrossThreadLogger]Client.SceneChange {\"fromSceneName\":\"Home\",\"toSceneName\":\"Deck\",\"id\":%d}\n",
+    "Uploading Crash Report\n",
+]
+UNKNOWN_ID_START = 900000
+SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+
+def parse_size(text):
+    """Parse size like 10MB or 5GB as bytes"""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*$", text.upper())
+    if match is None:
+        raise ValueError("Invalid size %s" % text)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def known_card_ids(count):
+    """Ids of cards known to python-mtga"""
+    from mtga_log import get_card_index
+    return sorted(get_card_index())[:count]
+
+
+class LogGenerator(object):
+    """Write a synthetic log of about size bytes
+
+    Args:
+        size (int): Size of the log in bytes
+        card_ids (list): Ids of cards known to python-mtga in the collection
+        unknown (int): Number of cards unknown to python-mtga in the collection
+        decks (int): Number of decks
+        block_every (int): Bytes of noise between two groups of blocks
+        seed (int): Random seed
+    """
+
+    def __init__(self, size, card_ids, unknown=20, decks=20, block_every=256 * 1024, seed=0):
+        self.size = size
+        self.card_ids = list(card_ids)
+        self.unknown_ids = list(range(UNKNOWN_ID_START, UNKNOWN_ID_START + unknown))
+        self.decks = decks
+        self.block_every = block_every
+        self.random = random.Random(seed)
+        self.collection = {}
+        self.request_id = 0
+
+    def collection_block(self):
+        for mtga_id in self.random.sample(self.card_ids, min(len(self.card_ids), 50)):
+            self.collection[mtga_id] = min(4, self.collection.get(mtga_id, 0) + 1)
+        counts = dict(self.collection)
+        counts.update((mtga_id, 1) for mtga_id in self.unknown_ids)
+        lines = ',\n'.join('    "%d": "%d"' % (mtga_id, count) for mtga_id, count in sorted(counts.items()))
+        return "<== PlayerInventory.GetPlayerCardsV3(%d)\n{\n%s\n}\n" % (self.next_id(), lines)
+
+    def inventory_block(self):
+        payload = {
+            "wcCommon": self.random.randint(0, 99), "wcUncommon": self.random.randint(0, 99),
+            "wcRare": self.random.randint(0, 30), "wcMythic": self.random.randint(0, 10),
+            "gold": self.random.randint(0, 50000), "gems": self.random.randint(0, 5000),
+            "draftTokens": 0, "sealedTokens": 0, "vaultProgress": round(self.random.random() * 100, 1),
+            "starterDecks": []
+        }
+        return "<== PlayerInventory.GetPlayerInventory %s\n" % json.dumps({"id": self.next_id(), "payload": payload})
+
+    def deck_lists_block(self):
+        owned = sorted(self.collection) or self.card_ids
+        decks = []
+        for i in range(self.decks):
+            main_deck = []
+            for mtga_id in self.random.sample(owned, min(len(owned), 20)):
+                main_deck.extend([mtga_id, self.random.randint(1, 4)])
+            sideboard = []
+            for mtga_id in self.random.sample(owned, min(len(owned), 5)):
+                sideboard.extend([mtga_id, 1])
+            decks.append({
+                "id": "00000000-0000-0000-0000-%012d" % i, "name": "Deck %d" % i, "format": "Standard",
+                "deckTileId": main_deck[0] if main_deck else 0, "mainDeck": main_deck, "sideboard": sideboard
+            })
+        return "<== Deck.GetDeckListsV3 %s\n" % json.dumps({"id": self.next_id(), "payload": decks})
+
+    def next_id(self):
+        self.request_id += 1
+        return self.request_id
+
+    def noise(self, size):
+        lines = []
+        written = 0
+        while written < size:
+            line = self.random.choice(NOISE_LINES)
+            if '%d' in line:
+                line = line % self.next_id()
+            lines.append(line)
+            written += len(line)
+        return ''.join(lines)
+
+    def write(self, stream):
+        """Write the log to a text stream
+        Returns: number of bytes written
+        """
+        stream.write(HEADER)
+        written = len(HEADER)
+        while True:
+            blocks = self.collection_block() + self.inventory_block() + self.deck_lists_block()
+            remaining = self.size - written - len(blocks)
+            noise = self.noise(min(self.block_every, remaining)) if remaining > 0 else ''
+            stream.write(noise)
+            stream.write(blocks)
+            written += len(noise) + len(blocks)
+            if written >= self.size:
+                return written
+
+
+def generate_log(filename, size, card_ids=None, **kwargs):
+    """Write a synthetic log file
+    Returns: number of bytes written
+    """
+    if card_ids is None:
+        card_ids = known_card_ids(3000)
+    with open(filename, 'w') as log_file:
+        return LogGenerator(size, card_ids, **kwargs).write(log_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic MTGA log file")
+    parser.add_argument("file", help="Log file to write")
+    parser.add_argument("--size", default="10MB", help="Size of the log, e.g. 10MB or 5GB")
+    parser.add_argument("--cards", type=int, default=3000, help="Number of known cards in the collection")
+    parser.add_argument("--unknown", type=int, default=20, help="Number of cards unknown to python-mtga")
+    parser.add_argument("--decks", type=int, default=20, help="Number of decks")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    written = generate_log(
+        args.file, parse_size(args.size), known_card_ids(args.cards),
+        unknown=args.unknown, decks=args.decks, seed=args.seed
+    )
+    print(json.dumps({'file': args.file, 'bytes': written}))
+
+
+if __name__ == "__main__":
+    main()
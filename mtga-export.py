@@ -10,9 +10,21 @@ import argparse
 import shlex
 import sys
 import os
+import time
+import io
+import copy
+import contextlib
 from mtga_log import *
-from mtga_formats import MtgaFormats, normalize_set
+from mtga_batch import find_log_files
+from mtga_formats import MtgaFormats
+from mtga_writers import open_output, CustomWriter, GoldfishWriter, DeckstatsWriter, ArenaDeckWriter, write_decks_repr
 import scryfall
+import mtga_stats
+import mtga_card_index
+
+# Modules needed by some actions only (snapshots, diff, batch, bulk import,
+# profiling) are imported by these actions, so that e.g. --decknames does
+# not pay for loading them.
 
 __version__ = "0.4.4"
 
@@ -63,7 +75,8 @@ def get_argparse_parser():
     parser = argparse.ArgumentParser(description="Parse MTGA log file")
     parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + __version__)
     parser.add_argument("-l", "--log_file", nargs=1,
-                        help="MTGA/Unity log file [Win: %%AppData%%\\LocalLow\\Wizards Of The Coast\\MTGA\\Player.log]")
+                        help="MTGA/Unity log file, directory or glob pattern of log files "
+                             "[Win: %%AppData%%\\LocalLow\\Wizards Of The Coast\\MTGA\\Player.log]")
     parser.add_argument("-k", "--keyword", help="List json under keyword", nargs=1)
     parser.add_argument("--collids", help="List collection ids", action="store_true")
     parser.add_argument("-c", "--collection", help="List collection with card data", action="store_true")
@@ -85,7 +98,36 @@ def get_argparse_parser():
     parser.add_argument("--decknames", help="Print names of user's decks", action="store_true")
     parser.add_argument("--deckinfo", metavar="DECK_NAME", help="Print info about specific deck", nargs=1)
     parser.add_argument("--deckexport", metavar="DECK_NAME", help="Export specific deck in Arena format", nargs=1)
+    parser.add_argument("--snapshot", action="store_true",
+                        help="Record collection and inventory changes in the snapshot history")
+    parser.add_argument("--snapshots", action="store_true", help="List recorded snapshots")
+    parser.add_argument("--changes_since", metavar="DATE", nargs=1,
+                        help="Print collection and inventory changes recorded since DATE (YYYY-MM-DD[ HH:MM[:SS]])")
+    parser.add_argument("--diff", metavar="LOG_OR_DATE", nargs="+",
+                        help="Print changes of collection and inventory between two logs or snapshot dates "
+                             "(OLD [NEW]), NEW defaults to the current log")
     parser.add_argument("-f",  "--file", help="Store export to file", nargs=1)
+    parser.add_argument("--scryfall_workers", metavar="N", type=int, default=MTGA_SCRYFALL_WORKERS,
+                        help="Number of parallel requests for cards unknown to python-mtga")
+    parser.add_argument("--previous_log", action="store_true",
+                        help="Search Player-prev.log for data not found in the current log")
+    parser.add_argument("--import_bulk", metavar="BULK_FILE", nargs=1,
+                        help="Import cards from a Scryfall bulk data file (e.g. default-cards.json) "
+                             "into the offline card database and exit")
+    parser.add_argument("--nocache", help="Do not use on-disk caches", action="store_true")
+    parser.add_argument("--follow", metavar="SECONDS", type=float, nargs="?", const=2.0,
+                        help="Keep watching the log and export again when new data arrives")
+    parser.add_argument("--serve", metavar="ADDRESS", nargs="?", const="127.0.0.1:8721",
+                        help="Answer json queries on collection, inventory and decks over HTTP on "
+                             "HOST:PORT, PORT or a Unix socket path [default: 127.0.0.1:8721]")
+    parser.add_argument("--batch_workers", metavar="N", type=int,
+                        help="Number of processes when exporting multiple logs [default: number of CPUs]")
+    parser.add_argument("--output_dir", metavar="DIR", default="mtga-export",
+                        help="Directory for per-log exports and summary when exporting multiple logs")
+    parser.add_argument("--stats", action="store_true",
+                        help="Print time spent scanning, parsing, looking up cards and exporting to stderr")
+    parser.add_argument("--profile", metavar="FILE", nargs=1,
+                        help="Write cProfile stats to FILE (read with python -m pstats FILE)")
     parser.add_argument("--log", help="Log level", nargs="?", default="INFO")
     return parser
 
@@ -131,39 +173,95 @@ def get_keyword_data(args, mlog):
     return data
 
 
-def get_collection(mlog):
-    """Get collection and print messages"""
-    from mtga.models.card import Card
+def get_collection(session, stream=False):
+    """Get collection and print messages (once per session)
+    Args:
+        stream (bool): Yield cards as they are resolved without keeping them
+            in the session, for runs which use the collection only once
+    """
+    if stream:
+        return _get_valid_collection(session, lambda: session.mtga_log.lookup_cards(
+            iteritems(session.get_payload(MTGA_COLLECTION_KEYWORD))
+        ))
+    return session.memoize('valid_collection', lambda: list(
+        _get_valid_collection(session, session.get_collection)
+    ), MTGA_COLLECTION_KEYWORD)
+
+
+def stream_collection(args):
+    """Can the collection be streamed, i.e. is it used by only one action of a single export"""
+    uses = [args.collection, args.export, args.completiontracker, args.goldfish, args.deckstats]
+    return not (args.follow or args.serve) and sum(1 for use in uses if use) == 1
+
 
+def _get_valid_collection(session, get_cards):
     try:
-        for (mtga_id, card, count) in mlog.get_collection():
+        for (mtga_id, card, count) in get_cards():
             if isinstance(card, MtgaUnknownCard):
                 print('Info: Unknown card in collection: %s (Will fetch it from Scryfall)' % card)
             elif isinstance(card, scryfall.ScryfallError):
                 print('Warning: Could not fetch unknown card from scryfall: %s' % card)
-            elif not isinstance(card, Card):
+            elif not mtga_card_index.is_card(card):
                 print('Warning: Unexpected card format [id=%s, card=%s]' % (mtga_id, str(card)))
             else:
                 yield [card, count]
     except MtgaLogParsingError as error:
         print('Error: Could not parse json data: ', error)
         logging.debug("Got:")
-        logging.debug(mlog.get_last_keyword_block('<== ' + MTGA_COLLECTION_KEYWORD))
+        logging.debug(session.mtga_log.get_last_keyword_block('<== ' + MTGA_COLLECTION_KEYWORD))
 
 
 def main(args_string=None):
-    output = []
-
     args = parse_arguments(args_string)
     setup_logging(args)
 
+    if args.stats:
+        mtga_stats.enable()
+    try:
+        if args.profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(run, args)
+            finally:
+                profiler.dump_stats(args.profile[0])
+        return run(args)
+    finally:
+        if args.stats:
+            mtga_stats.print_stats()
+            mtga_stats.enable(False)
+
+
+def run(args):
+    """Run the actions requested by the parsed arguments"""
+    if args.import_bulk:
+        return import_bulk(args.import_bulk[0])
+
+    if (args.snapshots or args.changes_since) and not args.snapshot:
+        return print_snapshot_history(args)
+
+    if args.diff:
+        return print_diff(args)
+
     log_file = None
 
     if args.log_file:
-        log_file = args.log_file[0]
+        log_files = find_log_files(args.log_file[0])
+        if not log_files:
+            print("No log files match %s" % args.log_file[0])
+            return 1
+        if len(log_files) > 1 or os.path.isdir(args.log_file[0]):
+            return batch(args, log_files)
+        log_file = log_files[0]
+
+    if args.nocache:
+        scryfall.set_cache(None)
+        mtga_card_index.set_use_snapshot(False)
 
     try:
-        mlog = MtgaLog(log_file)
+        checkpoint = None if args.nocache else MtgaLogCheckpoint()
+        mlog = MtgaLog(log_file, checkpoint=checkpoint, search_previous=args.previous_log)
+        mlog.scryfall_workers = args.scryfall_workers
     except FileNotFoundError as exception:
         print("Arena log file not found, please provide proper log file.")
         print(str(exception))
@@ -177,101 +275,324 @@ def main(args_string=None):
         print('    - restart the game')
         return 1
 
+    session = MtgaSession(mlog)
+    export(args, session)
+
+    if args.serve:
+        return serve(args, session)
+
+    if args.follow:
+        return follow(args, session)
+
+
+def batch(args, log_files):
+    """Export every log in a process pool, one output per log plus a combined summary"""
+    from mtga_batch import log_names, run_batch, combine_summaries, MTGA_BATCH_SUMMARY_FILENAME
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    output_name = os.path.basename(args.file[0]) if args.file else "export.txt"
+    outputs = [
+        (os.path.join(args.output_dir, name, output_name),)
+        for name in log_names(log_files)
+    ]
+
+    summaries = []
+    for summary in run_batch(
+            log_files, export_log, [(args,) + output for output in outputs], args.batch_workers, args.nocache):
+        print('%s: %s' % (summary['log_file'], summary['error'] or 'exported to %s' % summary['output']))
+        summaries.append(summary)
+
+    summary = combine_summaries(summaries)
+    summary_file = os.path.join(args.output_dir, MTGA_BATCH_SUMMARY_FILENAME)
+    with open(summary_file, 'w') as out:
+        out.write(json.dumps(summary, indent=2) + '\n')
+    print("Exported %d logs (%d failed), summary in %s" % (summary['logs'], summary['failed'], summary_file))
+    return 1 if summary['failed'] else 0
+
+
+def export_log(log_file, args, output_file):
+    """Batch worker, export one log to output_file
+
+    Messages normally printed to the console are returned in the summary.
+    """
+    from mtga_batch import summarize_session
+
+    start = time.time()
+    args = copy.copy(args)
+    args.file = [output_file]
+    if args.nocache:
+        scryfall.set_cache(None)
+        mtga_card_index.set_use_snapshot(False)
+    if args.stats:
+        mtga_stats.enable()
+    summary = {'log_file': log_file, 'output': output_file, 'error': None}
+    messages = io.StringIO()
+    with contextlib.redirect_stdout(messages):
+        try:
+            mlog = MtgaLog(log_file, search_previous=args.previous_log)
+            mlog.scryfall_workers = args.scryfall_workers
+            if not mlog.detailed_logs():
+                summary['error'] = 'Detailed logs are disabled'
+            else:
+                if not os.path.isdir(os.path.dirname(output_file)):
+                    os.makedirs(os.path.dirname(output_file))
+                session = MtgaSession(mlog)
+                export(args, session)
+                summary.update(summarize_session(session))
+        except Exception as error:
+            summary['error'] = str(error)
+    summary['messages'] = messages.getvalue().splitlines()
+    if args.stats:
+        summary['stats'] = mtga_stats.get_stats()
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def import_bulk(bulk_filename):
+    """Import Scryfall bulk data file into the offline card database"""
+    import scryfall_bulk
+
+    offline_db = scryfall_bulk.ScryfallOfflineDb()
+    try:
+        imported, skipped = offline_db.import_bulk_file(bulk_filename)
+    except (IOError, ValueError) as error:
+        print('Error: Could not import %s: %s' % (bulk_filename, error))
+        return 1
+    finally:
+        offline_db.close()
+    print('Imported %d cards into %s (%d skipped)' % (imported, offline_db.filename, skipped))
+    return 0
+
+
+def print_snapshot_history(args):
+    """Print recorded snapshots and changes, without reading the log"""
+    from mtga_snapshots import MtgaSnapshotStore, parse_date
+
+    since = 0
+    if args.changes_since:
+        try:
+            since = parse_date(args.changes_since[0])
+        except ValueError as error:
+            print('Error: %s' % error)
+            return 1
+
+    store = MtgaSnapshotStore()
+    try:
+        if args.snapshots:
+            for snapshot in store.snapshots(since):
+                print('%d %s %s %s@%d' % (
+                    snapshot['id'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['log_time'])),
+                    snapshot['kind'], snapshot['log_file'], snapshot['log_offset']
+                ))
+
+        if args.changes_since:
+            for mtga_id, name, set_code, delta in store.card_changes_since(since):
+                print('%+d %s (%s) %d' % (delta, name or 'Unknown card', set_code or '?', mtga_id))
+            print_arrays_with_keys(store.inventory_changes_since(since), '', ':')
+    finally:
+        store.close()
+    return 0
+
+
+def get_diff_source(source, store):
+    """Card counts, inventory and log of a log file, or of the snapshot history at a date
+    Returns: (dict, MtgaInventory, MtgaLog) tuple, the log is None for snapshots
+    """
+    from mtga_diff import log_counts, snapshot_counts
+    from mtga_snapshots import parse_date
+
+    if os.path.isfile(source):
+        mlog = MtgaLog(source)
+        return log_counts(mlog) + (mlog,)
+    return snapshot_counts(store, parse_date(source)) + (None,)
+
+
+def print_diff(args):
+    """Print changes between two logs or snapshots"""
+    from mtga_diff import MtgaCollectionDiff
+    from mtga_snapshots import MtgaSnapshotStore
+
+    if len(args.diff) > 2:
+        print('Error: --diff takes one or two logs or dates')
+        return 1
+    sources = list(args.diff)
+    if len(sources) == 1:
+        try:
+            sources.append(args.log_file[0] if args.log_file else get_mtga_file_path(MTGA_LOG_FILENAME))
+        except FileNotFoundError as exception:
+            print("Arena log file not found, please provide proper log file.")
+            print(str(exception))
+            return 1
+
+    store = MtgaSnapshotStore()
+    try:
+        old_counts, old_inventory, old_log = get_diff_source(sources[0], store)
+        new_counts, new_inventory, new_log = get_diff_source(sources[1], store)
+    except (ValueError, MtgaLogParsingError) as error:
+        print('Error: %s' % error)
+        return 1
+    finally:
+        store.close()
+
+    diff = MtgaCollectionDiff(old_counts, new_counts, old_inventory, new_inventory, new_log or old_log)
+    for mtga_id, card, change in diff.card_changes():
+        print('%+d %s %s%s' % (change, mtga_id, card, ' (new)' if diff.deltas[mtga_id][0] == 0 else ''))
+    print_arrays_with_keys(diff.inventory_changes(), 'Inventory', ':')
+    print_arrays_with_keys(diff.set_changes(), 'Sets', ':')
+    return 0
+
+
+def follow(args, session):
+    """Watch the log and export again whenever a watched keyword gets a new block
+
+    The log may be missing for a moment while Arena restarts, it is then
+    polled again until it is back.
+    """
+    session.refresh()
+    print('Watching %s for changes, press Ctrl+C to stop' % session.mtga_log.log_filename)
+    pending = set()
+    try:
+        while True:
+            time.sleep(args.follow)
+            try:
+                pending.update(session.refresh().intersection(MTGA_WATCHED_KEYWORDS))
+                if pending:
+                    logging.info("New data for: %s" % ', '.join(sorted(pending)))
+                    export(args, session)
+                    pending.clear()
+            except OSError as error:
+                logging.warning("Could not read %s, retrying: %s" % (session.mtga_log.log_filename, error))
+    except KeyboardInterrupt:
+        return 0
+
+
+def serve(args, session):
+    """Answer json queries from the warm session until interrupted"""
+    from mtga_server import MtgaQueries, MtgaServer
+
+    queries = MtgaQueries(session)
+    queries.warm()
+    server = MtgaServer(queries, args.serve)
+    print('Serving %s on %s, press Ctrl+C to stop' % (session.mtga_log.log_filename, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.close()
+
+
+def export(args, session):
+    """Run all requested actions, sharing parsed data through the session"""
+    mlog = session.mtga_log
+
+    if args.snapshot:
+        with mtga_stats.timer('export.snapshot'):
+            from mtga_snapshots import MtgaSnapshotStore
+            store = MtgaSnapshotStore()
+            print("Recorded %d new snapshots" % store.record_log(mlog))
+            store.close()
+            if args.snapshots or args.changes_since:
+                print_snapshot_history(args)
+
     if args.collids:
         args.keyword = MTGA_COLLECTION_KEYWORD
 
     if args.keyword:
-        print(get_keyword_data(args, mlog))
+        with mtga_stats.timer('export.keyword'):
+            print(get_keyword_data(args, mlog))
+
+    stream = stream_collection(args)
 
     if args.collection:
-        for card, count in get_collection(mlog):
-            logging.debug(str(card))
-            print(card.mtga_id, card, count)
+        with mtga_stats.timer('export.collection'):
+            for card, count in get_collection(session, stream):
+                logging.debug(str(card))
+                print(card.mtga_id, card, count)
 
-    if args.export:
-        output.append(','.join(args.export))
-        for card, count in get_collection(mlog):
-            fields = []
-            for key in args.export:
-                if key == "count":
-                    fields.append(str(count))
-                else:
-                    fields.append(str(getattr(card, key)))
-            output.append(','.join(fields))
+    if args.inventory:
+        with mtga_stats.timer('export.inventory'):
+            inventory_dict = session.get_inventory().inventory()
+            print_arrays_with_keys(inventory_dict, '', ':')
+
+    if args.decks:
+        with mtga_stats.timer('export.decks'):
+            decks = {}
+            for deck in session.get_deck_lists():
+                decks[deck.name] = deck.deck()
+            print_arrays_with_keys(decks, '', ':')
 
-    if args.completiontracker:
-        sets_progression_output = {}
-        mformats = MtgaFormats(mtga_log=mlog)
+    if args.deckinfo:
+        with mtga_stats.timer('export.deckinfo'):
+            for deck in session.get_deck_lists():
+                if deck.name == args.deckinfo[0]:
+                    print_arrays_with_keys(deck.deck(), '', ':')
+
+    output_actions = [
+        args.export, args.completiontracker, args.goldfish, args.deckstats,
+        args.inventoryjson, args.decksjson, args.decknames, args.deckexport
+    ]
+    if not any(output_actions):
+        return
 
-        for card, count in get_collection(mlog):
-            if sets_progression_output.get(card.set, None) is None:
-                sets_progression_output[card.set] = {
-                    'singlesOwned': 0,
-                    'completeSetsOwned': 0,
-                    'totalSetCount': mformats.get_set_card_count(card.set)
-                }
+    with open_output(args.file[0] if args.file else None) as out:
+        write_output(args, session, out, stream)
+    if args.file:
+        print("Exported to file")
 
-            sets_progression_output[card.set]['singlesOwned'] += 1
 
-            if int(count) >= 4:
-                sets_progression_output[card.set]['completeSetsOwned'] += 1
+def write_output(args, session, out, stream=False):
+    """Stream all exports to out
+    Args:
+        stream (bool): Stream the collection instead of keeping it in the session
+    """
+    if args.export:
+        with mtga_stats.timer('export.export'):
+            CustomWriter(out, args.export).write(get_collection(session, stream))
 
-        output.append(json.dumps(sets_progression_output, indent=2))
+    if args.completiontracker:
+        with mtga_stats.timer('export.completiontracker'):
+            write_completion(session, out, stream)
 
     if args.goldfish:
-        output.append('Card,Set ID,Set Name,Quantity,Foil')
-        for card, count in get_collection(mlog):
-            card_set = normalize_set(card.set, {'ANA': 'ARENA'})
-            output.append('"%s",%s,%s,%s,%s' % (card.pretty_name, card_set, '', count, ''))
+        with mtga_stats.timer('export.goldfish'):
+            GoldfishWriter(out).write(get_collection(session, stream))
 
     if args.deckstats:
-        output.append('card_name,amount,set_code,is_foil,is_pinned')
-        for card, count in get_collection(mlog):
-            card_set = normalize_set(card.set, {'ANA': 'MTGA'})
-            output.append('"%s",%s,"%s",%s,%s' % (
-                card.pretty_name, count, card_set, 0, 0,
-            ))
-
-    if args.inventory:
-        inventory_dict = mlog.get_inventory().inventory()
-        print_arrays_with_keys(inventory_dict, '', ':')
+        with mtga_stats.timer('export.deckstats'):
+            DeckstatsWriter(out).write(get_collection(session, stream))
 
     if args.inventoryjson:
-        inventory_dict = mlog.get_inventory().inventory()
-        output.append(json.dumps(inventory_dict, indent=2))
-
-    if args.decks or args.decksjson:
-        decks = {}
-        for deck in mlog.get_deck_lists():
-            decks[deck.name] = deck.deck()
-        if args.decksjson:
-            output.append(str(decks))
-        if args.decks:
-            print_arrays_with_keys(decks, '', ':')
+        with mtga_stats.timer('export.inventoryjson'):
+            inventory_dict = session.get_inventory().inventory()
+            out.write(json.dumps(inventory_dict, indent=2) + '\n')
 
-    if args.decknames:
-        for deck in mlog.get_deck_lists():
-            output.append(deck.name)
+    if args.decksjson:
+        with mtga_stats.timer('export.decksjson'):
+            write_decks_repr(out, session.get_deck_lists())
 
-    if args.deckinfo:
-        for deck in mlog.get_deck_lists():
-            if deck.name == args.deckinfo[0]:
-                print_arrays_with_keys(deck.deck(), '', ':')
+    if args.decknames:
+        with mtga_stats.timer('export.decknames'):
+            for deck in session.get_deck_lists():
+                out.write(deck.name + '\n')
 
     if args.deckexport:
-        for deck in mlog.get_deck_lists():
-            if deck.name == args.deckexport[0]:
-                output.append(deck.export_arena())
+        with mtga_stats.timer('export.deckexport'):
+            for deck in session.get_deck_lists():
+                if deck.name == args.deckexport[0]:
+                    ArenaDeckWriter(out).write(deck)
+
 
-    if output:
-        output_str = '\n'.join(output)
-        if args.file:
-            with open(args.file[0], "w") as out_file:
-                out_file.write(output_str)
-            print("Exported to file")
-        else:
-            print(output_str)
+def write_completion(session, out, stream=False):
+    """Write set completion of the collection as json"""
+    mformats = MtgaFormats(mtga_log=session.mtga_log)
+    sets_progression_output = mformats.get_set_completion(list(get_collection(session, stream)))
+    out.write(json.dumps(sets_progression_output, indent=2) + '\n')
 
 
 if __name__ == "__main__":
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     sys.exit(main())
@@ -0,0 +1,149 @@
+"""Process many MTGA logs in parallel
+
+Each log is handled in a worker process. Workers build the python-mtga
+card index once, in the pool initializer, and reuse it for every log
+they process.
+"""
+from __future__ import print_function
+import os
+import glob
+import time
+import scryfall
+import mtga_card_index
+from mtga_log import *
+
+MTGA_BATCH_LOG_PATTERNS = ("*.log",) + tuple("*.log" + ext for ext in MTGA_LOG_OPENERS)
+MTGA_BATCH_SUMMARY_FILENAME = "summary.json"
+
+
+def find_log_files(pattern):
+    """Expand a log file argument to a sorted list of log files
+
+    Directories are searched for *.log files (plain or compressed), except
+    the logs of previous sessions.
+
+    Args:
+        pattern (str): Log file, directory with logs or glob pattern
+    Returns:
+        list: Log file names
+    """
+    if os.path.isdir(pattern):
+        # Previous session logs belong to their account's log, see --previous_log
+        log_files = []
+        for log_pattern in MTGA_BATCH_LOG_PATTERNS:
+            log_files.extend(
+                log_file for log_file in glob.glob(os.path.join(pattern, '**', log_pattern), recursive=True)
+                if not is_previous_log(log_file)
+            )
+    elif glob.has_magic(pattern):
+        log_files = glob.glob(pattern, recursive=True)
+    else:
+        return [pattern]
+    return sorted(log_file for log_file in set(log_files) if os.path.isfile(log_file))
+
+
+def is_previous_log(log_file):
+    """Is log_file the log of a previous session, e.g. Player-prev.log or Player-prev.log.gz"""
+    base = os.path.splitext(log_file)[0] if is_compressed_log(log_file) else log_file
+    return os.path.splitext(base)[0].endswith(MTGA_PREVIOUS_LOG_SUFFIX)
+
+
+def log_names(log_files):
+    """Unique names for log files, e.g. ['a/Player.log', 'b/Player.log'] -> ['a_Player', 'b_Player']"""
+    log_files = [os.path.abspath(log_file) for log_file in log_files]
+    root = os.path.commonpath([os.path.dirname(log_file) for log_file in log_files]) if log_files else ''
+    names = []
+    for log_file in log_files:
+        name = os.path.splitext(os.path.relpath(log_file, root))[0]
+        names.append(name.replace(os.sep, '_'))
+    return names
+
+
+def init_worker(scryfall_rate=scryfall.SCRYFALL_RATE_LIMIT, nocache=False):
+    """Pool initializer, build the card index once per worker
+
+    Args:
+        scryfall_rate (float): Scryfall requests per second for this worker
+        nocache (bool): Do not use on-disk caches, as with --nocache
+    """
+    if nocache:
+        scryfall.set_cache(None)
+        mtga_card_index.set_use_snapshot(False)
+    get_card_index()
+    scryfall.set_client(scryfall.ScryfallClient(rate=scryfall_rate))
+
+
+def summarize_session(session):
+    """Summary of collection, decks and inventory of one log, without card lookups"""
+    summary = {}
+    try:
+        collection = session.get_payload(MTGA_COLLECTION_KEYWORD)
+        summary['cards'] = len(collection)
+        summary['total_cards'] = sum(int(count) for count in collection.values())
+    except MtgaLogParsingError:
+        summary['cards'] = summary['total_cards'] = None
+    try:
+        summary['decks'] = len(session.get_payload(MTGA_DECK_LISTS_KEYWORD))
+    except MtgaLogParsingError:
+        summary['decks'] = None
+    return summary
+
+
+def summarize_log(log_file):
+    """Worker summarizing one log
+
+    Returns:
+        dict: Summary, with 'error' set when the log could not be processed
+    """
+    start = time.time()
+    summary = {'log_file': log_file, 'error': None}
+    try:
+        summary.update(summarize_session(MtgaSession(MtgaLog(log_file))))
+    except Exception as error:
+        summary['error'] = str(error)
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def run_batch(log_files, worker, args=(), workers=None, nocache=False):
+    """Run worker(log_file, *args) for every log in a process pool
+
+    Args:
+        log_files (list): Log file names
+        worker: Module level function returning a summary dict
+        args (tuple): Extra arguments for the worker, one tuple per log
+            or one shared tuple
+        workers (int): Number of processes, defaults to the number of CPUs
+        nocache (bool): Do not use on-disk caches in the workers
+    Yields:
+        dict: Summaries in order of completion
+    """
+    import concurrent.futures
+
+    workers = min(workers or os.cpu_count() or 1, max(len(log_files), 1))
+    scryfall_rate = float(scryfall.SCRYFALL_RATE_LIMIT) / workers
+    if args and isinstance(args[0], tuple):
+        worker_args = args
+    else:
+        worker_args = [args] * len(log_files)
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker, initargs=(scryfall_rate, nocache)) as executor:
+        futures = [executor.submit(worker, log_file, *extra)
+                   for log_file, extra in zip(log_files, worker_args)]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def combine_summaries(summaries):
+    """Combined summary of a batch run"""
+    summaries = sorted(summaries, key=lambda summary: summary['log_file'])
+    ok = [summary for summary in summaries if not summary.get('error')]
+    return {
+        'logs': len(summaries),
+        'failed': len(summaries) - len(ok),
+        'cards': sum(summary.get('cards') or 0 for summary in ok),
+        'total_cards': sum(summary.get('total_cards') or 0 for summary in ok),
+        'decks': sum(summary.get('decks') or 0 for summary in ok),
+        'results': summaries,
+    }
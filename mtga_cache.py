@@ -0,0 +1,29 @@
+"""Location of on-disk caches used by mtga-utils"""
+
+import os
+import sys
+
+MTGA_CACHE_DIR_ENV = "MTGA_UTILS_CACHE_DIR"
+MTGA_CACHE_DIRNAME = "mtga-utils"
+
+
+def get_cache_dir():
+    """Get (and create) the directory for cache files
+
+    Can be overridden with the MTGA_UTILS_CACHE_DIR environment variable.
+    """
+    cache_dir = os.getenv(MTGA_CACHE_DIR_ENV)
+    if not cache_dir:
+        if sys.platform == "win32":
+            base = os.getenv("LOCALAPPDATA") or os.path.expanduser("~")
+        else:
+            base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        cache_dir = os.path.join(base, MTGA_CACHE_DIRNAME)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def get_cache_file_path(filename):
+    """Get the full path to the specified cache file"""
+    return os.path.join(get_cache_dir(), filename)
@@ -0,0 +1,264 @@
+"""Snapshot of the python-mtga card index
+
+Importing python-mtga loads every set (or, with Arena installed, generates
+them from the Arena data files) before a single card can be looked up.
+The card index is therefore saved once to a marshal file in the cache
+directory and loaded from there, without importing python-mtga, until the
+installed python-mtga version or, when python-mtga generates the sets
+from an Arena installation, the Arena data files change.
+
+Cards are always mtga_card_index.Card objects, with or without the
+snapshot, which have the same attributes and methods as python-mtga Card.
+"""
+import os
+import re
+import sys
+import marshal
+import logging
+import importlib.util
+import mtga_cache
+
+MTGA_CARD_INDEX_FILENAME = "card_index.marshal"
+MTGA_CARD_INDEX_FORMAT = 2
+MTGA_ARENA_DATA_KEYS = ('cards', 'loc', 'enums', 'abilities')
+MTGA_CARD_FIELDS = (
+    'name', 'pretty_name', 'cost', 'color_identity', 'card_type', 'sub_types',
+    'abilities', 'set', 'rarity', 'collectible', 'set_number', 'mtga_id'
+)
+
+COLORMAP = {
+    "R": "Red",
+    "W": "White",
+    "B": "Black",
+    "U": "Blue",
+    "G": "Green"
+}
+
+
+class Card(object):
+    """Lightweight python-mtga Card, see mtga.models.card.Card"""
+
+    __slots__ = (
+        'name', 'set', 'pretty_name', 'cost', 'color_identity', 'card_type', 'sub_types',
+        'set_number', 'mtga_id', 'rarity', 'collectible', 'abilities'
+    )
+
+    def __init__(self, name="", pretty_name="", cost=None, color_identity=None, card_type="", sub_types="",
+                 abilities=None, set_id="", rarity="", collectible=True, set_number=-1, mtga_id=-1):
+        self.name = name
+        self.set = set_id
+        self.pretty_name = pretty_name
+        self.cost = [] if cost is None else cost
+        self.color_identity = [] if color_identity is None else color_identity
+        self.card_type = card_type
+        self.sub_types = sub_types
+        self.set_number = set_number
+        self.mtga_id = mtga_id
+        self.rarity = rarity
+        self.collectible = collectible
+        self.abilities = [] if abilities is None else abilities
+
+    @property
+    def abilities_decoded(self):
+        from mtga.set_data import all_mtga_abilities
+        return {ability_id: all_mtga_abilities[ability_id] for ability_id in self.abilities}
+
+    @property
+    def colors(self):
+        colors = [COLORMAP[key] for key in COLORMAP if key in self.cost or key in self.color_identity]
+        if not colors and self.card_type == "Basic Land":
+            for land, color in [("Plains", "White"), ("Swamp", "Black"), ("Forest", "Green"),
+                                ("Mountain", "Red"), ("Island", "Blue")]:
+                if land in self.pretty_name:
+                    colors = [color]
+        return colors or ["Colorless"]
+
+    @property
+    def cmc(self):
+        """Converted mana cost"""
+        return sum(int(symbol) if symbol.isdigit() else 1 for symbol in self.cost if symbol != "X")
+
+    def to_serializable(self):
+        return {
+            "name": self.name,
+            "set": self.set,
+            "colors": self.colors,
+            "pretty_name": self.pretty_name,
+            "cost": self.cost,
+            "color_identity": self.color_identity,
+            "card_type": self.card_type,
+            "sub_types": self.sub_types,
+            "rarity": self.rarity,
+            "set_number": self.set_number,
+            "mtga_id": self.mtga_id
+        }
+
+    @classmethod
+    def from_dict(cls, obj):
+        """Card by the mtga_id of a serialized card, an unknown card when it is not in the index"""
+        from mtga_log import get_card_index
+        card = get_card_index().get(int(obj["mtga_id"]))
+        if card is None:
+            card = cls("unknown_{}".format(obj["mtga_id"]), "{}: Unknown MTGA ID".format(obj["mtga_id"]),
+                       card_type="unknown", sub_types="unknown", set_id="unknown", mtga_id=obj["mtga_id"])
+        return card
+
+    def __repr__(self):
+        return "<Card: '{}' {} {} {}>".format(self.pretty_name, self.colors, self.set, self.mtga_id)
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def is_card(card):
+    """Is card a python-mtga Card or mtga_card_index.Card, without importing python-mtga"""
+    if isinstance(card, Card):
+        return True
+    card_module = sys.modules.get('mtga.models.card')
+    return card_module is not None and isinstance(card, card_module.Card)
+
+
+def get_mtga_version():
+    """Version of the installed python-mtga, read without importing it
+    Returns: str or None
+    """
+    try:
+        spec = importlib.util.find_spec('mtga')
+    except (ImportError, ValueError):
+        return None
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    package_dir = list(spec.submodule_search_locations)[0]
+    try:
+        with open(os.path.join(package_dir, '_version.py')) as version_file:
+            match = re.search(r"__version__\s*=\s*['\"]([^'\"]+)['\"]", version_file.read())
+    except (IOError, OSError):
+        return None
+    return None if match is None else match.group(1)
+
+
+def get_arena_data_location():
+    """Directory python-mtga generates the card sets from, see mtga.set_data.dynamic
+    Returns: str or None on platforms where python-mtga uses its static sets
+    """
+    if sys.platform == 'darwin':
+        return os.path.join(
+            os.path.expanduser("~"), "Library/Application Support/com.wizards.mtga/Downloads/Data"
+        )
+    if sys.platform != 'win32':
+        return None
+    try:
+        from winreg import ConnectRegistry, OpenKey, HKEY_LOCAL_MACHINE, QueryValueEx
+        registry_key = OpenKey(ConnectRegistry(None, HKEY_LOCAL_MACHINE), r"SOFTWARE\Wizards of the Coast\MTGArena")
+        return QueryValueEx(registry_key, "Path")[0] + r"MTGA_Data\Downloads\Data"
+    except Exception:
+        root = os.environ.get("ProgramFiles", r"C:\Program Files")
+        return os.path.join(root, "Wizards of the Coast", "MTGA", "MTGA_Data", "Downloads", "Data")
+
+
+def get_arena_data_fingerprint(data_location=None):
+    """Names, sizes and modification times of the Arena data files python-mtga reads
+    Returns: sorted list of [name, size, mtime], None when Arena is not installed
+    """
+    data_location = get_arena_data_location() if data_location is None else data_location
+    if data_location is None or not os.path.isdir(data_location):
+        return None
+    fingerprint = []
+    for filename in os.listdir(data_location):
+        parts = filename.split('_')
+        if len(parts) > 1 and parts[1] in MTGA_ARENA_DATA_KEYS and filename.endswith('mtga'):
+            stat = os.stat(os.path.join(data_location, filename))
+            fingerprint.append([filename, stat.st_size, stat.st_mtime])
+    return sorted(fingerprint)
+
+
+def build_card_index():
+    """Dict of cards by mtga id, built by importing python-mtga"""
+    from mtga.set_data import all_mtga_cards
+    return dict((card.mtga_id, Card(*card_values(card))) for card in all_mtga_cards.cards)
+
+
+def card_values(card):
+    """Card fields as tuple, in MTGA_CARD_FIELDS (and Card constructor) order"""
+    return tuple(getattr(card, field) for field in MTGA_CARD_FIELDS)
+
+
+def save_snapshot(filename, version, card_index):
+    """Write the card index to a marshal file, replacing it atomically
+    Args:
+        version: Key the snapshot is valid for, e.g. python-mtga version and Arena data fingerprint
+    """
+    data = {
+        'format': MTGA_CARD_INDEX_FORMAT,
+        'version': version,
+        'cards': [card_values(card) for card in card_index.values()],
+    }
+    import tempfile
+
+    # A temp file per writer, batch workers may save the snapshot at the same time
+    fd, temp_filename = tempfile.mkstemp(
+        prefix=os.path.basename(filename) + '.', suffix='.tmp', dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as snapshot_file:
+            snapshot_file.write(marshal.dumps(data))
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def load_snapshot(filename, version):
+    """Read the card index from a marshal file
+    Returns: dict of Card by mtga id, None when missing or outdated
+    """
+    try:
+        with open(filename, 'rb') as snapshot_file:
+            # Reading the whole file first is much faster than marshal.load
+            data = marshal.loads(snapshot_file.read())
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get('format') != MTGA_CARD_INDEX_FORMAT or data.get('version') != version:
+        return None
+    return dict((values[-1], Card(*values)) for values in data['cards'])
+
+
+_use_snapshot = True
+
+
+def set_use_snapshot(use_snapshot):
+    """Enable or disable the card index snapshot"""
+    global _use_snapshot
+    _use_snapshot = use_snapshot
+
+
+def get_snapshot_version():
+    """Key of the card index: python-mtga version and Arena data fingerprint
+    Returns: list or None when python-mtga is not installed
+    """
+    version = get_mtga_version()
+    if version is None:
+        return None
+    return [version, get_arena_data_fingerprint()]
+
+
+def load_card_index():
+    """Load the card index from the snapshot, rebuilding the snapshot when
+    python-mtga was upgraded or the Arena data changed
+    Returns: dict of Card by mtga id
+    """
+    version = get_snapshot_version() if _use_snapshot else None
+    if version is None:
+        return build_card_index()
+
+    filename = mtga_cache.get_cache_file_path(MTGA_CARD_INDEX_FILENAME)
+    card_index = load_snapshot(filename, version)
+    if card_index is not None:
+        return card_index
+
+    logging.debug("Building card index snapshot for python-mtga %s" % version[0])
+    card_index = build_card_index()
+    try:
+        save_snapshot(filename, version, card_index)
+    except (IOError, OSError, ValueError) as error:
+        logging.debug("Could not save card index snapshot: %s" % error)
+    return card_index
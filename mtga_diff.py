@@ -0,0 +1,159 @@
+"""Differences between two collections and inventories
+
+Collections are compared as sorted MtgaCollection arrays (or dicts) of
+card counts by mtga id, so a diff is linear in the size of the
+collections, and card data is only looked up for the cards whose count
+changed.
+"""
+from mtga_log import *
+from mtga_snapshots import MTGA_SNAPSHOT_COLLECTION, MTGA_SNAPSHOT_INVENTORY
+
+
+def log_counts(mtga_log):
+    """Card counts and inventory of the last blocks in a log
+    Returns: (MtgaCollection, MtgaInventory) tuple
+    """
+    return mtga_log.get_collection_counts(), mtga_log.get_inventory()
+
+
+def snapshot_counts(store, until=None):
+    """Card counts and inventory from the snapshot history
+    Args:
+        store (MtgaSnapshotStore): Snapshot history
+        until (float): State at this unix time, defaults to the latest snapshot
+    Returns: (MtgaCollection, MtgaInventory) tuple
+    """
+    return (
+        MtgaCollection(iteritems(store.values_at(MTGA_SNAPSHOT_COLLECTION, until))),
+        MtgaInventory(store.values_at(MTGA_SNAPSHOT_INVENTORY, until))
+    )
+
+
+def count_deltas(old_counts, new_counts):
+    """Changed card counts
+    Args:
+        old_counts: MtgaCollection or dict of card counts by mtga id
+        new_counts: MtgaCollection or dict of card counts by mtga id
+    Returns: dict of (old count, new count) by mtga id, only for changed cards
+    """
+    if isinstance(old_counts, MtgaCollection) and isinstance(new_counts, MtgaCollection):
+        return old_counts.diff(new_counts)
+    deltas = {}
+    for mtga_id, count in iteritems(new_counts):
+        old_count = old_counts.get(mtga_id, 0)
+        if count != old_count:
+            deltas[mtga_id] = (old_count, count)
+    for mtga_id, old_count in iteritems(old_counts):
+        if mtga_id not in new_counts and old_count:
+            deltas[mtga_id] = (old_count, 0)
+    return deltas
+
+
+def inventory_deltas(old_inventory, new_inventory):
+    """Changed numeric values of MtgaInventory.inventory(), e.g. gold or wildcards
+    Returns: dict with the same nesting as MtgaInventory.inventory()
+    """
+    def diff(old, new):
+        changes = {}
+        for key, value in iteritems(new):
+            if isinstance(value, dict):
+                nested = diff(old.get(key) or {}, value)
+                if nested:
+                    changes[key] = nested
+            elif value != old.get(key, 0):
+                changes[key] = value - old.get(key, 0)
+        return changes
+    return diff(_inventory_dict(old_inventory), _inventory_dict(new_inventory))
+
+
+def _inventory_dict(inventory):
+    try:
+        return inventory.inventory()
+    except KeyError:
+        # Partial inventory, e.g. before the first inventory snapshot
+        raw = inventory.inventory_raw()
+        return MtgaInventory(dict(
+            (key, raw.get(key, 0)) for key in
+            ['gems', 'gold', 'draftTokens', 'sealedTokens', 'vaultProgress',
+             'wcCommon', 'wcUncommon', 'wcRare', 'wcMythic']
+        )).inventory()
+
+
+def resolve_cards(mtga_ids, mtga_log=None):
+    """Look up cards, through mtga_log (and its Scryfall fallback) if given
+    Returns: dict of Card, MtgaUnknownCard or ScryfallError by mtga id
+    """
+    cards = {}
+    if mtga_log is None:
+        for mtga_id in mtga_ids:
+            try:
+                cards[mtga_id] = find_one_mtga_card(mtga_id)
+            except ValueError as exception:
+                cards[mtga_id] = MtgaUnknownCard(exception)
+        return cards
+    for mtga_id, card, count in mtga_log.lookup_cards((mtga_id, 0) for mtga_id in mtga_ids):
+        # Cards fetched from Scryfall follow their MtgaUnknownCard
+        cards[mtga_id] = card
+    return cards
+
+
+class MtgaCollectionDiff(object):
+    """Differences between an old and a new collection and inventory
+
+    Args:
+        old_counts: MtgaCollection or dict of card counts by mtga id
+        new_counts: MtgaCollection or dict of card counts by mtga id
+        old_inventory (MtgaInventory): Inventory or None
+        new_inventory (MtgaInventory): Inventory or None
+        mtga_log (MtgaLog): Log used to look up cards unknown to python-mtga
+    """
+
+    def __init__(self, old_counts, new_counts, old_inventory=None, new_inventory=None, mtga_log=None):
+        self.deltas = count_deltas(old_counts, new_counts)
+        self.old_inventory = old_inventory
+        self.new_inventory = new_inventory
+        self.mtga_log = mtga_log
+        self._cards = None
+
+    @property
+    def cards(self):
+        """Card data of the changed cards, looked up on first access"""
+        if self._cards is None:
+            self._cards = resolve_cards(sorted(self.deltas), self.mtga_log)
+        return self._cards
+
+    def card_changes(self):
+        """List of [mtga_id, card, count change] sorted by set and name"""
+        changes = [[mtga_id, self.cards[mtga_id], new - old] for mtga_id, (old, new) in iteritems(self.deltas)]
+        return sorted(changes, key=lambda change: (getattr(change[1], 'set', ''), str(change[1]), change[0]))
+
+    def new_cards(self):
+        """List of [mtga_id, card, count] of cards not in the old collection"""
+        return [
+            [mtga_id, card, count] for mtga_id, card, count in self.card_changes()
+            if self.deltas[mtga_id][0] == 0
+        ]
+
+    def inventory_changes(self):
+        """Changes of gold, gems, wildcards, ... as in MtgaInventory.inventory()"""
+        if self.old_inventory is None or self.new_inventory is None:
+            return {}
+        return inventory_deltas(self.old_inventory, self.new_inventory)
+
+    def set_changes(self):
+        """Changes of set completion, as in the completion tracker export
+
+        Returns: dict of {'singlesOwned': change, 'completeSetsOwned': change} by set
+        """
+        changes = {}
+        for mtga_id, (old, new) in iteritems(self.deltas):
+            card_set = getattr(self.cards[mtga_id], 'set', None)
+            if card_set is None:
+                continue
+            singles = int(new > 0) - int(old > 0)
+            complete = int(new >= 4) - int(old >= 4)
+            if singles or complete:
+                set_change = changes.setdefault(card_set, {'singlesOwned': 0, 'completeSetsOwned': 0})
+                set_change['singlesOwned'] += singles
+                set_change['completeSetsOwned'] += complete
+        return changes
@@ -1,4 +1,5 @@
 import simplejson as json
+import logging
 from mtga_log import MtgaLogParsingError, get_mtga_file_path
 import scryfall
 
@@ -19,6 +20,7 @@ class MtgaFormats(object):
     def __init__(self, mtga_log, formats_filename=None):
         self.mtga_log = mtga_log
         self.formats_filename = formats_filename
+        self._set_info = {}
 
     def get_full_filename(self):
         if self.formats_filename is None:
@@ -49,9 +51,42 @@ class MtgaFormats(object):
                         sets.append("DOM")
         return sets
 
+    def prefetch_set_info(self, mtga_sets):
+        """Resolve info on all sets at once, see scryfall.get_sets_info"""
+        try:
+            self._set_info.update(scryfall.get_sets_info(mtga_sets))
+        except Exception as error:
+            logging.warning('Could not prefetch set info: %s' % error)
+
     def get_set_info(self, mtga_set):
-        return scryfall.get_set_info(mtga_set)
+        if mtga_set not in self._set_info:
+            self._set_info[mtga_set] = scryfall.get_set_info(mtga_set)
+        return self._set_info[mtga_set]
 
     def get_set_card_count(self, mtga_set):
         set_info = self.get_set_info(mtga_set)
         return set_info.get('card_count', 0)
+
+    def get_set_completion(self, collection):
+        """Set completion, as in the completion tracker export
+        Args:
+            collection: List of (card, count)
+        Returns: dict of {'singlesOwned', 'completeSetsOwned', 'totalSetCount'} by set
+        """
+        sets_progression = {}
+        self.prefetch_set_info([card.set for card, count in collection])
+
+        for card, count in collection:
+            if sets_progression.get(card.set, None) is None:
+                sets_progression[card.set] = {
+                    'singlesOwned': 0,
+                    'completeSetsOwned': 0,
+                    'totalSetCount': self.get_set_card_count(card.set)
+                }
+
+            sets_progression[card.set]['singlesOwned'] += 1
+
+            if int(count) >= 4:
+                sets_progression[card.set]['completeSetsOwned'] += 1
+
+        return sets_progression
@@ -0,0 +1,48 @@
+"""Find where json values end without parsing them
+
+Log blocks and bulk data files are read a chunk at a time. Before a value
+is parsed, find_value_end() tells whether the value is complete in the
+buffer: brackets are matched while strings, including escaped quotes,
+are skipped, so names like "Mono {R" do not unbalance the count.
+"""
+import re
+
+# Groups: 1 string start, 2 opening bracket, 3 closing bracket
+_TOKEN_PATTERNS = {
+    bytes: re.compile(br'(")|([{\[])|([}\]])'),
+    str: re.compile(r'(")|([{\[])|([}\]])'),
+}
+_STRING_END_PATTERNS = {
+    bytes: re.compile(br'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL),
+    str: re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL),
+}
+
+
+def find_value_end(buf, pos=0):
+    """Find the end of the first json object or array at or after pos
+    Args:
+        buf: str, bytes or any buffer supported by re (e.g. mmap)
+        pos (int): Offset to start searching at
+    Returns: offset just past the closing bracket, None when the value is
+        not complete in buf
+    """
+    key = str if isinstance(buf, str) else bytes
+    token_pattern = _TOKEN_PATTERNS[key]
+    string_end_pattern = _STRING_END_PATTERNS[key]
+    depth = 0
+    while True:
+        token = token_pattern.search(buf, pos)
+        if token is None:
+            return None
+        pos = token.end()
+        if token.lastindex == 1:
+            string_end = string_end_pattern.match(buf, pos)
+            if string_end is None:
+                return None
+            pos = string_end.end()
+        elif token.lastindex == 2:
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+            if depth == 0:
+                return pos
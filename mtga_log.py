@@ -1,17 +1,49 @@
 from __future__ import print_function
-from future.utils import iteritems
 import os
 import simplejson as json
 import scryfall
+import mtga_cache
+import mtga_stats
+import mtga_card_index
+import mtga_json
 import re
 import logging
+import mmap
+import contextlib
+import functools
+import itertools
+import array
+import bisect
+import io
 
 
 MTGA_COLLECTION_KEYWORD = "PlayerInventory.GetPlayerCardsV3"
 MTGA_DECK_LISTS_KEYWORD = "Deck.GetDeckListsV3"
 MTGA_INVENTORY_KEYWORD = "PlayerInventory.GetPlayerInventory"
 MTGA_PRECON_DECK_LISTS_KEYWORD = "Deck.GetPreconDecksV3"
+MTGA_WATCHED_KEYWORDS = (
+    MTGA_COLLECTION_KEYWORD, MTGA_DECK_LISTS_KEYWORD,
+    MTGA_INVENTORY_KEYWORD, MTGA_PRECON_DECK_LISTS_KEYWORD
+)
 MTGA_LOG_FILENAME = "Player.log"
+MTGA_CHECKPOINT_FILENAME = "log_checkpoints.json"
+MTGA_SCRYFALL_WORKERS = 4
+MTGA_RESPONSE_PREFIX = "<== "
+MTGA_TAIL_LIMIT = 64 * 1024 * 1024
+MTGA_HEADER_SIZE = 1024
+MTGA_METHOD_PATTERN = re.compile(br"<== ([\w.]+)")
+MTGA_PREVIOUS_LOG_SUFFIX = "-prev"
+MTGA_STREAM_CHUNK_SIZE = 1024 * 1024
+MTGA_STREAM_MAX_BLOCK = 64 * 1024 * 1024
+
+_json_decoder = json.JSONDecoder()
+_whitespace_pattern = re.compile(r'\s*')
+_card_index = None
+
+
+def iteritems(obj):
+    """Iterate over (key, value) pairs of a dict"""
+    return iter(obj.items())
 
 
 def _mtga_file_path(filename):
@@ -31,9 +63,115 @@ def get_mtga_file_path(filename):
     return filepath
 
 
+# Codecs are imported when a log is opened, most logs are not compressed
+def _open_gzip(filename):
+    import gzip
+    return gzip.open(filename)
+
+
+def _open_bz2(filename):
+    import bz2
+    return bz2.open(filename)
+
+
+def _open_xz(filename):
+    import lzma
+    return lzma.open(filename)
+
+
+def _open_zstd(filename):
+    try:
+        import zstandard
+    except ImportError:
+        raise IOError('Reading %s requires the zstandard package' % filename)
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True))
+
+
+MTGA_LOG_OPENERS = {
+    '.gz': _open_gzip,
+    '.bz2': _open_bz2,
+    '.xz': _open_xz,
+    '.zst': _open_zstd,
+}
+
+
+def _sha1(data):
+    import hashlib
+    return hashlib.sha1(data).hexdigest()
+
+
+def is_compressed_log(filename):
+    """Is the log compressed (.gz, .bz2, .xz or .zst)"""
+    return os.path.splitext(filename)[1].lower() in MTGA_LOG_OPENERS
+
+
+def open_log_stream(filename):
+    """Open log file as binary stream, decompressing it on the fly"""
+    opener = MTGA_LOG_OPENERS.get(os.path.splitext(filename)[1].lower())
+    if opener is None:
+        return open(filename, 'rb')
+    return opener(filename)
+
+
+def get_previous_log_filename(log_filename):
+    """Find the log of the previous session next to the log, e.g. Player.log -> Player-prev.log
+    Returns: str or None
+    """
+    base = os.path.splitext(log_filename)[0] if is_compressed_log(log_filename) else log_filename
+    root, ext = os.path.splitext(base)
+    previous = root + MTGA_PREVIOUS_LOG_SUFFIX + ext
+    for filename in [previous] + [previous + compressed_ext for compressed_ext in sorted(MTGA_LOG_OPENERS)]:
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+
+def _keyword_prefixes(method):
+    """Keywords matching a method name, e.g. b'A.B' -> ['A', 'A.B']"""
+    parts = method.decode('utf-8').split('.')
+    return ['.'.join(parts[:i]) for i in range(1, len(parts) + 1) if parts[i - 1]]
+
+
+@functools.lru_cache(maxsize=64)
+def _keyword_pattern(keyword):
+    """Precompiled bytes pattern matching the whole keyword"""
+    return re.compile(re.escape(keyword.encode('utf-8')) + br"\b")
+
+
+def _method_keywords(match):
+    """Keywords of a '<== Method' match and the keyword preceding their blocks"""
+    return [(keyword, MTGA_RESPONSE_PREFIX + keyword) for keyword in _keyword_prefixes(match.group(1))]
+
+
+def _line_end(buf, offset):
+    """Offset just past the end of the line starting at offset"""
+    line_end = buf.find(b'\n', offset)
+    return len(buf) if line_end == -1 else line_end + 1
+
+
+def get_card_index():
+    """Get dict of python-mtga cards by mtga id, loaded once per process
+    from the card index snapshot (see mtga_card_index)
+    """
+    global _card_index
+    if _card_index is None:
+        with mtga_stats.timer('lookup.card_index'):
+            _card_index = mtga_card_index.load_card_index()
+    return _card_index
+
+
 def find_one_mtga_card(mtga_id):
-    from mtga.set_data import all_mtga_cards
-    return all_mtga_cards.find_one(mtga_id)
+    try:
+        return get_card_index()[int(mtga_id)]
+    except (KeyError, ValueError, TypeError):
+        raise ValueError("Pool does not contain {}".format(mtga_id))
+
+
+def _in_card_index(card_index, mtga_id):
+    try:
+        return int(mtga_id) in card_index
+    except (ValueError, TypeError):
+        return False
 
 
 class MtgaLogParsingError(ValueError):
@@ -49,70 +187,511 @@ class MtgaUnknownCard(ValueError):
 class MtgaLog(object):
     """Process MTGA/Unity log file"""
 
-    def __init__(self, log_filename=None):
+    def __init__(self, log_filename=None, use_index=True, reverse_scan=False, checkpoint=None,
+                 search_previous=False):
         self.log_filename = get_mtga_file_path(MTGA_LOG_FILENAME) if log_filename is None else log_filename
         logging.debug("MtgaLog: %s" % self.log_filename)
         self.fallback = True
+        self.scryfall_workers = MTGA_SCRYFALL_WORKERS
+        self.use_index = use_index
+        self._keyword_index = None
+        self._indexed_size = None
+        self._scanned_size = None
+        self._log_identity = None
+        self.rotations = 0
+        self.checkpoint = checkpoint
+        self.reverse_scan = reverse_scan
+        self.tail_limit = MTGA_TAIL_LIMIT
+        self.compressed = is_compressed_log(self.log_filename)
+        self._stream_blocks = None
+        self.search_previous = search_previous
+        self._previous_log = None
 
     def detailed_logs(self):
         """Are detailed logs enabled"""
-        with open(self.log_filename) as logfile:
-            head = ''.join([next(logfile) for _ in range(100)])
+        with open_log_stream(self.log_filename) as logfile:
+            head = b''.join(itertools.islice(logfile, 100))
 
-        if re.search(r"DETAILED LOGS: ENABLED", head) is not None:
+        if re.search(br"DETAILED LOGS: ENABLED", head) is not None:
             return True
         return False
 
+    def get_previous_log(self):
+        """Log of the previous session (Player-prev.log), searched for keywords
+        not found in this log when search_previous is enabled
+        Returns: MtgaLog or None
+        """
+        if not self.search_previous:
+            return None
+        if self._previous_log is None:
+            previous_filename = get_previous_log_filename(self.log_filename)
+            if previous_filename is None:
+                return None
+            logging.debug("MtgaLog: previous log %s" % previous_filename)
+            self._previous_log = MtgaLog(previous_filename, self.use_index, self.reverse_scan, self.checkpoint)
+        return self._previous_log
+
     def scryfall_fallback(self, fallback=True):
         """Enable/disable fallback to Scryfall"""
         self.fallback = fallback
 
-    def get_last_keyword_block(self, keyword):
+    @contextlib.contextmanager
+    def _open_buffer(self):
+        """Memory-map the log file for bytes-level scanning"""
+        with open(self.log_filename, 'rb') as logfile:
+            try:
+                buf = mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can not be mapped
+                buf = None
+            if buf is None:
+                yield b""
+                return
+            try:
+                yield buf
+            finally:
+                buf.close()
+
+    @contextlib.contextmanager
+    def _open_block(self, keyword, reverse=None):
+        """Find the last block for keyword
+        Yields: (buffer, (offset, length)) tuple, None when keyword is not found
+        """
+        if self.compressed:
+            block = self._get_stream_block(keyword)
+            yield None if block is None else (block, (0, len(block)))
+            return
+        with self._open_buffer() as buf:
+            span = self._find_block_span(buf, keyword, reverse)
+            yield None if span is None else (buf, span)
+
+    def get_last_keyword_block(self, keyword, reverse=None):
         """Find json block for specific keyword (last in the file)
         Args:
             keyword (str): Keyword to search for in the log file
+            reverse (bool): Search from the end of the file,
+                defaults to MtgaLog.reverse_scan
         Returns: list
         """
-        bucket = []
-        copy = False
-        dict_levels = 0
-        list_levels = 0
-
-        with open(self.log_filename) as logfile:
-            for line in logfile:
-                if re.search(r"%s\b" % re.escape(keyword), line):
-                    bucket, dict_levels, list_levels = [], 0, 0
-
-                    if line.count('{') > 0 or line.count('[') > 0:
-                        line = re.sub(r'.*' + re.escape(keyword), '', line)
-                    else:
-                        line = ""
-                    copy = True
-
-                if copy and line:
-                    bucket.append(line)
-                    dict_levels += line.count('{') - line.count('}')
-                    list_levels += line.count('[') - line.count(']')
-
-                if line.count('}') > 0 and dict_levels == 0 and list_levels == 0:
-                    copy = False
-                if line.count(']') > 0 and list_levels == 0 and dict_levels == 0:
-                    copy = False
-        return bucket
+        with self._open_block(keyword, reverse) as block:
+            if block is None:
+                previous_log = self.get_previous_log()
+                return [] if previous_log is None else previous_log.get_last_keyword_block(keyword, reverse)
+            return self._read_span(*block)
+
+    def _find_block_span(self, buf, keyword, reverse=None):
+        """Find (offset, length) of the last block for keyword
+        Returns: tuple or None
+        """
+        reverse = self.reverse_scan if reverse is None else reverse
+        if reverse:
+            line_offset = self._rfind_keyword_line(buf, keyword)
+            if line_offset is not None:
+                return self._block_span(buf, line_offset, keyword)
+            logging.debug("MtgaLog: %s not found in the last %s bytes" % (keyword, self.tail_limit))
+
+        span = self._get_indexed_span(keyword)
+        if span is not None:
+            return span
+
+        line_offset = self._find_keyword_line(buf, keyword)
+        if line_offset is None:
+            return None
+        return self._block_span(buf, line_offset, keyword)
+
+    @mtga_stats.timed('log.scan')
+    def _find_keyword_line(self, buf, keyword):
+        """Find the offset of the last line containing keyword
+        Returns: int or None
+        """
+        last_match = None
+        for last_match in _keyword_pattern(keyword).finditer(buf):
+            pass
+        if last_match is None:
+            return None
+        return buf.rfind(b'\n', 0, last_match.start()) + 1
+
+    @mtga_stats.timed('log.scan')
+    def _rfind_keyword_line(self, buf, keyword):
+        """Find the offset of the last line containing keyword, from the end
+
+        Only the last MtgaLog.tail_limit bytes are searched (None for no limit).
+        Returns: int or None
+        """
+        pattern = _keyword_pattern(keyword)
+        keyword_bytes = keyword.encode('utf-8')
+        limit = 0 if self.tail_limit is None else max(0, len(buf) - self.tail_limit)
+        end = len(buf)
+
+        while True:
+            found = buf.rfind(keyword_bytes, limit, end)
+            if found == -1:
+                return None
+            if pattern.match(buf, found):
+                return buf.rfind(b'\n', 0, found) + 1
+            end = found + len(keyword_bytes) - 1
+
+    @mtga_stats.timed('log.extract')
+    def _block_span(self, buf, line_offset, keyword):
+        """Find the json block following the keyword line
+        Args:
+            buf: Log file buffer
+            line_offset (int): Offset of the line containing keyword
+            keyword (str): Keyword starting the block
+        Returns: (offset, length) tuple
+        """
+        return self._scan_block(buf, line_offset, keyword)[:2]
+
+    def _scan_block(self, buf, line_offset, keyword):
+        """Find the json block following the keyword line
+        Returns: (offset, length, closed) tuple, closed is False when
+            the json value does not end before the end of the buffer
+        """
+        line_end = _line_end(buf, line_offset)
+        line = buf[line_offset:line_end]
+        if b'{' in line or b'[' in line:
+            keyword_bytes = keyword.encode('utf-8')
+            start = line_offset + line.rfind(keyword_bytes) + len(keyword_bytes)
+        else:
+            start = line_end
+
+        end = mtga_json.find_value_end(buf, start)
+        if end is None:
+            return start, len(buf) - start, False
+        return start, end - start, True
+
+    def _iter_stream_blocks(self, stream, pattern, keywords_for_match, last_only=False,
+                            chunk_size=MTGA_STREAM_CHUNK_SIZE):
+        """Generator of (offset, key, block) for blocks in a stream, one chunk at a time
+
+        Only the current chunk and a block which is not complete yet are
+        kept in memory, so compressed logs are never inflated as a whole.
+        Args:
+            stream: Binary file object
+            pattern: Compiled bytes pattern matching lines which start a block
+            keywords_for_match: Function returning [(key, keyword), ...] for a match,
+                key to yield the block with and keyword preceding the block
+            last_only (bool): Only yield the last block of every key in each
+                chunk; the same block may then be yielded more than once
+        """
+        carry = b''
+        carry_offset = 0
+        eof = False
+        while not eof:
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            window = carry + chunk
+            end = len(window) if eof else window.rfind(b'\n') + 1
+            lines = window[:end]
+
+            matches = []
+            for match in pattern.finditer(lines):
+                for key, keyword in keywords_for_match(match):
+                    matches.append((match.start(), key, keyword))
+            if last_only:
+                matches = sorted(dict((key, (offset, key, keyword)) for offset, key, keyword in matches).values())
+
+            keep = end
+            for match_offset, key, keyword in matches:
+                line_offset = lines.rfind(b'\n', 0, match_offset) + 1
+                offset, length, closed = self._scan_block(lines, line_offset, keyword)
+                if closed or eof:
+                    yield carry_offset + offset, key, lines[offset:offset + length]
+                    continue
+                # Continues in the next chunk
+                keep = min(keep, line_offset)
+                if not last_only:
+                    break
+
+            if end - keep > MTGA_STREAM_MAX_BLOCK:
+                logging.warning("MtgaLog: skipping unterminated block in %s" % self.log_filename)
+                keep = end
+            carry = lines[keep:] + window[end:]
+            carry_offset += keep
+
+    @mtga_stats.timed('log.scan')
+    def _stream_last_blocks(self, stream, pattern, keywords_for_match, chunk_size=MTGA_STREAM_CHUNK_SIZE):
+        """Find the last block of keywords in a stream
+        Returns: dict of block bytes by key
+        """
+        blocks = self._iter_stream_blocks(stream, pattern, keywords_for_match, True, chunk_size)
+        return dict((key, block) for offset, key, block in blocks)
+
+    def _get_stream_block(self, keyword):
+        """Get the last block for keyword from a compressed log
+        Returns: bytes or None
+        """
+        if self.use_index and keyword.startswith(MTGA_RESPONSE_PREFIX):
+            if self._stream_blocks is None or self._scanned_size != os.path.getsize(self.log_filename):
+                self.refresh()
+            return self._stream_blocks.get(keyword[len(MTGA_RESPONSE_PREFIX):])
+
+        with open_log_stream(self.log_filename) as stream:
+            blocks = self._stream_last_blocks(stream, _keyword_pattern(keyword), lambda match: [(keyword, keyword)])
+        return blocks.get(keyword)
+
+    def _refresh_stream(self):
+        """Index the last block of every '<== Method' keyword of a compressed log
+
+        Compressed logs can not be appended to, so the whole log is indexed
+        again when its size changes.
+        Returns: set of keywords with a new last block
+        """
+        size = os.path.getsize(self.log_filename)
+        if self._stream_blocks is not None and size == self._scanned_size:
+            return set()
+        previous_blocks = self._stream_blocks or {}
+        with open_log_stream(self.log_filename) as stream:
+            self._stream_blocks = self._stream_last_blocks(stream, MTGA_METHOD_PATTERN, _method_keywords)
+        if self._scanned_size is not None:
+            self.rotations += 1
+        self._scanned_size = size
+        return set(
+            keyword for keyword, block in iteritems(self._stream_blocks)
+            if previous_blocks.get(keyword) != block
+        ) | (set(previous_blocks) - set(self._stream_blocks))
+
+    def build_keyword_index(self):
+        """Index the last block of every '<== Method' keyword in one pass
+
+        The log is read once; for each method keyword (and each of its
+        dotted prefixes) the byte offset and length of its last json block
+        is recorded, so that later lookups do not have to rescan the file.
+        Returns: dict
+        """
+        if self.compressed:
+            self._stream_blocks = None
+            self.refresh()
+            return self._stream_blocks
+        self._keyword_index = None
+        self.refresh()
+        logging.debug("MtgaLog: indexed %d keywords in %d bytes" % (len(self._keyword_index), self._indexed_size))
+        return self._keyword_index
+
+    def refresh(self):
+        """Update the keyword index with blocks appended since the last call
+
+        Only bytes after the last indexed offset are scanned. Truncated or
+        rotated log files (e.g. after a client restart) are indexed again
+        from the start, counted in rotations; all keywords of the replaced
+        log are then reported as changed. Blocks which are not completely
+        written yet are picked up by the next call.
+        Returns: set of keywords with a new last block
+        Raises: OSError when the log file is missing, e.g. while Arena restarts
+        """
+        if self.compressed:
+            return self._refresh_stream()
+        with self._open_buffer() as buf:
+            indexed_size = self._indexed_size
+            previous_keywords = set()
+            if self._keyword_index is None:
+                if not self._restore_checkpoint(buf):
+                    self._reset_index(buf)
+            elif self._log_rotated(buf):
+                logging.info("MtgaLog: %s was truncated or rotated, indexing again" % self.log_filename)
+                previous_keywords = set(self._keyword_index)
+                self.rotations += 1
+                self._reset_index(buf)
+
+            changed = self._index_region(buf, self._indexed_size) | previous_keywords
+            if self.checkpoint is not None and (changed or self._indexed_size != indexed_size):
+                self._save_checkpoint(buf)
+            return changed
+
+    def _reset_index(self, buf):
+        self._keyword_index = {}
+        self._indexed_size = 0
+        self._log_identity = self._get_log_identity(buf)
+
+    def _restore_checkpoint(self, buf):
+        """Restore the keyword index from the checkpoint, if still valid
+        Returns: bool
+        """
+        if self.checkpoint is None:
+            return False
+        entry = self.checkpoint.load(self.log_filename)
+        if entry is None:
+            return False
+
+        self._log_identity = tuple(entry['identity'])
+        self._scanned_size = entry['scanned_size']
+        if self._log_rotated(buf):
+            logging.debug("MtgaLog: checkpoint for %s is outdated" % self.log_filename)
+            return False
+
+        index = {}
+        for keyword, (offset, length, block_hash) in iteritems(entry['keywords']):
+            if _sha1(buf[offset:offset + length]) != block_hash:
+                logging.debug("MtgaLog: checkpoint block %s does not match the log" % keyword)
+                return False
+            index[keyword] = (offset, length)
+
+        self._keyword_index = index
+        self._indexed_size = entry['indexed_size']
+        logging.debug("MtgaLog: restored %d keywords from checkpoint" % len(index))
+        return True
+
+    def _save_checkpoint(self, buf):
+        keywords = {}
+        for keyword, (offset, length) in iteritems(self._keyword_index):
+            keywords[keyword] = (offset, length, _sha1(buf[offset:offset + length]))
+        self.checkpoint.save(self.log_filename, {
+            'identity': self._log_identity,
+            'indexed_size': self._indexed_size,
+            'scanned_size': self._scanned_size,
+            'keywords': keywords
+        })
+
+    def _get_log_identity(self, buf):
+        """Identify the log file by inode and a fingerprint of its header"""
+        stat = os.stat(self.log_filename)
+        header = buf[:MTGA_HEADER_SIZE]
+        return stat.st_dev, stat.st_ino, len(header), _sha1(header)
+
+    @property
+    def indexed_size(self):
+        """Bytes of the log covered by the keyword index, None before indexing"""
+        return self._indexed_size
+
+    def get_log_identity(self):
+        """Identify the log file by inode and a fingerprint of its header
+        Returns: (device, inode, header size, header hash) tuple
+        """
+        with self._open_buffer() as buf:
+            return self._get_log_identity(buf)
+
+    def has_identity(self, identity):
+        """Is the log file the one identified by identity, possibly grown since"""
+        device, inode, header_size, header_hash = identity
+        stat = os.stat(self.log_filename)
+        if (stat.st_dev, stat.st_ino) != (device, inode):
+            return False
+        with open(self.log_filename, 'rb') as logfile:
+            return _sha1(logfile.read(header_size)) == header_hash
+
+    def _log_rotated(self, buf):
+        """Has the log been replaced or truncated since it was indexed"""
+        if len(buf) < self._scanned_size:
+            return True
+        device, inode, header_size, header_hash = self._log_identity
+        stat = os.stat(self.log_filename)
+        if (stat.st_dev, stat.st_ino) != (device, inode):
+            return True
+        if _sha1(buf[:header_size]) != header_hash:
+            return True
+        if header_size < MTGA_HEADER_SIZE:
+            self._log_identity = self._get_log_identity(buf)
+        return False
+
+    @mtga_stats.timed('log.scan')
+    def _index_region(self, buf, start):
+        """Index the complete lines from start to the end of the buffer
+        Returns: set of keywords with a new last block
+        """
+        end = max(start, buf.rfind(b'\n', start) + 1)
+        last_methods = {}
+        for match in MTGA_METHOD_PATTERN.finditer(buf, start, end):
+            last_methods[match.group(1)] = match.start()
+
+        last_keywords = {}
+        for method, match_offset in iteritems(last_methods):
+            for keyword in _keyword_prefixes(method):
+                last_keywords[keyword] = max(match_offset, last_keywords.get(keyword, -1))
+
+        changed = set()
+        for keyword, match_offset in iteritems(last_keywords):
+            line_offset = buf.rfind(b'\n', 0, match_offset) + 1
+            block_offset, length, closed = self._scan_block(buf, line_offset, MTGA_RESPONSE_PREFIX + keyword)
+            if not closed:
+                # Still being written, scan it again next time
+                end = min(end, line_offset)
+                continue
+            if self._keyword_index.get(keyword) != (block_offset, length):
+                self._keyword_index[keyword] = (block_offset, length)
+                changed.add(keyword)
+
+        mtga_stats.count('log.scanned_bytes', len(buf) - start)
+        self._indexed_size = end
+        self._scanned_size = len(buf)
+        return changed
+
+    def _get_indexed_span(self, keyword):
+        """Get (offset, length) of the last block for keyword from the index
+
+        Returns None when the keyword can not be served from the index,
+        e.g. it is not a '<== Method' keyword.
+        """
+        if not self.use_index or not keyword.startswith(MTGA_RESPONSE_PREFIX):
+            return None
+        if self._keyword_index is None:
+            self.build_keyword_index()
+        elif self._scanned_size != os.path.getsize(self.log_filename):
+            self.refresh()
+        return self._keyword_index.get(keyword[len(MTGA_RESPONSE_PREFIX):])
+
+    @mtga_stats.timed('log.extract')
+    def _read_span(self, buf, span):
+        """Decode block as list of lines"""
+        offset, length = span
+        return buf[offset:offset + length].decode('utf-8').splitlines(True)
 
     def get_last_json_block(self, keyword):
         """Get the block as dict"""
         try:
-            block = self.get_last_keyword_block(keyword)
-            return self._list_to_json(block)
+            with self._open_block(keyword) as block:
+                if block is None:
+                    previous_log = self.get_previous_log()
+                    if previous_log is None:
+                        raise MtgaLogParsingError('Keyword %s not found' % keyword)
+                    return previous_log.get_last_json_block(keyword)
+                return self._decode_span(*block)
+        except MtgaLogParsingError:
+            raise
         except ValueError as exception:
             raise MtgaLogParsingError(exception)
             # return False
 
-    def _list_to_json(self, json_list):
-        json_string = ''.join(json_list)
-        return json.loads(json_string)
+    @mtga_stats.timed('log.parse')
+    def _decode_span(self, buf, span):
+        """Parse the json value of a block"""
+        offset, length = span
+        mtga_stats.count('log.parsed_bytes', length)
+        # Decode straight from the buffer, without copying the span to bytes first
+        with memoryview(buf) as view, view[offset:offset + length] as span_view:
+            text = str(span_view, 'utf-8')
+        return _json_decoder.raw_decode(text, _whitespace_pattern.match(text).end())[0]
+
+    def iter_json_blocks(self, keyword, start=0):
+        """Generator of (offset, dict) for every block of keyword, in log order
+
+        Blocks which can not be parsed are skipped.
+        Args:
+            keyword (str): Keyword to search for in the log file
+            start (int): Skip blocks before this offset
+        """
+        for offset, (buf, span) in self._iter_block_spans(keyword, start):
+            try:
+                yield offset, self._decode_span(buf, span)
+            except ValueError as exception:
+                logging.warning("MtgaLog: could not parse %s block at %d: %s" % (keyword, offset, exception))
+
+    def _iter_block_spans(self, keyword, start=0):
+        """Generator of (offset, (buffer, (offset, length))) for every block of keyword"""
+        if self.compressed:
+            with open_log_stream(self.log_filename) as stream:
+                blocks = self._iter_stream_blocks(stream, _keyword_pattern(keyword), lambda match: [(keyword, keyword)])
+                for offset, key, block in blocks:
+                    if offset >= start:
+                        yield offset, (block, (0, len(block)))
+            return
+
+        with self._open_buffer() as buf:
+            for match in _keyword_pattern(keyword).finditer(buf, start):
+                line_offset = buf.rfind(b'\n', 0, match.start()) + 1
+                span = self._block_span(buf, line_offset, keyword)
+                yield span[0], (buf, span)
 
+    @mtga_stats.timed('lookup.scryfall')
     def _fetch_card_from_scryfall(self, mtga_id):
         if not self.fallback:
             return None
@@ -122,47 +701,329 @@ class MtgaLog(object):
             card = scryfall.ScryfallError(scryfall_error)
         return card
 
+    @mtga_stats.timed('lookup.scryfall')
+    def _fetch_cards_from_scryfall(self, mtga_ids):
+        """Fetch many cards at once
+        Returns: dict of Card or ScryfallError by mtga id
+        """
+        if not self.fallback or not mtga_ids:
+            return {}
+        try:
+            return scryfall.get_mtga_cards(mtga_ids, self.scryfall_workers)
+        except Exception as scryfall_error:
+            return dict((mtga_id, scryfall.ScryfallError(scryfall_error)) for mtga_id in mtga_ids)
+
     def lookup_cards(self, list_of_pairs):
+        """Generator of [mtga_id, card, count] in the original order
+
+        Cards unknown to python-mtga are looked up in the offline card
+        database (see scryfall_bulk). Cards not found there either are
+        yielded as MtgaUnknownCard first, followed by the card fetched
+        from Scryfall (or ScryfallError).
+        Only the ids of unknown cards are collected up front, to look them
+        up in one batch, known cards are resolved while they are yielded.
+        Args:
+            list_of_pairs: Iterable of (mtga_id, count), iterated twice; an
+                iterator is copied to a list first
+        """
+        if iter(list_of_pairs) is list_of_pairs:
+            list_of_pairs = list(list_of_pairs)
+        card_index = get_card_index()
+        with mtga_stats.timer('lookup.python_mtga'):
+            unknown_ids = [mtga_id for (mtga_id, count) in list_of_pairs if not _in_card_index(card_index, mtga_id)]
+        mtga_stats.count('lookup.cards', len(list_of_pairs))
+        mtga_stats.count('lookup.unknown_cards', len(unknown_ids))
+
+        offline_cards = self._lookup_offline(unknown_ids)
+        unknown_ids = [mtga_id for mtga_id in unknown_ids if mtga_id not in offline_cards]
+        fetched_cards = self._fetch_cards_from_scryfall(unknown_ids) if unknown_ids else {}
         for (mtga_id, count) in list_of_pairs:
             try:
                 card = find_one_mtga_card(mtga_id)
             except ValueError as exception:
-                yield [mtga_id, MtgaUnknownCard(exception), count]
-                # Card not found, try to get it from scryfall
-                card = self._fetch_card_from_scryfall(mtga_id)
+                card = offline_cards.get(mtga_id)
+                if card is None:
+                    yield [mtga_id, MtgaUnknownCard(exception), count]
+                    # Card not found, try to get it from scryfall
+                    card = fetched_cards.get(mtga_id)
+                    if card is None:
+                        continue
+            yield [mtga_id, card, count]
 
-            if card is not None:
-                yield [mtga_id, card, count]
+    @mtga_stats.timed('lookup.offline')
+    def _lookup_offline(self, mtga_ids):
+        """Look up cards unknown to python-mtga in the offline card database
+        Returns: dict of Card by mtga id, only for cards found
+        """
+        if not mtga_ids:
+            return {}
+        import scryfall_bulk
+        offline_db = scryfall_bulk.get_offline_db()
+        if offline_db is None:
+            return {}
+        return offline_db.get_many(mtga_ids)
 
     def lookup_card(self, mtga_id):
         try:
             return find_one_mtga_card(mtga_id)
         except ValueError:
+            card = self._lookup_offline([mtga_id]).get(mtga_id)
+            if card is not None:
+                return card
             return self._fetch_card_from_scryfall(mtga_id)
 
+    def get_payload(self, keyword):
+        """Get payload of the last '<== keyword' response"""
+        block = self.get_last_json_block(MTGA_RESPONSE_PREFIX + keyword)
+        return block.get('payload', block)
+
     def get_collection(self):
         """Generator for MTGA collection"""
-        collection = self.get_last_json_block('<== ' + MTGA_COLLECTION_KEYWORD)
-        collection = collection.get('payload', collection)
-        return self.lookup_cards(iteritems(collection))
+        collection = self.get_payload(MTGA_COLLECTION_KEYWORD)
+        return self.lookup_cards(collection.items())
+
+    def get_collection_counts(self):
+        """Get MTGA collection as compact MtgaCollection, cards are looked up on demand"""
+        return MtgaCollection(iteritems(self.get_payload(MTGA_COLLECTION_KEYWORD)), self)
 
     def get_inventory(self):
         """Convenience function to get the player's inventory"""
-        inventory_dict = self.get_last_json_block('<== ' + MTGA_INVENTORY_KEYWORD)
-        inventory_dict = inventory_dict.get('payload', inventory_dict)
-        return MtgaInventory(inventory_dict)
+        return MtgaInventory(self.get_payload(MTGA_INVENTORY_KEYWORD))
+
+    def _get_deck_lists(self, keyword, card_lookup=None):
+        card_lookup = MtgaCardLookup(self) if card_lookup is None else card_lookup
+        deck_lists = [MtgaDeckList(j, card_lookup) for j in self.get_payload(keyword)]
+        for deck_list in deck_lists:
+            card_lookup.add(deck_list.card_ids())
+        return deck_lists
+
+    def get_deck_lists(self, card_lookup=None):
+        """Get all deck lists, cards of all decks are resolved together on first access"""
+        return self._get_deck_lists(MTGA_DECK_LISTS_KEYWORD, card_lookup)
+
+    def get_preconstructed_deck_lists(self, card_lookup=None):
+        """Get all preconstructed deck lists"""
+        return self._get_deck_lists(MTGA_PRECON_DECK_LISTS_KEYWORD, card_lookup)
+
+
+class MtgaSession(object):
+    """Parse-once view of the log shared by several actions
+
+    Every keyword block is parsed once and the resolved collection,
+    inventory and deck lists are memoized until refresh() finds a new
+    block of the keyword they were built from.
+    """
+
+    def __init__(self, mtga_log):
+        self.mtga_log = mtga_log
+        self._memo = {}
+
+    def memoize(self, name, factory, keyword=None):
+        """Get memoized value, calling factory() on first access
+        Args:
+            name: Key of the value
+            factory: Function returning the value
+            keyword (str): Keyword the value is built from, values without
+                keyword are dropped whenever the log has new blocks
+        """
+        if name not in self._memo:
+            self._memo[name] = (keyword, factory())
+        return self._memo[name][1]
+
+    def refresh(self):
+        """Pick up new blocks from the log, dropping memoized values built from them
+
+        All values are dropped when the log was replaced, including those
+        of keywords the new log has no block of yet.
+        Returns: set of keywords with a new last block
+        """
+        rotations = self.mtga_log.rotations
+        changed = self.mtga_log.refresh()
+        if self.mtga_log.rotations != rotations:
+            self._memo.clear()
+        elif changed:
+            for name, (keyword, value) in list(iteritems(self._memo)):
+                if keyword is None or keyword in changed:
+                    del self._memo[name]
+        return changed
+
+    def get_payload(self, keyword):
+        return self.memoize(('payload', keyword), lambda: self.mtga_log.get_payload(keyword), keyword)
+
+    def get_collection(self):
+        """MTGA collection as list of [mtga_id, card, count]"""
+        return self.memoize('collection', lambda: list(
+            self.mtga_log.lookup_cards(self.get_payload(MTGA_COLLECTION_KEYWORD).items())
+        ), MTGA_COLLECTION_KEYWORD)
+
+    def get_collection_counts(self):
+        return self.memoize('collection_counts', self.mtga_log.get_collection_counts, MTGA_COLLECTION_KEYWORD)
+
+    def get_inventory(self):
+        return self.memoize(
+            'inventory', lambda: MtgaInventory(self.get_payload(MTGA_INVENTORY_KEYWORD)), MTGA_INVENTORY_KEYWORD
+        )
+
+    def get_card_lookup(self):
+        """Card lookup shared by all deck lists of the session"""
+        return self.memoize('card_lookup', lambda: MtgaCardLookup(self.mtga_log))
 
     def get_deck_lists(self):
-        """Get all deck lists"""
-        deck_lists_json = self.get_last_json_block('<== ' + MTGA_DECK_LISTS_KEYWORD)
-        deck_lists_json = deck_lists_json.get('payload', deck_lists_json)
-        return [MtgaDeckList(j, self) for j in deck_lists_json]
+        return self.memoize(
+            'deck_lists', lambda: self.mtga_log.get_deck_lists(self.get_card_lookup()), MTGA_DECK_LISTS_KEYWORD
+        )
 
     def get_preconstructed_deck_lists(self):
-        """Get all preconstructed deck lists"""
-        deck_lists_json = self.get_last_json_block('<== ' + MTGA_PRECON_DECK_LISTS_KEYWORD)
-        deck_lists_json = deck_lists_json.get('payload', deck_lists_json)
-        return [MtgaDeckList(j, self) for j in deck_lists_json]
+        return self.memoize('precon_deck_lists', lambda: self.mtga_log.get_preconstructed_deck_lists(
+            self.get_card_lookup()
+        ), MTGA_PRECON_DECK_LISTS_KEYWORD)
+
+
+class MtgaLogCheckpoint(object):
+    """On-disk checkpoint of keyword indexes, keyed by log file path
+
+    Each entry stores the log identity (inode and header fingerprint),
+    the indexed size and offset, length and hash of every last block.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = mtga_cache.get_cache_file_path(MTGA_CHECKPOINT_FILENAME) if filename is None else filename
+
+    def _load_all(self):
+        try:
+            with open(self.filename) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (IOError, ValueError):
+            return {}
+
+    def load(self, log_filename):
+        """Get checkpoint entry for the log file
+        Returns: dict or None
+        """
+        return self._load_all().get(os.path.abspath(log_filename))
+
+    def save(self, log_filename, entry):
+        """Store checkpoint entry for the log file"""
+        entries = self._load_all()
+        entries[os.path.abspath(log_filename)] = entry
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as checkpoint_file:
+            json.dump(entries, checkpoint_file)
+        os.replace(temp_filename, self.filename)
+
+
+class MtgaCollection(object):
+    """Compact collection of card counts
+
+    Ids and counts are kept in parallel arrays sorted by id, 8 bytes per
+    card, and card data is looked up on demand. Iterating yields
+    [mtga_id, card, count] like MtgaLog.get_collection.
+
+    Args:
+        pairs: Iterable of (mtga_id, count), as ints or strings
+        mtga_log (MtgaLog): Log to look up cards unknown to python-mtga with
+    """
+
+    def __init__(self, pairs=(), mtga_log=None):
+        pairs = sorted((int(mtga_id), int(count)) for mtga_id, count in pairs)
+        self.mtga_ids = array.array('I', [mtga_id for mtga_id, count in pairs])
+        self.counts = array.array('I', [count for mtga_id, count in pairs])
+        self.mtga_log = mtga_log
+
+    def __len__(self):
+        return len(self.mtga_ids)
+
+    def __iter__(self):
+        if self.mtga_log is not None:
+            return self.mtga_log.lookup_cards(self.items())
+        return self._lookup_cards()
+
+    def _lookup_cards(self):
+        for mtga_id, count in self.items():
+            try:
+                yield [mtga_id, find_one_mtga_card(mtga_id), count]
+            except ValueError as exception:
+                yield [mtga_id, MtgaUnknownCard(exception), count]
+
+    def items(self):
+        """Iterator of (mtga_id, count)"""
+        return zip(self.mtga_ids, self.counts)
+
+    def _find(self, mtga_id):
+        i = bisect.bisect_left(self.mtga_ids, mtga_id)
+        if i < len(self.mtga_ids) and self.mtga_ids[i] == mtga_id:
+            return i
+        return None
+
+    def __contains__(self, mtga_id):
+        return self._find(int(mtga_id)) is not None
+
+    def get(self, mtga_id, default=None):
+        """Get count of a card by binary search"""
+        i = self._find(int(mtga_id))
+        return default if i is None else self.counts[i]
+
+    def total(self):
+        """Number of cards, counting every copy"""
+        return sum(self.counts)
+
+    def diff(self, other):
+        """Changed counts, in one pass over both sorted arrays
+        Returns: dict of (count in self, count in other) by mtga id
+        """
+        deltas = {}
+        i, j = 0, 0
+        ids, other_ids = self.mtga_ids, other.mtga_ids
+        while i < len(ids) or j < len(other_ids):
+            if j == len(other_ids) or (i < len(ids) and ids[i] < other_ids[j]):
+                if self.counts[i]:
+                    deltas[ids[i]] = (self.counts[i], 0)
+                i += 1
+            elif i == len(ids) or other_ids[j] < ids[i]:
+                if other.counts[j]:
+                    deltas[other_ids[j]] = (0, other.counts[j])
+                j += 1
+            else:
+                if self.counts[i] != other.counts[j]:
+                    deltas[ids[i]] = (self.counts[i], other.counts[j])
+                i += 1
+                j += 1
+        return deltas
+
+    def card_sets(self):
+        """Set of every card, cards unknown to python-mtga are looked up through mtga_log
+        Returns: dict of set code by mtga id, None for cards which could not be found
+        """
+        card_index = get_card_index()
+        sets = {}
+        unknown = []
+        for mtga_id in self.mtga_ids:
+            card = card_index.get(mtga_id)
+            if card is None:
+                unknown.append((mtga_id, 0))
+                sets[mtga_id] = None
+            else:
+                sets[mtga_id] = card.set
+        if unknown and self.mtga_log is not None:
+            for mtga_id, card, count in self.mtga_log.lookup_cards(unknown):
+                sets[mtga_id] = getattr(card, 'set', None)
+        return sets
+
+    def set_completion(self):
+        """Singles and complete playsets owned, by set
+        Returns: dict of {'singlesOwned': int, 'completeSetsOwned': int} by set
+        """
+        sets = self.card_sets()
+        completion = {}
+        for mtga_id, count in self.items():
+            card_set = sets[mtga_id]
+            if card_set is None or not count:
+                continue
+            set_completion = completion.setdefault(card_set, {'singlesOwned': 0, 'completeSetsOwned': 0})
+            set_completion['singlesOwned'] += 1
+            if count >= 4:
+                set_completion['completeSetsOwned'] += 1
+        return completion
 
 
 class MtgaInventory(object):
@@ -221,19 +1082,105 @@ class MtgaInventory(object):
         }
 
 
+class MtgaCardLookup(object):
+    """Card lookup shared by many card lists, e.g. all deck lists
+
+    Ids registered with add() are resolved together, once, on the first
+    lookup, so cards shared between decks are looked up only once and
+    unknown cards are fetched from Scryfall in one batch.
+    """
+
+    def __init__(self, mtga_log):
+        self.mtga_log = mtga_log
+        self._pending = []
+        self._resolved = {}
+
+    @staticmethod
+    def _key(mtga_id):
+        try:
+            return int(mtga_id)
+        except (ValueError, TypeError):
+            return mtga_id
+
+    def add(self, mtga_ids):
+        """Register ids to be resolved with the next lookup"""
+        self._pending.extend(mtga_id for mtga_id in mtga_ids if self._key(mtga_id) not in self._resolved)
+
+    def _resolve(self):
+        pending = list(dict.fromkeys(self._pending))
+        self._pending = []
+        for mtga_id in pending:
+            self._resolved[self._key(mtga_id)] = []
+        for (mtga_id, card, count) in self.mtga_log.lookup_cards((mtga_id, None) for mtga_id in pending):
+            self._resolved[self._key(mtga_id)].append(card)
+
+    def _lookup(self, mtga_id):
+        key = self._key(mtga_id)
+        if key not in self._resolved:
+            self._pending.append(mtga_id)
+            self._resolve()
+        elif self._pending:
+            self._resolve()
+        return self._resolved[key]
+
+    def lookup_cards(self, list_of_pairs):
+        """Same as MtgaLog.lookup_cards"""
+        list_of_pairs = list(list_of_pairs)
+        self.add(mtga_id for (mtga_id, count) in list_of_pairs)
+        for (mtga_id, count) in list_of_pairs:
+            for card in self._lookup(mtga_id):
+                yield [mtga_id, card, count]
+
+    def lookup_card(self, mtga_id):
+        """Same as MtgaLog.lookup_card"""
+        cards = self._lookup(mtga_id)
+        if not cards or (len(cards) == 1 and isinstance(cards[0], MtgaUnknownCard)):
+            return None
+        return cards[-1]
+
+
 class MtgaDeckList(object):
     """Wrapper for a deck list"""
 
     def __init__(self, deck_list_json, card_lookup):
         self.deck_list_json = deck_list_json
+        self.card_lookup = card_lookup
+        self._maindeck = None
+        self._sideboard = None
+        self._deckbox_image = None
 
-        maindeck_pairs = zip(*[iter(self.deck_list_json['mainDeck'])]*2)
-        self.maindeck = card_lookup.lookup_cards(maindeck_pairs)
+    @property
+    def maindeck_pairs(self):
+        return list(zip(*[iter(self.deck_list_json['mainDeck'])]*2))
 
-        sideboard_pairs = zip(*[iter(self.deck_list_json['sideboard'])]*2)
-        self.sideboard = card_lookup.lookup_cards(sideboard_pairs)
+    @property
+    def sideboard_pairs(self):
+        return list(zip(*[iter(self.deck_list_json['sideboard'])]*2))
 
-        self.deckbox_image = card_lookup.lookup_card(self.deck_list_json['deckTileId'])
+    def card_ids(self):
+        """All mtga ids used by the deck, including the deck box image"""
+        pairs = self.maindeck_pairs + self.sideboard_pairs
+        return [mtga_id for (mtga_id, count) in pairs] + [self.deck_list_json['deckTileId']]
+
+    @property
+    def maindeck(self):
+        """List of [mtga_id, card, count], resolved on first access"""
+        if self._maindeck is None:
+            self._maindeck = list(self.card_lookup.lookup_cards(self.maindeck_pairs))
+        return self._maindeck
+
+    @property
+    def sideboard(self):
+        """List of [mtga_id, card, count], resolved on first access"""
+        if self._sideboard is None:
+            self._sideboard = list(self.card_lookup.lookup_cards(self.sideboard_pairs))
+        return self._sideboard
+
+    @property
+    def deckbox_image(self):
+        if self._deckbox_image is None:
+            self._deckbox_image = self.card_lookup.lookup_card(self.deck_list_json['deckTileId'])
+        return self._deckbox_image
 
     @property
     def deck_id(self):
@@ -257,14 +1204,17 @@ class MtgaDeckList(object):
         }
 
     def export_arena(self):
+        """Deck in MTG Arena import format, cards which could not be looked up are left out"""
         export = ["Deck"]
         for [mtga_id, card, count] in self.maindeck:
-            export.append("{} {} ({}) {}".format(count, card.pretty_name, card.set, card.set_number))
+            if mtga_card_index.is_card(card):
+                export.append("{} {} ({}) {}".format(count, card.pretty_name, card.set, card.set_number))
         export.append("")
 
         export.append("Sideboard")
         for [mtga_id, card, count] in self.sideboard:
-            export.append("{} {} ({}) {}".format(count, card.pretty_name, card.set, card.set_number))
+            if mtga_card_index.is_card(card):
+                export.append("{} {} ({}) {}".format(count, card.pretty_name, card.set, card.set_number))
 
         return '\n'.join(export)
 
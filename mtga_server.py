@@ -0,0 +1,266 @@
+"""Answer json queries on collection, inventory and decks from a warm process
+
+The server keeps the MtgaLog keyword index, the card index and the
+resolved collection, inventory and deck lists in memory. Before each
+query the log is stat()ed; when it changed, the session is refreshed
+incrementally and only the responses built from keywords with new blocks
+are dropped, or all responses when Arena replaced the log. Responses are memoized as encoded json, so a repeated query
+costs a stat() and a dict lookup.
+
+Queries (GET):
+    /collection     Collection with card data
+    /inventory      Inventory
+    /decks          Deck lists with card data
+    /decks/NAME     One deck, with its Arena export
+    /completion     Set completion, as in the completion tracker export
+    /status         Log file and index state
+"""
+import os
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import unquote, urlsplit
+from mtga_log import *
+from mtga_formats import MtgaFormats
+import mtga_card_index
+import mtga_stats
+
+MTGA_SERVER_ADDRESS = "127.0.0.1:8721"
+
+
+def parse_address(address):
+    """Parse HOST:PORT, PORT or a Unix socket path (containing a /)
+    Returns: ('tcp', (host, port)) or ('unix', path) tuple
+    """
+    if '/' in address or address.startswith('unix:'):
+        return 'unix', address[len('unix:'):] if address.startswith('unix:') else address
+    host, _, port = address.rpartition(':')
+    try:
+        return 'tcp', (host or '127.0.0.1', int(port))
+    except ValueError:
+        raise ValueError('Invalid address %s, expected HOST:PORT, PORT or a socket path' % address)
+
+
+def card_json(mtga_id, card, count):
+    """Json of a card with its count, or of the lookup error for unknown cards"""
+    if mtga_card_index.is_card(card):
+        result = card.to_serializable()
+    else:
+        result = {'mtga_id': int(mtga_id), 'error': str(card)}
+    result['count'] = int(count) if count is not None else None
+    return result
+
+
+def resolved_cards(cards):
+    """Last lookup result per card, i.e. the Scryfall card following an MtgaUnknownCard
+    Returns: list of [mtga_id, card, count]
+    """
+    resolved = {}
+    for mtga_id, card, count in cards:
+        resolved[mtga_id] = [mtga_id, card, count]
+    return list(resolved.values())
+
+
+def deck_json(deck_list, export=False):
+    """Json of a deck list, with its Arena export if requested"""
+    maindeck = resolved_cards(deck_list.maindeck)
+    sideboard = resolved_cards(deck_list.sideboard)
+    result = {
+        'id': deck_list.deck_id,
+        'name': deck_list.name,
+        'format': deck_list.format,
+        'maindeck': [card_json(*entry) for entry in maindeck],
+        'sideboard': [card_json(*entry) for entry in sideboard],
+    }
+    if export:
+        result['export'] = deck_list.export_arena()
+    return result
+
+
+class MtgaQueries(object):
+    """Memoized json queries on a session, refreshed when the log changes
+
+    Queries are answered one at a time, the session is not thread-safe.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._log_state = None
+        self.refreshes = 0
+
+    def _get_log_state(self):
+        stat = os.stat(self.session.mtga_log.log_filename)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+
+    def refresh(self):
+        """Pick up new log blocks if the log changed since the last query
+        Returns: set of keywords with a new last block
+        """
+        state = self._get_log_state()
+        if state == self._log_state:
+            return set()
+        changed = self.session.refresh()
+        if changed and self._log_state is not None:
+            logging.info("New data for: %s" % ', '.join(sorted(changed.intersection(MTGA_WATCHED_KEYWORDS))))
+        self._log_state = state
+        self.refreshes += 1
+        return changed
+
+    def collection(self):
+        cards, unknown = [], []
+        for mtga_id, card, count in resolved_cards(self.session.get_collection()):
+            (cards if mtga_card_index.is_card(card) else unknown).append(card_json(mtga_id, card, count))
+        return {'cards': cards, 'unknown': unknown}
+
+    def inventory(self):
+        return self.session.get_inventory().inventory()
+
+    def decks(self):
+        return [deck_json(deck_list) for deck_list in self.session.get_deck_lists()]
+
+    def deck(self, name):
+        for deck_list in self.session.get_deck_lists():
+            if deck_list.name == name:
+                return deck_json(deck_list, export=True)
+        raise KeyError('Unknown deck %s' % name)
+
+    def completion(self):
+        collection = [
+            (card, count) for mtga_id, card, count in resolved_cards(self.session.get_collection())
+            if mtga_card_index.is_card(card)
+        ]
+        return MtgaFormats(mtga_log=self.session.mtga_log).get_set_completion(collection)
+
+    def status(self):
+        mtga_log = self.session.mtga_log
+        return {
+            'log_file': mtga_log.log_filename,
+            'log_size': self._log_state[2] if self._log_state else None,
+            'indexed_size': mtga_log.indexed_size,
+            'refreshes': self.refreshes,
+        }
+
+    def _get_query(self, path):
+        """Find the query for a path
+        Returns: (memo name, function, keyword) tuple, keyword is the one the
+            response is built from, None for responses which are not memoized
+        """
+        parts = [unquote(part) for part in urlsplit(path).path.strip('/').split('/')]
+        if parts == ['collection']:
+            return 'collection', self.collection, MTGA_COLLECTION_KEYWORD
+        if parts == ['inventory']:
+            return 'inventory', self.inventory, MTGA_INVENTORY_KEYWORD
+        if parts == ['decks']:
+            return 'decks', self.decks, MTGA_DECK_LISTS_KEYWORD
+        if len(parts) == 2 and parts[0] == 'decks':
+            return ('deck', parts[1]), lambda: self.deck(parts[1]), MTGA_DECK_LISTS_KEYWORD
+        if parts == ['completion']:
+            return 'completion', self.completion, MTGA_COLLECTION_KEYWORD
+        if parts == ['status']:
+            return 'status', self.status, None
+        return None
+
+    def query(self, path):
+        """Answer a query
+        Returns: (http status, json bytes) tuple
+        """
+        query = self._get_query(path)
+        if query is None:
+            return 404, self._encode({'error': 'Unknown query %s' % path})
+        name, function, keyword = query
+
+        with self._lock, mtga_stats.timer('server.query'):
+            mtga_stats.count('server.queries')
+            try:
+                self.refresh()
+            except OSError as error:
+                # The log is missing for a moment while Arena restarts
+                return 503, self._encode({'error': 'Could not read log: %s' % error})
+            try:
+                if keyword is None:
+                    return 200, self._encode(function())
+                return 200, self.session.memoize(('response', name), lambda: self._encode(function()), keyword)
+            except (KeyError, MtgaLogParsingError) as error:
+                return 404, self._encode({'error': str(error).strip("'")})
+            except Exception as error:
+                logging.exception("Query %s failed" % path)
+                return 500, self._encode({'error': str(error)})
+
+    def warm(self):
+        """Resolve collection, inventory and decks before the first query"""
+        for query in ('/collection', '/inventory', '/decks'):
+            self.query(query)
+
+    @staticmethod
+    def _encode(value):
+        return json.dumps(value).encode('utf-8')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class MtgaServer(object):
+    """HTTP server for MtgaQueries on a local TCP address or a Unix socket
+
+    Args:
+        queries (MtgaQueries): Queries to answer
+        address (str): HOST:PORT, PORT or Unix socket path
+    """
+
+    def __init__(self, queries, address=MTGA_SERVER_ADDRESS):
+        self.queries = queries
+        self.kind, self.address = parse_address(address)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, message_format, *args):
+                logging.debug("MtgaServer: " + message_format % args)
+
+            def do_GET(self):
+                status, body = queries.query(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        if self.kind == 'unix':
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.httpd = _ThreadingUnixServer(self.address, Handler)
+        else:
+            self.httpd = _ThreadingHTTPServer(self.address, Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        if self.kind == 'unix':
+            return 'unix:' + self.address
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.server_close()
+        if self.kind == 'unix' and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.close()
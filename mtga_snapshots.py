@@ -0,0 +1,262 @@
+"""History of collection and inventory blocks in a local SQLite database
+
+Every collection (PlayerInventory.GetPlayerCardsV3) and inventory
+(PlayerInventory.GetPlayerInventory) block which differs from the previous
+one is stored as a snapshot holding only the changes, so questions like
+"what changed since date X" are answered by the database instead of
+rescanning logs.
+"""
+import os
+import time
+import datetime
+import sqlite3
+import threading
+import simplejson as json
+import mtga_cache
+from mtga_log import *
+
+MTGA_SNAPSHOT_FILENAME = "snapshots.sqlite"
+MTGA_SNAPSHOT_COLLECTION = "collection"
+MTGA_SNAPSHOT_INVENTORY = "inventory"
+MTGA_SNAPSHOT_KEYWORDS = {
+    MTGA_SNAPSHOT_COLLECTION: MTGA_COLLECTION_KEYWORD,
+    MTGA_SNAPSHOT_INVENTORY: MTGA_INVENTORY_KEYWORD,
+}
+MTGA_SNAPSHOT_DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S")
+
+
+def parse_date(text):
+    """Parse local date (YYYY-MM-DD[ HH:MM[:SS]]) as unix time"""
+    for date_format in MTGA_SNAPSHOT_DATE_FORMATS:
+        try:
+            return time.mktime(datetime.datetime.strptime(text, date_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError("Invalid date %s, expected YYYY-MM-DD[ HH:MM[:SS]]" % text)
+
+
+def collection_values(payload):
+    """Card counts by mtga id of a collection payload"""
+    return dict((int(mtga_id), int(count)) for mtga_id, count in iteritems(payload))
+
+
+def inventory_values(payload):
+    """Numeric fields of an inventory payload, e.g. gold, gems and wildcards"""
+    return dict(
+        (name, value) for name, value in iteritems(payload)
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    )
+
+
+class MtgaSnapshotStore(object):
+    """SQLite store of collection and inventory snapshots
+
+    Snapshots are keyed by log file, log time (modification time of the log
+    when it was recorded) and byte offset of the block, and store the
+    difference to the previously recorded snapshot of the same kind. Logs
+    should therefore be recorded oldest first.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = mtga_cache.get_cache_file_path(MTGA_SNAPSHOT_FILENAME) if filename is None else filename
+        self._lock = threading.Lock()
+        self._state = {}
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, log_file TEXT NOT NULL, "
+            "log_time REAL NOT NULL, log_offset INTEGER NOT NULL, recorded REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots (kind, log_time)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS card_deltas ("
+            "snapshot_id INTEGER NOT NULL, mtga_id INTEGER NOT NULL, name TEXT, set_code TEXT, "
+            "delta INTEGER NOT NULL, count INTEGER NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS card_deltas_snapshot ON card_deltas (snapshot_id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS card_deltas_mtga_id ON card_deltas (mtga_id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS card_deltas_set ON card_deltas (set_code)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS inventory_deltas ("
+            "snapshot_id INTEGER NOT NULL, name TEXT NOT NULL, delta REAL NOT NULL, value REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS inventory_deltas_snapshot ON inventory_deltas (snapshot_id)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS log_positions ("
+            "log_file TEXT NOT NULL, kind TEXT NOT NULL, size INTEGER NOT NULL, log_offset INTEGER NOT NULL, "
+            "identity TEXT NOT NULL DEFAULT '', PRIMARY KEY (log_file, kind))"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(log_positions)")]
+        if 'identity' not in columns:
+            # Stores created before the log identity was recorded
+            self._db.execute("ALTER TABLE log_positions ADD COLUMN identity TEXT NOT NULL DEFAULT ''")
+        self._db.commit()
+
+    def record_log(self, mtga_log):
+        """Record collection and inventory blocks not seen before
+
+        Only blocks after the last recorded position in the log are parsed.
+        Returns: number of new snapshots
+        """
+        log_file = os.path.abspath(mtga_log.log_filename)
+        size = os.path.getsize(mtga_log.log_filename)
+        log_time = os.path.getmtime(mtga_log.log_filename)
+        identity = mtga_log.get_log_identity()
+        recorded = 0
+        for kind, keyword in sorted(iteritems(MTGA_SNAPSHOT_KEYWORDS)):
+            start = self._get_position(mtga_log, log_file, kind, size)
+            last_offset = None
+            for offset, block in mtga_log.iter_json_blocks(MTGA_RESPONSE_PREFIX + keyword, start):
+                last_offset = offset
+                if self.record(kind, block.get('payload', block), log_file, log_time, offset) is not None:
+                    recorded += 1
+            if last_offset is not None:
+                self._set_position(log_file, kind, size, last_offset + 1, identity)
+        return recorded
+
+    def _get_position(self, mtga_log, log_file, kind, size):
+        """Offset to continue recording at, 0 for a new, truncated or replaced log"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, log_offset, identity FROM log_positions WHERE log_file = ? AND kind = ?",
+                (log_file, kind)
+            ).fetchone()
+        if row is None or size < row[0] or not row[2] or not mtga_log.has_identity(json.loads(row[2])):
+            return 0
+        return row[1]
+
+    def _set_position(self, log_file, kind, size, offset, identity):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO log_positions (log_file, kind, size, log_offset, identity) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (log_file, kind, size, offset, json.dumps(list(identity)))
+            )
+            self._db.commit()
+
+    def record(self, kind, payload, log_file, log_time, offset):
+        """Record a collection or inventory payload as a snapshot
+
+        Returns: snapshot id, None when nothing changed since the previous snapshot
+        """
+        values = collection_values(payload) if kind == MTGA_SNAPSHOT_COLLECTION else inventory_values(payload)
+        with self._lock:
+            state = self._get_state(kind)
+            deltas = dict(
+                (key, values.get(key, 0) - state.get(key, 0))
+                for key in set(state) | set(values)
+                if values.get(key, 0) != state.get(key, 0)
+            )
+            if not deltas:
+                return None
+
+            cursor = self._db.execute(
+                "INSERT INTO snapshots (kind, log_file, log_time, log_offset, recorded) VALUES (?, ?, ?, ?, ?)",
+                (kind, log_file, log_time, offset, time.time())
+            )
+            snapshot_id = cursor.lastrowid
+            if kind == MTGA_SNAPSHOT_COLLECTION:
+                card_index = get_card_index()
+                rows = []
+                for mtga_id, delta in iteritems(deltas):
+                    card = card_index.get(mtga_id)
+                    rows.append((
+                        snapshot_id, mtga_id,
+                        None if card is None else card.pretty_name, None if card is None else card.set,
+                        delta, values.get(mtga_id, 0)
+                    ))
+                self._db.executemany(
+                    "INSERT INTO card_deltas (snapshot_id, mtga_id, name, set_code, delta, count) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", rows
+                )
+            else:
+                self._db.executemany(
+                    "INSERT INTO inventory_deltas (snapshot_id, name, delta, value) VALUES (?, ?, ?, ?)",
+                    [(snapshot_id, name, delta, values.get(name, 0)) for name, delta in iteritems(deltas)]
+                )
+            self._db.commit()
+            self._state[kind] = values
+        return snapshot_id
+
+    def _get_state(self, kind):
+        """Values of the latest snapshot, summed from the deltas once"""
+        if kind not in self._state:
+            self._state[kind] = self._sum_deltas(kind)
+        return self._state[kind]
+
+    def _sum_deltas(self, kind, until=None):
+        if kind == MTGA_SNAPSHOT_COLLECTION:
+            table, key = "card_deltas", "mtga_id"
+        else:
+            table, key = "inventory_deltas", "name"
+        query = "SELECT %s, SUM(delta) FROM %s" % (key, table)
+        args = []
+        if until is not None:
+            query += " JOIN snapshots ON snapshots.id = %s.snapshot_id WHERE snapshots.log_time <= ?" % table
+            args.append(until)
+        query += " GROUP BY %s" % key
+        values = {}
+        for key, value in self._db.execute(query, args):
+            if value:
+                values[key] = int(value) if float(value).is_integer() else value
+        return values
+
+    def values_at(self, kind, until=None):
+        """Values of the last snapshot of a kind recorded up to a time
+        Args:
+            kind (str): MTGA_SNAPSHOT_COLLECTION or MTGA_SNAPSHOT_INVENTORY
+            until (float): Unix time, defaults to the latest snapshot
+        Returns: dict of card counts by mtga id, or of inventory values by field
+        """
+        with self._lock:
+            if until is None:
+                return dict(self._get_state(kind))
+            return self._sum_deltas(kind, until)
+
+    def snapshots(self, since=None):
+        """List of snapshots as dicts, oldest first
+        Args:
+            since (float): Only snapshots of logs modified at or after this unix time
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, kind, log_file, log_time, log_offset, recorded FROM snapshots "
+                "WHERE log_time >= ? ORDER BY id", (since or 0,)
+            ).fetchall()
+        keys = ('id', 'kind', 'log_file', 'log_time', 'log_offset', 'recorded')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def card_changes_since(self, since, set_code=None):
+        """Card count changes since unix time
+
+        The first snapshot is the baseline, its cards are not changes.
+        Returns: list of (mtga_id, name, set_code, delta) tuples
+        """
+        query = (
+            "SELECT mtga_id, name, set_code, SUM(delta) FROM card_deltas "
+            "JOIN snapshots ON snapshots.id = card_deltas.snapshot_id "
+            "WHERE snapshots.log_time >= ? AND snapshots.id > (SELECT MIN(id) FROM snapshots WHERE kind = ?)"
+        )
+        args = [since, MTGA_SNAPSHOT_COLLECTION]
+        if set_code is not None:
+            query += " AND set_code = ?"
+            args.append(set_code)
+        query += " GROUP BY mtga_id HAVING SUM(delta) != 0 ORDER BY set_code, name"
+        with self._lock:
+            return self._db.execute(query, args).fetchall()
+
+    def inventory_changes_since(self, since):
+        """Inventory changes since unix time
+        Returns: dict of change by inventory field
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, SUM(delta) FROM inventory_deltas "
+                "JOIN snapshots ON snapshots.id = inventory_deltas.snapshot_id "
+                "WHERE snapshots.log_time >= ? AND snapshots.id > (SELECT MIN(id) FROM snapshots WHERE kind = ?) "
+                "GROUP BY name HAVING SUM(delta) != 0", (since, MTGA_SNAPSHOT_INVENTORY)
+            ).fetchall()
+        return dict((name, int(delta) if float(delta).is_integer() else delta) for name, delta in rows)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,131 @@
+"""Lightweight timers and counters for mtga-export --stats
+
+Instrumentation is disabled by default: timer() then returns a shared
+no-op context manager and count() returns at once, so instrumented code
+pays one global check per call. Timers are inclusive, e.g. an export
+timer includes the log scan and card lookups it triggers.
+"""
+from __future__ import print_function
+import sys
+import time
+import functools
+import threading
+
+_enabled = False
+_started = None
+_lock = threading.Lock()
+_timers = {}
+_counters = {}
+
+
+class _Timer(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.perf_counter() - self.start)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def enable(enabled=True):
+    """Enable or disable collecting stats, enabling resets them"""
+    global _enabled
+    if enabled:
+        reset()
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forget all timers and counters"""
+    global _started
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _started = time.perf_counter()
+
+
+def timer(name):
+    """Context manager adding the time spent in its block to timer name"""
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def timed(name):
+    """Decorator adding the time spent in the function to timer name"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_time(name, seconds):
+    """Add a measured duration, e.g. a request latency, to timer name"""
+    if not _enabled:
+        return
+    with _lock:
+        calls, total = _timers.get(name, (0, 0.0))
+        _timers[name] = (calls + 1, total + seconds)
+
+
+def count(name, value=1):
+    """Increase counter name"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_stats():
+    """Collected stats
+    Returns: dict with total seconds, {'calls', 'seconds'} by timer and value by counter
+    """
+    with _lock:
+        return {
+            'seconds': 0.0 if _started is None else time.perf_counter() - _started,
+            'timers': dict((name, {'calls': calls, 'seconds': seconds}) for name, (calls, seconds) in _timers.items()),
+            'counters': dict(_counters),
+        }
+
+
+def print_stats(stats=None, out=None):
+    """Print a breakdown of timers and counters, sorted by name"""
+    stats = get_stats() if stats is None else stats
+    out = sys.stderr if out is None else out
+    total = stats['seconds']
+    print('%-32s %8s %10s %7s' % ('timer', 'calls', 'seconds', '%'), file=out)
+    for name, timer_stats in sorted(stats['timers'].items()):
+        share = 100.0 * timer_stats['seconds'] / total if total else 0.0
+        print('%-32s %8d %10.4f %6.1f%%' % (name, timer_stats['calls'], timer_stats['seconds'], share), file=out)
+    print('%-32s %8s %10.4f' % ('total', '', total), file=out)
+    if stats['counters']:
+        print('%-32s %8s' % ('counter', 'value'), file=out)
+        for name, value in sorted(stats['counters'].items()):
+            print('%-32s %8s' % (name, value), file=out)
@@ -0,0 +1,104 @@
+"""Streaming export writers
+
+Each writer writes rows to an open text stream as soon as cards are
+resolved, instead of building the whole export in memory.
+"""
+import io
+import abc
+import csv
+import sys
+import contextlib
+from mtga_formats import normalize_set
+
+MTGA_WRITE_BUFFER_SIZE = 64 * 1024
+
+
+@contextlib.contextmanager
+def open_output(filename=None):
+    """Open buffered export file, or use stdout when no filename is given"""
+    if filename is None:
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+    with io.open(filename, 'w', newline='', encoding='utf-8', buffering=MTGA_WRITE_BUFFER_SIZE) as out_file:
+        yield out_file
+
+
+class CollectionWriter(abc.ABC):
+    """Write collection as csv, one row per (card, count)
+
+    Rows are quoted by csv.writer with the quoting of each format, the
+    header is written as is.
+    """
+
+    header = None
+    quoting = csv.QUOTE_MINIMAL
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = csv.writer(stream, quoting=self.quoting, lineterminator='\n')
+
+    @abc.abstractmethod
+    def row(self, card, count):
+        """Returns: list of fields for a card and its count"""
+
+    def write(self, collection):
+        """Write header and rows
+        Args:
+            collection: Iterable of (card, count)
+        """
+        if self.header:
+            self.stream.write(','.join(self.header) + '\n')
+        self.writer.writerows(self.row(card, count) for card, count in collection)
+
+
+class GoldfishWriter(CollectionWriter):
+    """mtggoldfish collection format"""
+
+    header = ['Card', 'Set ID', 'Set Name', 'Quantity', 'Foil']
+    quoting = csv.QUOTE_NONNUMERIC
+
+    def row(self, card, count):
+        return [card.pretty_name, normalize_set(card.set, {'ANA': 'ARENA'}), '', int(count), '']
+
+
+class DeckstatsWriter(CollectionWriter):
+    """deckstats.net collection format"""
+
+    header = ['card_name', 'amount', 'set_code', 'is_foil', 'is_pinned']
+    quoting = csv.QUOTE_NONNUMERIC
+
+    def row(self, card, count):
+        return [card.pretty_name, int(count), normalize_set(card.set, {'ANA': 'MTGA'}), 0, 0]
+
+
+class CustomWriter(CollectionWriter):
+    """Custom columns, card attributes or 'count'"""
+
+    def __init__(self, stream, fields):
+        super(CustomWriter, self).__init__(stream)
+        self.header = fields
+
+    def row(self, card, count):
+        return [count if key == "count" else getattr(card, key) for key in self.header]
+
+
+class ArenaDeckWriter(object):
+    """MTG Arena deck import format, see MtgaDeckList.export_arena"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, deck_list):
+        self.stream.write(deck_list.export_arena() + '\n')
+
+
+def write_decks_repr(stream, deck_lists):
+    """Write deck lists as str() of a dict of decks by name, one deck at a time"""
+    decks = dict((deck_list.name, deck_list) for deck_list in deck_lists)
+    stream.write('{')
+    for i, (name, deck_list) in enumerate(decks.items()):
+        if i:
+            stream.write(', ')
+        stream.write('%r: %r' % (name, deck_list.deck()))
+    stream.write('}\n')
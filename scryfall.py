@@ -2,14 +2,33 @@
 
 """Scryfall to python-mtga Card"""
 
-import requests
-import argparse
 import json
+import logging
+import threading
+import time
+import mtga_cache
+import mtga_stats
 
 
 SCRYFALL_CARDS_API = "https://api.scryfall.com/cards"
 SCRYFALL_SETS_API = "https://api.scryfall.com/sets"
 
+SCRYFALL_COLLECTION_BATCH_SIZE = 75
+SCRYFALL_RATE_LIMIT = 10
+SCRYFALL_RETRIES = 3
+SCRYFALL_BACKOFF = 0.5
+SCRYFALL_TIMEOUT = 30
+SCRYFALL_POOL_SIZE = 16
+SCRYFALL_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+SCRYFALL_OK = 200
+SCRYFALL_NOT_FOUND = 404
+
+SCRYFALL_CACHE_FILENAME = "scryfall_cache.sqlite"
+SCRYFALL_CACHE_TTL = 30 * 24 * 3600
+SCRYFALL_CACHE_NEGATIVE_TTL = 24 * 3600
+SCRYFALL_CACHE_MAX_ENTRIES = 50000
+SCRYFALL_SET_CACHE_TTL = 7 * 24 * 3600
+
 SCRYFALL_SET_CONVERSION = {
     'G18' : 'M19'
 }
@@ -22,6 +41,269 @@ class ScryfallError(ValueError):
     pass
 
 
+class RateLimiter(object):
+    """Thread-safe token bucket allowing rate requests per second"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(rate if capacity is None else capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ScryfallClient(object):
+    """HTTP client for the Scryfall API
+
+    Keeps connections alive in a pooled requests.Session, limits the
+    request rate and retries with exponential backoff on 429 and 5xx.
+    """
+
+    def __init__(self, rate=SCRYFALL_RATE_LIMIT, retries=SCRYFALL_RETRIES,
+                 backoff=SCRYFALL_BACKOFF, timeout=SCRYFALL_TIMEOUT, pool_size=SCRYFALL_POOL_SIZE):
+        import requests
+        import requests.adapters
+
+        self.rate_limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'User-Agent': 'mtga-utils', 'Accept': 'application/json'})
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.retry_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying when Scryfall is busy
+        Returns: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            start = time.monotonic()
+            response = self.session.request(method, url, **kwargs)
+            self._record_latency(time.monotonic() - start)
+
+            if response.status_code not in SCRYFALL_RETRY_STATUS_CODES or attempt >= self.retries:
+                return response
+
+            delay = self.backoff * 2 ** attempt
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logging.debug('Scryfall returned %s for %s, retrying in %.1fs' % (response.status_code, url, delay))
+            with self._lock:
+                self.retry_count += 1
+            mtga_stats.count('scryfall.retries')
+            attempt += 1
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _record_latency(self, latency):
+        with self._lock:
+            self.request_count += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        mtga_stats.add_time('scryfall.request', latency)
+
+    def stats(self):
+        """Request counters and latencies in seconds"""
+        with self._lock:
+            return {
+                'requests': self.request_count,
+                'retries': self.retry_count,
+                'total_latency': self.total_latency,
+                'average_latency': self.total_latency / self.request_count if self.request_count else 0.0,
+                'max_latency': self.max_latency
+            }
+
+
+class ScryfallCache(object):
+    """SQLite cache of Scryfall card json by arena id
+
+    Unknown cards are cached as well (negative lookups), with a shorter TTL.
+    When max_entries is exceeded the least recently used entries are evicted.
+    """
+
+    def __init__(self, filename=None, ttl=SCRYFALL_CACHE_TTL,
+                 negative_ttl=SCRYFALL_CACHE_NEGATIVE_TTL, max_entries=SCRYFALL_CACHE_MAX_ENTRIES,
+                 set_ttl=SCRYFALL_SET_CACHE_TTL):
+        import sqlite3
+
+        self.filename = mtga_cache.get_cache_file_path(SCRYFALL_CACHE_FILENAME) if filename is None else filename
+        self.ttl = ttl
+        self.set_ttl = set_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cards ("
+            "arena_id INTEGER PRIMARY KEY, payload TEXT, fetched REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cards_accessed ON cards (accessed)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sets (code TEXT PRIMARY KEY, payload TEXT NOT NULL, fetched REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, arena_id):
+        """Get cached card json
+        Returns: (found, payload) tuple, payload is None for unknown cards
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT payload, fetched FROM cards WHERE arena_id = ?", (int(arena_id),)
+            ).fetchone()
+            if row is None:
+                return False, None
+            payload, fetched = row
+            ttl = self.negative_ttl if payload is None else self.ttl
+            if now - fetched > ttl:
+                return False, None
+            self._db.execute("UPDATE cards SET accessed = ? WHERE arena_id = ?", (now, int(arena_id)))
+            self._db.commit()
+        return True, None if payload is None else json.loads(payload)
+
+    def get_many(self, arena_ids):
+        """Get cached card json for many arena ids with one query per 500 ids
+        Returns: (fresh, stale) tuple of dicts by arena id. fresh holds
+            payloads (None for unknown cards), stale holds expired payloads
+        """
+        now = time.time()
+        by_id = dict((int(arena_id), arena_id) for arena_id in arena_ids)
+        fresh, stale = {}, {}
+        ids = list(by_id)
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self._db.execute(
+                    "SELECT arena_id, payload, fetched FROM cards WHERE arena_id IN (%s)" % ','.join('?' * len(chunk)),
+                    chunk
+                ).fetchall()
+                for arena_id, payload, fetched in rows:
+                    ttl = self.negative_ttl if payload is None else self.ttl
+                    if now - fetched <= ttl:
+                        fresh[by_id[arena_id]] = None if payload is None else json.loads(payload)
+                    elif payload is not None:
+                        stale[by_id[arena_id]] = json.loads(payload)
+            self._db.executemany(
+                "UPDATE cards SET accessed = ? WHERE arena_id = ?", [(now, int(k)) for k in fresh]
+            )
+            self._db.commit()
+        return fresh, stale
+
+    def put(self, arena_id, payload):
+        """Store card json, None marks the card as unknown"""
+        now = time.time()
+        payload = None if payload is None else json.dumps(payload)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cards (arena_id, payload, fetched, accessed) VALUES (?, ?, ?, ?)",
+                (int(arena_id), payload, now, now)
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM cards").fetchone()
+        if count > self.max_entries:
+            self._db.execute(
+                "DELETE FROM cards WHERE arena_id IN (SELECT arena_id FROM cards ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def get_sets(self, set_codes):
+        """Get cached set json, an empty dict marks an unknown set
+        Returns: dict of set json by set code (lower case)
+        """
+        codes = [code.lower() for code in set_codes]
+        oldest = time.time() - self.set_ttl
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT code, payload FROM sets WHERE fetched >= ? AND code IN (%s)" % ','.join('?' * len(codes)),
+                [oldest] + codes
+            ).fetchall()
+        return dict((code, json.loads(payload)) for code, payload in rows)
+
+    def put_sets(self, sets):
+        """Store set json by set code"""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO sets (code, payload, fetched) VALUES (?, ?, ?)",
+                [(code.lower(), json.dumps(payload), now) for code, payload in sets.items()]
+            )
+            self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+_cache = None
+_use_cache = True
+_client = None
+
+
+def set_client(client):
+    """Set the client used for all Scryfall requests"""
+    global _client
+    _client = client
+
+
+def get_client():
+    """Get the shared Scryfall client, created on first use"""
+    global _client
+    if _client is None:
+        _client = ScryfallClient()
+    return _client
+
+
+def set_cache(cache):
+    """Set the card cache, None disables caching"""
+    global _cache, _use_cache
+    _cache = cache
+    _use_cache = cache is not None
+
+
+def get_cache():
+    """Get the card cache, opened on first use"""
+    global _cache
+    if _use_cache and _cache is None:
+        _cache = ScryfallCache()
+    return _cache
+
+
 def get_mtga_card(arena_id):
     scryfall_card = get_arena_card_json(arena_id)
     return scryfall_to_mtga(scryfall_card)
@@ -29,14 +311,118 @@ def get_mtga_card(arena_id):
 
 def get_arena_card_json(arena_id):
     """Get card from Scryfall by arena id"""
-    response = requests.get(SCRYFALL_CARDS_API+'/arena/'+str(arena_id))
-    if response.status_code != requests.codes.ok:
+    cache = get_cache()
+    if cache is not None:
+        found, payload = cache.get(arena_id)
+        mtga_stats.count('scryfall.cache_hits' if found else 'scryfall.cache_misses')
+        if found and payload is None:
+            raise ScryfallError('Unknown card id %s (cached)' % arena_id)
+        if found:
+            return payload
+
+    response = get_client().get(SCRYFALL_CARDS_API+'/arena/'+str(arena_id))
+    if response.status_code != SCRYFALL_OK:
+        if cache is not None and response.status_code == SCRYFALL_NOT_FOUND:
+            cache.put(arena_id, None)
         raise ScryfallError('Unknown card id %s. Status code: %s' % (arena_id, response.status_code))
-    return response.json()
+    payload = response.json()
+    if cache is not None:
+        cache.put(arena_id, payload)
+    return payload
+
+
+def get_cards_collection_json(identifiers):
+    """Get many cards from Scryfall with POST /cards/collection
+
+    Identifiers are sent in batches of SCRYFALL_COLLECTION_BATCH_SIZE.
+    Note that the endpoint does not accept arena ids, only Scryfall ids,
+    names, set and collector numbers etc.
+    Returns: (cards, not_found) tuple of lists
+    """
+    cards, not_found = [], []
+    for i in range(0, len(identifiers), SCRYFALL_COLLECTION_BATCH_SIZE):
+        batch = identifiers[i:i + SCRYFALL_COLLECTION_BATCH_SIZE]
+        response = get_client().post(SCRYFALL_CARDS_API+'/collection', json={'identifiers': batch})
+        if response.status_code != SCRYFALL_OK:
+            raise ScryfallError('Could not fetch card collection. Status code: %s' % response.status_code)
+        result = response.json()
+        cards.extend(result.get('data', []))
+        not_found.extend(result.get('not_found', []))
+    return cards, not_found
+
+
+def get_arena_cards_json(arena_ids, workers=1):
+    """Get many cards by arena id
+
+    Fresh cached cards are served with one cache query, expired cached
+    cards are refreshed in batches through /cards/collection using their
+    Scryfall id, only cards never seen before are fetched one by one,
+    by up to workers threads sharing the client's rate limit.
+    Returns: dict of card json or ScryfallError by arena id
+    """
+    import requests
+
+    arena_ids = list(dict.fromkeys(arena_ids))
+    cache = get_cache()
+    results, stale = {}, {}
+    if cache is not None:
+        fresh, stale = cache.get_many(arena_ids)
+        mtga_stats.count('scryfall.cache_hits', len(fresh))
+        mtga_stats.count('scryfall.cache_stale', len(stale))
+        for arena_id, payload in fresh.items():
+            if payload is None:
+                results[arena_id] = ScryfallError('Unknown card id %s (cached)' % arena_id)
+            else:
+                results[arena_id] = payload
+
+    if stale:
+        by_arena_id = dict((int(arena_id), arena_id) for arena_id in stale)
+        try:
+            cards, _ = get_cards_collection_json([{'id': payload['id']} for payload in stale.values()])
+        except (ScryfallError, requests.RequestException) as error:
+            logging.debug('Could not refresh cached cards: %s' % error)
+            cards = []
+        for payload in cards:
+            arena_id = by_arena_id.get(payload.get('arena_id'))
+            if arena_id is not None:
+                cache.put(arena_id, payload)
+                results[arena_id] = payload
+
+    missing = [arena_id for arena_id in arena_ids if arena_id not in results]
+    if workers > 1 and len(missing) > 1:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results.update(zip(missing, executor.map(_get_arena_card_json_or_error, missing)))
+    else:
+        results.update((arena_id, _get_arena_card_json_or_error(arena_id)) for arena_id in missing)
+    return results
+
+
+def _get_arena_card_json_or_error(arena_id):
+    try:
+        return get_arena_card_json(arena_id)
+    except Exception as error:
+        return ScryfallError(error)
+
+
+def get_mtga_cards(arena_ids, workers=1):
+    """Get many cards by arena id as python-mtga Cards
+    Returns: dict of Card or ScryfallError by arena id
+    """
+    cards = {}
+    for arena_id, payload in get_arena_cards_json(arena_ids, workers).items():
+        if isinstance(payload, ScryfallError):
+            cards[arena_id] = payload
+            continue
+        try:
+            cards[arena_id] = scryfall_to_mtga(payload)
+        except Exception as error:
+            cards[arena_id] = ScryfallError(error)
+    return cards
 
 
 def scryfall_to_mtga(scryfall_card):
-    from mtga.models.card import Card
+    from mtga_card_index import Card
 
     name = scryfall_card['name'].lower().replace(' ', '_')
     pretty_name = scryfall_card['name']
@@ -62,13 +448,70 @@ def scryfall_to_mtga(scryfall_card):
 
 def get_set_info(set_name):
     """gets info on requested set"""
-    response = requests.get(SCRYFALL_SETS_API+'/'+str(set_name))
-    if response.status_code == requests.codes.not_found:
+    cache = get_cache()
+    if cache is not None:
+        cached = cache.get_sets([set_name]).get(set_name.lower())
+        mtga_stats.count('scryfall.set_cache_misses' if cached is None else 'scryfall.set_cache_hits')
+        if cached is not None:
+            return cached
+
+    response = get_client().get(SCRYFALL_SETS_API+'/'+str(set_name))
+    if response.status_code == SCRYFALL_NOT_FOUND:
         print('Unknown set: %s. Reason: %s %s' % (set_name, response.status_code, response.reason))
-        return {}
-    if response.status_code != requests.codes.ok:
-        raise ScryfallError('Unknown set: %s. Status code: %s' % (set, response.status_code))
-    return response.json()
+        set_info = {}
+    elif response.status_code != SCRYFALL_OK:
+        raise ScryfallError('Unknown set: %s. Status code: %s' % (set_name, response.status_code))
+    else:
+        set_info = response.json()
+
+    if cache is not None:
+        cache.put_sets({set_name: set_info})
+    return set_info
+
+
+def get_all_sets():
+    """Get info on all sets with GET /sets
+    Returns: dict of set json by set code (lower case)
+    """
+    sets = {}
+    url = SCRYFALL_SETS_API
+    while url:
+        response = get_client().get(url)
+        if response.status_code != SCRYFALL_OK:
+            raise ScryfallError('Could not fetch sets. Status code: %s' % response.status_code)
+        result = response.json()
+        for set_info in result.get('data', []):
+            sets[set_info['code'].lower()] = set_info
+        url = result.get('next_page') if result.get('has_more') else None
+    return sets
+
+
+def get_sets_info(set_names):
+    """Get info on many sets at once
+
+    Sets are served from the cache; if any is missing, all sets are
+    fetched with a single GET /sets and cached, sets unknown to Scryfall
+    are cached as empty dicts.
+    Returns: dict of set json by set name as given
+    """
+    set_names = list(dict.fromkeys(set_names))
+    cache = get_cache()
+    cached = {} if cache is None else cache.get_sets(set_names)
+    if mtga_stats.is_enabled():
+        hits = sum(1 for name in set_names if name.lower() in cached)
+        mtga_stats.count('scryfall.set_cache_hits', hits)
+        mtga_stats.count('scryfall.set_cache_misses', len(set_names) - hits)
+
+    if any(name.lower() not in cached for name in set_names):
+        all_sets = get_all_sets()
+        fetched = dict((name, all_sets.get(name.lower(), {})) for name in set_names)
+        if cache is not None:
+            cache.put_sets(all_sets)
+            cache.put_sets(dict((name, info) for name, info in fetched.items() if not info))
+        cached.update((name.lower(), info) for name, info in fetched.items())
+
+    return dict((name, cached[name.lower()]) for name in set_names)
+
 
 if __name__ == "__main__":
     x = get_arena_card_json(68369)
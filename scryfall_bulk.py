@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""Offline card database imported from Scryfall bulk data files
+
+Bulk data files (e.g. default-cards.json from https://scryfall.com/docs/api/bulk-data)
+are parsed one card at a time, so memory use does not depend on the
+size of the file. Only cards with an arena id are kept.
+"""
+
+import os
+import io
+import json
+import logging
+import threading
+import simplejson
+import mtga_cache
+import mtga_json
+import scryfall
+
+SCRYFALL_OFFLINE_DB_FILENAME = "scryfall_cards.sqlite"
+SCRYFALL_BULK_CHUNK_SIZE = 1024 * 1024
+SCRYFALL_BULK_BATCH_SIZE = 1000
+SCRYFALL_BULK_FIELDS = (
+    'id', 'arena_id', 'name', 'mana_cost', 'color_identity', 'type_line', 'set', 'rarity', 'collector_number'
+)
+_JSON_SEPARATORS = ' \t\r\n,'
+
+
+def iter_json_array(stream, chunk_size=SCRYFALL_BULK_CHUNK_SIZE):
+    """Generator of the values of a json array, read from a text stream chunk by chunk
+
+    Only the current chunk and the value being parsed are kept in memory.
+    """
+    decoder = simplejson.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = False
+    while True:
+        while pos < len(buf) and buf[pos] in _JSON_SEPARATORS:
+            pos += 1
+        if pos < len(buf):
+            if not in_array:
+                if buf[pos] != '[':
+                    raise ValueError('Expected json array at %d' % pos)
+                in_array = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] in '{[':
+                complete = eof or mtga_json.find_value_end(buf, pos) is not None
+            else:
+                # Scalars are short, a number may continue in the next chunk
+                complete = eof or buf.find(',', pos) != -1 or buf.find(']', pos) != -1
+            if complete:
+                value, pos = decoder.raw_decode(buf, pos)
+                yield value
+                continue
+        elif eof:
+            raise ValueError('Unterminated json array')
+
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def open_bulk_file(filename):
+    """Open bulk data file as text, gzip compressed files are decompressed on the fly"""
+    if filename.lower().endswith('.gz'):
+        import gzip
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return io.open(filename, encoding='utf-8')
+
+
+def trim_card_json(scryfall_card):
+    """Keep only the fields scryfall_to_mtga needs
+
+    Double-faced cards have no mana cost of their own, the cost of the
+    front face is used.
+    """
+    card = dict((key, scryfall_card[key]) for key in SCRYFALL_BULK_FIELDS if key in scryfall_card)
+    faces = scryfall_card.get('card_faces') or [{}]
+    for key in ('mana_cost', 'type_line'):
+        if key not in card and key in faces[0]:
+            card[key] = faces[0][key]
+    return card
+
+
+class ScryfallOfflineDb(object):
+    """SQLite database of Scryfall card json by arena id"""
+
+    def __init__(self, filename=None):
+        import sqlite3
+
+        self.filename = mtga_cache.get_cache_file_path(SCRYFALL_OFFLINE_DB_FILENAME) if filename is None else filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS cards (arena_id INTEGER PRIMARY KEY, payload TEXT NOT NULL)")
+        self._db.commit()
+
+    def import_bulk_file(self, filename):
+        """Import all cards with an arena id from a Scryfall bulk data file
+
+        Cards which can not be converted by scryfall_to_mtga are skipped.
+        Returns: (imported, skipped) tuple of card counts
+        """
+        imported, skipped = 0, 0
+        rows = []
+        with open_bulk_file(filename) as stream:
+            for scryfall_card in iter_json_array(stream):
+                if not isinstance(scryfall_card, dict) or not scryfall_card.get('arena_id'):
+                    continue
+                card = trim_card_json(scryfall_card)
+                try:
+                    scryfall.scryfall_to_mtga(card)
+                except Exception as error:
+                    logging.debug('Skipping %s: %s' % (card.get('name'), error))
+                    skipped += 1
+                    continue
+                rows.append((int(card['arena_id']), json.dumps(card)))
+                if len(rows) >= SCRYFALL_BULK_BATCH_SIZE:
+                    imported += self._put_many(rows)
+                    rows = []
+        imported += self._put_many(rows)
+        return imported, skipped
+
+    def _put_many(self, rows):
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO cards (arena_id, payload) VALUES (?, ?)", rows)
+            self._db.commit()
+        return len(rows)
+
+    def get_many(self, arena_ids):
+        """Get cards by arena id, one query per 500 ids
+        Returns: dict of python-mtga Card by arena id, only for cards found
+        """
+        by_id = dict((int(arena_id), arena_id) for arena_id in arena_ids)
+        ids = list(by_id)
+        cards = {}
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self._db.execute(
+                    "SELECT arena_id, payload FROM cards WHERE arena_id IN (%s)" % ','.join('?' * len(chunk)), chunk
+                ).fetchall()
+                for arena_id, payload in rows:
+                    cards[by_id[arena_id]] = scryfall.scryfall_to_mtga(json.loads(payload))
+        return cards
+
+    def get(self, arena_id):
+        """Get card by arena id
+        Returns: python-mtga Card or None
+        """
+        return self.get_many([arena_id]).get(arena_id)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+_offline_db = None
+_offline_db_checked = False
+
+
+def set_offline_db(offline_db):
+    """Set the offline card database, None disables it"""
+    global _offline_db, _offline_db_checked
+    _offline_db = offline_db
+    _offline_db_checked = True
+
+
+def get_offline_db():
+    """Get the offline card database, None when no bulk file has been imported"""
+    global _offline_db, _offline_db_checked
+    if not _offline_db_checked:
+        _offline_db_checked = True
+        filename = mtga_cache.get_cache_file_path(SCRYFALL_OFFLINE_DB_FILENAME)
+        if os.path.isfile(filename):
+            _offline_db = ScryfallOfflineDb(filename)
+    return _offline_db
@@ -0,0 +1,130 @@
+"""Local stand-in for the Scryfall API used by the tests and benchmarks"""
+
+import json
+import threading
+import time
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+def set_json(code, card_count):
+    """Minimal Scryfall set json"""
+    return {"object": "set", "code": code.lower(), "name": "Set %s" % code, "card_count": card_count}
+
+
+def card_json(arena_id, name=None, set_id="tst", collector_number=None):
+    """Minimal Scryfall card json"""
+    return {
+        "object": "card",
+        "id": "00000000-0000-0000-0000-%012d" % int(arena_id),
+        "arena_id": int(arena_id),
+        "name": name or "Test Card %s" % arena_id,
+        "mana_cost": "{1}{W}",
+        "color_identity": ["W"],
+        "type_line": u"Creature — Test",
+        "set": set_id,
+        "rarity": "common",
+        "collector_number": collector_number or str(arena_id % 1000),
+    }
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeScryfallServer(object):
+    """Serves /cards/arena/<id>, /cards/collection and /sets from dicts
+
+    Attributes:
+        cards (dict): Scryfall card json by arena id
+        sets (dict): Scryfall set json by set code
+        requests (list): Paths of all requests received
+        latency (float): Seconds to wait before answering
+        fail_next (list): Status codes to answer the next requests with
+    """
+
+    def __init__(self, cards=None, latency=0.0, sets=None):
+        self.cards = dict((int(k), v) for k, v in (cards or {}).items())
+        self.sets = dict((k.lower(), v) for k, v in (sets or {}).items())
+        self.requests = []
+        self.latency = latency
+        self.fail_next = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                time.sleep(server.latency)
+                status, body = server.handle_get(self.path)
+                if server.fail_next:
+                    status, body = server.fail_next.pop(0), {"object": "error"}
+                self.send_json(status, body)
+
+            def do_POST(self):
+                server.requests.append(self.path)
+                time.sleep(server.latency)
+                length = int(self.headers.get('Content-Length', 0))
+                status, body = server.handle_post(self.path, json.loads(self.rfile.read(length).decode('utf-8')))
+                if server.fail_next:
+                    status, body = server.fail_next.pop(0), {"object": "error"}
+                self.send_json(status, body)
+
+            def send_json(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.handler_class = Handler
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def handle_get(self, path):
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[:2] == ['cards', 'arena'] and parts[2].isdigit():
+            card = self.cards.get(int(parts[2]))
+            if card is not None:
+                return 200, card
+        if parts == ['sets']:
+            return 200, {"object": "list", "has_more": False, "data": list(self.sets.values())}
+        if len(parts) == 2 and parts[0] == 'sets' and parts[1].lower() in self.sets:
+            return 200, self.sets[parts[1].lower()]
+        return 404, {"object": "error", "status": 404}
+
+    def handle_post(self, path, body):
+        if path.strip('/') != 'cards/collection':
+            return 404, {"object": "error", "status": 404}
+        identifiers = body.get('identifiers', [])
+        if len(identifiers) > 75:
+            return 422, {"object": "error", "status": 422}
+        by_id = dict((card['id'], card) for card in self.cards.values())
+        data, not_found = [], []
+        for identifier in identifiers:
+            card = by_id.get(identifier.get('id'))
+            if card is None:
+                not_found.append(identifier)
+            else:
+                data.append(card)
+        return 200, {"object": "list", "not_found": not_found, "data": data}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
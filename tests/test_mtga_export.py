@@ -5,16 +5,64 @@ import os
 import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import unittest
+import tempfile
+import shutil
+import io
+import gzip
+import bz2
+import lzma
+import time
+import socket
+import threading
+import urllib.request
+import contextlib
+import importlib.util
+from unittest import mock
+os.environ.setdefault('MTGA_UTILS_CACHE_DIR', tempfile.mkdtemp())
 from parameterized import parameterized
 import scryfall
+import scryfall_bulk
 from mtga_log import *
+from fake_scryfall import FakeScryfallServer, card_json, set_json
+from mtga_formats import MtgaFormats
+import mtga_batch
+from mtga_batch import find_log_files, log_names, run_batch, summarize_log, combine_summaries
+from mtga_snapshots import MtgaSnapshotStore, parse_date
+from mtga_diff import MtgaCollectionDiff, count_deltas, log_counts, snapshot_counts
+from mtga_writers import CollectionWriter, GoldfishWriter, DeckstatsWriter, CustomWriter, ArenaDeckWriter, write_decks_repr
+import mtga_stats
+import mtga_card_index
+import mtga_cache
+import mtga_json
+from mtga_server import MtgaQueries, MtgaServer, parse_address
 
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
-class Test_MtgaLog(unittest.TestCase):
+def load_mtga_export():
+    """Import mtga-export.py as a module"""
+    spec = importlib.util.spec_from_file_location('mtga_export', os.path.join(ROOT, 'mtga-export.py'))
+    module = importlib.util.module_from_spec(spec)
+    # Batch workers are pickled by module name
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class MtgaTestCase(unittest.TestCase):
+    """Base test case with the test log and a temp dir removed after each test"""
+
+    MTGA_LOG = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_mtga_output_log.txt')
 
     def setUp(self):
-        self.MTGA_LOG =  os.path.join( os.path.dirname(os.path.realpath(__file__)), 'test_mtga_output_log.txt')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+
+class Test_MtgaLog(MtgaTestCase):
+
+    def setUp(self):
+        super(Test_MtgaLog, self).setUp()
         self.mlog = MtgaLog(self.MTGA_LOG)
 
     def test_get_last_json_block(self):
@@ -66,6 +114,21 @@ class Test_MtgaLog(unittest.TestCase):
         result = self.mlog.get_last_json_block('<== PlayerInventory.GetPlayerCardsV3')
         self.assertEqual(result.get(mtga_id), expected_count)
 
+    def test_get_last_json_block_brackets_in_strings(self):
+        result = self.mlog.get_last_json_block('<== BracketDeck')
+        self.assertEqual(result.get('payload')[0].get('name'), 'Deck [WIP] {v2}}')
+
+    @parameterized.expand([
+        [b'{"name": "a}", "list": [1, 2, 3]} trailing', 33],
+        [b'<== X {"name": "Mono {R"}\n', 25],
+        [b'[{"name": "\\"[", "x": "\\\\"}]', 28],
+        [b'{"name": "Mono {R"', None],
+        [b'{"name": "a", "list": [1', None],
+    ])
+    def test_find_value_end(self, data, expected):
+        self.assertEqual(mtga_json.find_value_end(data), expected)
+        self.assertEqual(mtga_json.find_value_end(data.decode('utf-8')), expected)
+
     def test_get_last_json_block_invalid(self):
         with self.assertRaises(MtgaLogParsingError):
             result = self.mlog.get_last_json_block('invalid')
@@ -96,6 +159,12 @@ class Test_MtgaLog(unittest.TestCase):
                     mtga_id, card, count = next(collection)
                     self.assertIsInstance(card, scryfall.ScryfallError)
 
+    def test_find_one_mtga_card(self):
+        self.assertIs(find_one_mtga_card("67682"), get_card_index()[67682])
+        self.assertEqual(find_one_mtga_card(67682).pretty_name, "Aegis of the Heavens")
+        with self.assertRaises(ValueError):
+            find_one_mtga_card("123")
+
     def test_inventory(self):
         inventory = self.mlog.get_inventory()
 
@@ -135,6 +204,32 @@ class Test_MtgaLog(unittest.TestCase):
         self.assertEqual(kethis_deck.deckbox_image.pretty_name, 'Fblthp, the Lost')
         self.assertEqual(kethis_deck.deck_id, '72ea9e67-1091-4e1c-81c2-3f2327378984')
 
+    def test_deck_list_reusable(self):
+        kethis_deck = self.mlog.get_deck_lists()[0]
+        self.assertEqual(len(kethis_deck.deck()['maindeck']), 2)
+        export = kethis_deck.export_arena()
+        self.assertIn("4 Kethis, the Hidden Hand (M20) 211", export)
+        self.assertIn("1 Lazav, the Multifarious (GRN) 184", export)
+
+    def test_deck_lists_shared_lookup(self):
+        looked_up = []
+        lookup_cards = self.mlog.lookup_cards
+
+        def counting_lookup_cards(pairs):
+            pairs = list(pairs)
+            looked_up.extend(mtga_id for mtga_id, count in pairs)
+            return lookup_cards(pairs)
+        self.mlog.lookup_cards = counting_lookup_cards
+
+        card_lookup = MtgaCardLookup(self.mlog)
+        deck_lists = self.mlog.get_deck_lists(card_lookup) + self.mlog.get_preconstructed_deck_lists(card_lookup)
+        self.assertEqual(looked_up, [])
+        for deck_list in deck_lists + deck_lists:
+            deck_list.deck()
+            deck_list.deckbox_image
+        self.assertEqual(sorted(looked_up), sorted(set(looked_up)))
+        self.assertIn(69302, looked_up)
+
     def test_preconstructed_deck_lists(self):
         precon_deck_lists = self.mlog.get_preconstructed_deck_lists()
 
@@ -143,7 +238,694 @@ class Test_MtgaLog(unittest.TestCase):
         self.assertEqual(simic_flash.name, 'Simic Flash')
         self.assertEqual(simic_flash.deck_id, '3b71e463-7a19-4a62-8695-855e024e645f')
 
-class Test_Scryfall(unittest.TestCase):
+class Test_MtgaLogIndex(MtgaTestCase):
+    """Test the single-pass keyword index"""
+
+    def setUp(self):
+        super(Test_MtgaLogIndex, self).setUp()
+        self.mlog = MtgaLog(self.MTGA_LOG)
+
+    @parameterized.expand([
+        ['<== PlayerInventory.GetPlayerCardsV3'],
+        ['<== PlayerInventory.GetPlayerInventory'],
+        ['<== Deck.GetDeckListsV3'],
+        ['<== KeywordOne'],
+        ['<== TestKey'],
+        ['<== TestArray'],
+        ['<== NewArrayFormat'],
+    ])
+    def test_index_matches_scan(self, keyword):
+        scanned = MtgaLog(self.MTGA_LOG, use_index=False).get_last_json_block(keyword)
+        self.assertEqual(self.mlog.get_last_json_block(keyword), scanned)
+
+    def test_index_built_once(self):
+        self.mlog.get_collection()
+        index = self.mlog._keyword_index
+        self.mlog.get_inventory()
+        self.mlog.get_deck_lists()
+        self.assertIs(self.mlog._keyword_index, index)
+
+    def test_index_prefix_keyword(self):
+        index = self.mlog.build_keyword_index()
+        self.assertIn('PlayerInventory', index)
+        self.assertNotIn('_NOT_PRESENT_', index)
+        scanned = MtgaLog(self.MTGA_LOG, use_index=False).get_last_keyword_block('<== PlayerInventory')
+        self.assertEqual(self.mlog.get_last_keyword_block('<== PlayerInventory'), scanned)
+
+
+class Test_MtgaLogReverse(MtgaTestCase):
+    """Test the tail-first keyword search"""
+
+    def setUp(self):
+        super(Test_MtgaLogReverse, self).setUp()
+        self.mlog = MtgaLog(self.MTGA_LOG, use_index=False, reverse_scan=True)
+
+    @parameterized.expand([
+        ['<== PlayerInventory.GetPlayerCardsV3'],
+        ['<== Deck.GetDeckListsV3'],
+        ['<== KeywordOne'],
+        ['<== TestKey'],
+        ['<== TestArray'],
+        ['blah'],
+    ])
+    def test_reverse_matches_forward(self, keyword):
+        forward = self.mlog.get_last_keyword_block(keyword, reverse=False)
+        self.assertEqual(self.mlog.get_last_keyword_block(keyword), forward)
+
+    def test_reverse_fallback_to_forward(self):
+        self.mlog.tail_limit = 128
+        with self.mlog._open_buffer() as buf:
+            self.assertIsNone(self.mlog._rfind_keyword_line(buf, '<== Deck.GetDeckListsV3'))
+        result = self.mlog.get_last_json_block('<== Deck.GetDeckListsV3')
+        self.assertEqual(result.get('payload')[0].get('name'), 'Kethis Combo')
+
+    def test_reverse_notpresent(self):
+        with self.assertRaises(MtgaLogParsingError):
+            self.mlog.get_last_json_block('_NOT_PRESENT_')
+
+
+class Test_MtgaLogCompressed(MtgaTestCase):
+    """Test streaming compressed logs and the previous log fallback"""
+
+    def setUp(self):
+        super(Test_MtgaLogCompressed, self).setUp()
+        self.mlog = MtgaLog(self.MTGA_LOG)
+
+    def compress(self, filename, opener, data=None):
+        if data is None:
+            with open(self.MTGA_LOG, 'rb') as logfile:
+                data = logfile.read()
+        filename = os.path.join(self.tmp_dir, filename)
+        with opener(filename, 'wb') as compressed:
+            compressed.write(data)
+        return filename
+
+    @parameterized.expand([
+        ['Player.log.gz', gzip.open],
+        ['Player.log.bz2', bz2.open],
+        ['Player.log.xz', lzma.open],
+    ])
+    def test_compressed_matches_plain(self, filename, opener):
+        mlog = MtgaLog(self.compress(filename, opener))
+        self.assertTrue(mlog.compressed)
+        self.assertEqual(mlog.detailed_logs(), self.mlog.detailed_logs())
+        for keyword in MTGA_WATCHED_KEYWORDS + ('BracketDeck',):
+            self.assertEqual(mlog.get_payload(keyword), self.mlog.get_payload(keyword))
+        for keyword in ['<== Deck', '<== KeywordOne', '<== TestArray', 'blah', '_NOT_PRESENT_']:
+            self.assertEqual(mlog.get_last_keyword_block(keyword), self.mlog.get_last_keyword_block(keyword))
+        with self.assertRaises(MtgaLogParsingError):
+            mlog.get_last_json_block('_NOT_PRESENT_')
+
+    def test_compressed_brace_in_string(self):
+        filename = os.path.join(self.tmp_dir, 'Player.log.gz')
+        with gzip.open(filename, 'wt') as logfile:
+            logfile.write('<== Deck.GetDeckListsV3 {"payload": [{"name": "Mono {R"}]}\nnoise\n')
+            logfile.write('<== Deck.GetDeckListsV3 {"payload": [{"name": "Mono {R"}, {"name": "New"}]}\n')
+        mlog = MtgaLog(filename)
+        names = [deck['name'] for deck in mlog.get_payload(MTGA_DECK_LISTS_KEYWORD)]
+        self.assertEqual(names, ['Mono {R', 'New'])
+
+    @parameterized.expand([[1], [7], [100]])
+    def test_stream_chunks(self, chunk_size):
+        with open(self.MTGA_LOG, 'rb') as logfile:
+            blocks = self.mlog._stream_last_blocks(logfile, MTGA_METHOD_PATTERN, lambda match: [
+                (keyword, '<== ' + keyword) for keyword in [match.group(1).decode('utf-8')]
+            ], chunk_size)
+        with self.mlog._open_buffer() as buf:
+            for keyword, (offset, length) in iteritems(self.mlog.build_keyword_index()):
+                if '.' in keyword or keyword in blocks:
+                    self.assertEqual(blocks[keyword], buf[offset:offset + length])
+
+    def test_previous_log(self):
+        log_filename = os.path.join(self.tmp_dir, 'Player.log')
+        with open(log_filename, 'w') as logfile:
+            logfile.write('<== PlayerInventory.GetPlayerInventory {"payload": {"gems": 7}}\n')
+        self.compress('Player-prev.log.gz', gzip.open)
+        self.assertEqual(get_previous_log_filename(log_filename), os.path.join(self.tmp_dir, 'Player-prev.log.gz'))
+
+        mlog = MtgaLog(log_filename)
+        with self.assertRaises(MtgaLogParsingError):
+            mlog.get_payload(MTGA_DECK_LISTS_KEYWORD)
+
+        mlog = MtgaLog(log_filename, search_previous=True)
+        self.assertEqual(mlog.get_payload(MTGA_INVENTORY_KEYWORD), {"gems": 7})
+        self.assertEqual(mlog.get_payload(MTGA_DECK_LISTS_KEYWORD), self.mlog.get_payload(MTGA_DECK_LISTS_KEYWORD))
+        with self.assertRaises(MtgaLogParsingError):
+            mlog.get_payload('_NOT_PRESENT_')
+
+
+class Test_MtgaLogRefresh(MtgaTestCase):
+    """Test incremental indexing of a growing log"""
+
+    def setUp(self):
+        super(Test_MtgaLogRefresh, self).setUp()
+        self.log_filename = os.path.join(self.tmp_dir, 'Player.log')
+        self.write('noise\n<== Test.Block {"value": 1}\n')
+        self.mlog = MtgaLog(self.log_filename)
+
+    def write(self, text, mode='a'):
+        with open(self.log_filename, mode) as logfile:
+            logfile.write(text)
+
+    def test_refresh_appended_block(self):
+        self.assertEqual(self.mlog.get_last_json_block('<== Test.Block'), {'value': 1})
+        self.assertEqual(self.mlog.refresh(), set())
+
+        self.write('noise\n<== Test.Block {"value": 2}\n')
+        self.assertEqual(self.mlog.refresh(), {'Test', 'Test.Block'})
+        self.assertEqual(self.mlog.get_last_json_block('<== Test.Block'), {'value': 2})
+
+    def test_refresh_partial_block(self):
+        self.mlog.refresh()
+        self.write('<== Test.Block\n{\n  "value":')
+        self.assertEqual(self.mlog.refresh(), set())
+
+        self.write(' 3\n}\n')
+        self.assertEqual(self.mlog.refresh(), {'Test', 'Test.Block'})
+        self.assertEqual(self.mlog.get_last_json_block('<== Test.Block'), {'value': 3})
+
+    def test_refresh_brace_in_string(self):
+        self.mlog.refresh()
+        self.write('<== Test.Block {"name": "Mono {R"}\nnoise\n')
+        self.assertEqual(self.mlog.refresh(), {'Test', 'Test.Block'})
+        self.assertEqual(self.mlog._indexed_size, os.path.getsize(self.log_filename))
+
+        self.write('<== Test.Block {"name": "New"}\n')
+        self.assertEqual(self.mlog.refresh(), {'Test', 'Test.Block'})
+        self.assertEqual(self.mlog.get_last_json_block('<== Test.Block'), {'name': 'New'})
+
+    def test_refresh_truncated_log(self):
+        self.mlog.refresh()
+        self.write('<== Other.Block {"value": 4}\n', mode='w')
+        self.assertEqual(self.mlog.refresh(), {'Other', 'Other.Block', 'Test', 'Test.Block'})
+        self.assertEqual(self.mlog.rotations, 1)
+        self.assertNotIn('Test.Block', self.mlog._keyword_index)
+        self.assertEqual(self.mlog.get_last_json_block('<== Other.Block'), {'value': 4})
+
+
+class Test_MtgaLogCheckpoint(MtgaTestCase):
+    """Test the persistent keyword index checkpoint"""
+
+    def setUp(self):
+        super(Test_MtgaLogCheckpoint, self).setUp()
+        self.log_filename = os.path.join(self.tmp_dir, 'Player.log')
+        self.write('header\n<== Test.Block {"value": 1}\n')
+        self.checkpoint = MtgaLogCheckpoint(os.path.join(self.tmp_dir, 'checkpoint.json'))
+        MtgaLog(self.log_filename, checkpoint=self.checkpoint).build_keyword_index()
+
+    def write(self, text, mode='a'):
+        with open(self.log_filename, mode) as logfile:
+            logfile.write(text)
+
+    def indexed_regions(self, mlog):
+        regions = []
+        index_region = mlog._index_region
+
+        def record(buf, start):
+            regions.append((start, len(buf)))
+            return index_region(buf, start)
+        mlog._index_region = record
+        return regions
+
+    def test_checkpoint_scans_appended_bytes(self):
+        size = os.path.getsize(self.log_filename)
+        self.write('<== Test.Block {"value": 2}\n')
+
+        mlog = MtgaLog(self.log_filename, checkpoint=self.checkpoint)
+        regions = self.indexed_regions(mlog)
+        self.assertEqual(mlog.get_last_json_block('<== Test.Block'), {'value': 2})
+        self.assertEqual(regions, [(size, os.path.getsize(self.log_filename))])
+
+    def test_checkpoint_invalidated_on_rotation(self):
+        self.write('new header\n<== Test.Block {"value": 3}\n', mode='w')
+
+        mlog = MtgaLog(self.log_filename, checkpoint=self.checkpoint)
+        regions = self.indexed_regions(mlog)
+        self.assertEqual(mlog.get_last_json_block('<== Test.Block'), {'value': 3})
+        self.assertEqual(regions[0][0], 0)
+
+
+class Test_MtgaSession(MtgaTestCase):
+    """Test the parse-once session"""
+
+    def setUp(self):
+        super(Test_MtgaSession, self).setUp()
+        self.mlog = MtgaLog(self.MTGA_LOG)
+        self.mlog.scryfall_fallback(False)
+        self.session = MtgaSession(self.mlog)
+
+    def test_session_parses_once(self):
+        parsed = []
+        get_payload = self.mlog.get_payload
+
+        def counting_get_payload(keyword):
+            parsed.append(keyword)
+            return get_payload(keyword)
+        self.mlog.get_payload = counting_get_payload
+
+        collection = self.session.get_collection()
+        self.assertIs(self.session.get_collection(), collection)
+        self.assertIs(self.session.get_inventory(), self.session.get_inventory())
+        self.assertEqual(len(self.session.get_deck_lists()), 2)
+        self.assertEqual(len(self.session.get_deck_lists()), 2)
+        self.assertEqual(sorted(parsed), sorted([
+            MTGA_COLLECTION_KEYWORD, MTGA_INVENTORY_KEYWORD, MTGA_DECK_LISTS_KEYWORD
+        ]))
+
+    def test_session_collection_matches_log(self):
+        expected = [(mtga_id, str(card), count) for mtga_id, card, count in self.mlog.get_collection()]
+        result = [(mtga_id, str(card), count) for mtga_id, card, count in self.session.get_collection()]
+        self.assertEqual(result, expected)
+
+    def test_session_rotated_log(self):
+        log_filename = os.path.join(self.tmp_dir, 'Player.log')
+        shutil.copy(self.MTGA_LOG, log_filename)
+        mlog = MtgaLog(log_filename)
+        mlog.scryfall_fallback(False)
+        session = MtgaSession(mlog)
+        self.assertTrue(session.get_collection())
+        self.assertEqual(session.get_inventory().gold, 2)
+
+        # Arena restarted, the new log has no collection block yet
+        os.remove(log_filename)
+        with open(log_filename, 'w') as logfile:
+            logfile.write('<== PlayerInventory.GetPlayerInventory {"payload": {"gold": 500}}\n')
+        self.assertIn(MTGA_COLLECTION_KEYWORD, session.refresh())
+        self.assertEqual(mlog.rotations, 1)
+        self.assertRaises(MtgaLogParsingError, session.get_collection)
+        self.assertEqual(session.get_payload(MTGA_INVENTORY_KEYWORD), {'gold': 500})
+
+
+class Test_MtgaBatch(MtgaTestCase):
+    """Test exporting many logs with a process pool"""
+
+    def setUp(self):
+        super(Test_MtgaBatch, self).setUp()
+        self.log_files = []
+        for account in ['acct1', 'acct2']:
+            os.makedirs(os.path.join(self.tmp_dir, account))
+            log_file = os.path.join(self.tmp_dir, account, 'Player.log')
+            shutil.copy(self.MTGA_LOG, log_file)
+            self.log_files.append(log_file)
+
+    def test_find_log_files(self):
+        for name in ['Player-prev.log', 'Player-prev.log.gz', 'notes.txt']:
+            with open(os.path.join(self.tmp_dir, 'acct1', name), 'w') as other_file:
+                other_file.write('')
+        self.assertEqual(find_log_files(self.tmp_dir), self.log_files)
+        self.assertEqual(find_log_files(os.path.join(self.tmp_dir, '*', 'Player.log')), self.log_files)
+        self.assertEqual(find_log_files(self.MTGA_LOG), [self.MTGA_LOG])
+        self.assertEqual(find_log_files(os.path.join(self.tmp_dir, '*.gz')), [])
+
+    def test_log_names(self):
+        self.assertEqual(log_names(self.log_files), ['acct1_Player', 'acct2_Player'])
+        self.assertEqual(log_names(self.log_files[:1]), ['Player'])
+
+    def test_run_batch(self):
+        log_files = self.log_files + [os.path.join(self.tmp_dir, 'missing.log')]
+        summary = combine_summaries(run_batch(log_files, summarize_log, workers=2))
+        self.assertEqual(summary['logs'], 3)
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(summary['decks'], 4)
+        expected = summarize_log(self.MTGA_LOG)
+        for result in summary['results'][:2]:
+            self.assertIsNone(result['error'])
+            self.assertEqual(result['cards'], expected['cards'])
+            self.assertEqual(result['total_cards'], expected['total_cards'])
+        self.assertIsNotNone(summary['results'][2]['error'])
+
+    def test_init_worker_nocache(self):
+        self.addCleanup(scryfall.set_client, None)
+        self.addCleanup(scryfall.set_cache, None)
+        self.addCleanup(mtga_card_index.set_use_snapshot, True)
+        with mock.patch('mtga_batch.get_card_index') as get_card_index:
+            get_card_index.side_effect = lambda: self.assertFalse(mtga_card_index._use_snapshot)
+            mtga_batch.init_worker(nocache=True)
+        get_card_index.assert_called_once_with()
+        self.assertIsNone(scryfall.get_cache())
+
+
+class Test_MtgaSnapshotStore(MtgaTestCase):
+    """Test the collection and inventory history"""
+
+    def setUp(self):
+        super(Test_MtgaSnapshotStore, self).setUp()
+        self.log_filename = os.path.join(self.tmp_dir, 'Player.log')
+        shutil.copy(self.MTGA_LOG, self.log_filename)
+        self.store = MtgaSnapshotStore(os.path.join(self.tmp_dir, 'snapshots.sqlite'))
+
+    def tearDown(self):
+        self.store.close()
+
+    def append(self, text, log_time):
+        with open(self.log_filename, 'a') as logfile:
+            logfile.write(text)
+        os.utime(self.log_filename, (log_time, log_time))
+
+    def test_record_log(self):
+        os.utime(self.log_filename, (1000, 1000))
+        self.assertEqual(self.store.record_log(MtgaLog(self.log_filename)), 3)
+        self.assertEqual(self.store.record_log(MtgaLog(self.log_filename)), 0)
+        snapshots = self.store.snapshots()
+        self.assertEqual([snapshot['kind'] for snapshot in snapshots], ['collection', 'collection', 'inventory'])
+        self.assertEqual(snapshots[0]['log_time'], 1000)
+
+        self.append('<== PlayerInventory.GetPlayerCardsV3 {"67682": "4", "67688": "4", "68369": "1", '
+                    '"69108": "1", "69259": "1", "70192": "1", "123": "4", "64037": "2"}\n', 2000)
+        self.append('<== PlayerInventory.GetPlayerInventory {"payload":{"wcCommon":6,"gold":102,"gems":1}}\n', 2000)
+        self.assertEqual(self.store.record_log(MtgaLog(self.log_filename)), 2)
+
+        changes = dict((mtga_id, delta) for mtga_id, name, set_code, delta in self.store.card_changes_since(1500))
+        self.assertEqual(changes, {67682: 1, 68411: -1})
+        self.assertEqual(self.store.inventory_changes_since(1500), {
+            'wcCommon': -1, 'gold': 100, 'wcUncommon': -8, 'wcRare': -9, 'wcMythic': -10,
+            'draftTokens': -3, 'sealedTokens': -4, 'vaultProgress': -5.6
+        })
+        self.assertEqual(self.store.card_changes_since(2500), [])
+        self.assertEqual(len(self.store.snapshots(1500)), 2)
+
+    def test_record_replaced_log(self):
+        self.store.record_log(MtgaLog(self.log_filename))
+        size = os.path.getsize(self.log_filename)
+
+        # A new log with a new inode, grown past the size of the old one
+        os.remove(self.log_filename)
+        with open(self.log_filename, 'w') as logfile:
+            logfile.write('<== PlayerInventory.GetPlayerCardsV3 {"67682": "4"}\n')
+            logfile.write('noise\n' * (size // 6 + 1))
+        self.assertEqual(self.store.record_log(MtgaLog(self.log_filename)), 1)
+        self.assertEqual(self.store._get_state('collection'), {67682: 4})
+
+    def test_changes_by_set(self):
+        self.store.record('collection', {'67682': '1'}, 'a.log', 1000, 0)
+        self.store.record('collection', {'67682': '2', '69259': '1'}, 'a.log', 2000, 10)
+        self.assertEqual([row[0] for row in self.store.card_changes_since(0)], [67682, 69259])
+        self.assertEqual([row[0] for row in self.store.card_changes_since(0, 'RNA')], [69259])
+        self.assertIsNone(self.store.record('collection', {'67682': '2', '69259': '1'}, 'a.log', 3000, 20))
+
+    def test_state_reloaded(self):
+        self.store.record('inventory', {'gold': 10}, 'a.log', 1000, 0)
+        self.store.record('inventory', {'gold': 15}, 'a.log', 2000, 10)
+        store = MtgaSnapshotStore(self.store.filename)
+        self.assertIsNone(store.record('inventory', {'gold': 15}, 'b.log', 3000, 0))
+        self.assertIsNotNone(store.record('inventory', {'gold': 5}, 'b.log', 3000, 10))
+        self.assertEqual(store.inventory_changes_since(0), {'gold': -5})
+        store.close()
+
+    def test_parse_date(self):
+        self.assertEqual(parse_date('2020-01-02 03:04'), time.mktime((2020, 1, 2, 3, 4, 0, 0, 0, -1)))
+        with self.assertRaises(ValueError):
+            parse_date('02/01/2020')
+
+
+class Test_MtgaCollection(MtgaTestCase):
+    """Test the compact collection"""
+
+    def setUp(self):
+        super(Test_MtgaCollection, self).setUp()
+        self.mlog = MtgaLog(self.MTGA_LOG)
+        self.mlog.scryfall_fallback(False)
+        self.collection = self.mlog.get_collection_counts()
+
+    def test_counts(self):
+        payload = self.mlog.get_payload(MTGA_COLLECTION_KEYWORD)
+        self.assertEqual(len(self.collection), len(payload))
+        self.assertEqual(list(self.collection.mtga_ids), sorted(int(mtga_id) for mtga_id in payload))
+        self.assertEqual(self.collection.get('67688'), 4)
+        self.assertEqual(self.collection.get(1), None)
+        self.assertIn(68369, self.collection)
+        self.assertNotIn(68370, self.collection)
+        self.assertEqual(self.collection.total(), sum(int(count) for count in payload.values()))
+
+    def test_iteration_matches_get_collection(self):
+        expected = sorted((int(mtga_id), str(card), int(count)) for mtga_id, card, count in self.mlog.get_collection())
+        result = [(mtga_id, str(card), count) for mtga_id, card, count in self.collection]
+        self.assertEqual(result, expected)
+
+    def test_diff(self):
+        old = MtgaCollection([(1, 2), (2, 1), (3, 4), (5, 0)])
+        new = MtgaCollection([('1', '3'), ('3', '4'), ('4', '1')])
+        self.assertEqual(old.diff(new), {1: (2, 3), 2: (1, 0), 4: (0, 1)})
+        self.assertEqual(old.diff(new), count_deltas(dict(old.items()), dict(new.items())))
+        self.assertEqual(MtgaCollection().diff(new), {1: (0, 3), 3: (0, 4), 4: (0, 1)})
+
+    def test_set_completion(self):
+        completion = self.collection.set_completion()
+        self.assertEqual(completion['M19'], {'singlesOwned': 2, 'completeSetsOwned': 1})
+        self.assertEqual(sum(value['singlesOwned'] for value in completion.values()), 6)
+
+
+class Test_MtgaCollectionDiff(MtgaTestCase):
+    """Test differences between collections"""
+
+    def setUp(self):
+        super(Test_MtgaCollectionDiff, self).setUp()
+        self.mlog = MtgaLog(self.MTGA_LOG)
+        self.mlog.scryfall_fallback(False)
+
+    def test_count_deltas(self):
+        self.assertEqual(
+            count_deltas({1: 2, 2: 1, 3: 4, 5: 0}, {1: 3, 3: 4, 4: 1}),
+            {1: (2, 3), 2: (1, 0), 4: (0, 1)}
+        )
+
+    def test_only_changed_cards_resolved(self):
+        looked_up = []
+        lookup_cards = self.mlog.lookup_cards
+
+        def counting_lookup_cards(pairs):
+            pairs = list(pairs)
+            looked_up.extend(mtga_id for mtga_id, count in pairs)
+            return lookup_cards(pairs)
+        self.mlog.lookup_cards = counting_lookup_cards
+
+        counts, inventory = log_counts(self.mlog)
+        new_counts = dict(counts.items())
+        new_counts[67682] = 4
+        new_counts[69259] = 0
+        new_counts[70205] = 1
+        diff = MtgaCollectionDiff(counts, new_counts, mtga_log=self.mlog)
+
+        changes = [(mtga_id, str(card), change) for mtga_id, card, change in diff.card_changes()]
+        self.assertEqual(sorted(looked_up), [67682, 69259, 70205])
+        self.assertEqual(len(changes), 3)
+        self.assertIn((67682, str(find_one_mtga_card(67682)), 1), changes)
+        self.assertEqual([mtga_id for mtga_id, card, count in diff.new_cards()], [70205])
+
+        set_changes = diff.set_changes()
+        self.assertEqual(set_changes['M19'], {'singlesOwned': 0, 'completeSetsOwned': 1})
+        self.assertEqual(set_changes['RNA']['singlesOwned'], -1)
+
+    def test_inventory_changes(self):
+        counts, inventory = log_counts(self.mlog)
+        raw = dict(inventory.inventory_raw(), gold=102, wcRare=7)
+        diff = MtgaCollectionDiff(counts, counts, inventory, MtgaInventory(raw))
+        self.assertEqual(diff.card_changes(), [])
+        self.assertEqual(diff.inventory_changes(), {'Gold': 100, 'Wildcards': {'Rare': -2}})
+
+    def test_snapshot_diff(self):
+        store = MtgaSnapshotStore(os.path.join(self.tmp_dir, 'snapshots.sqlite'))
+        self.addCleanup(store.close)
+        store.record('collection', {'67682': '1'}, 'a.log', 1000, 0)
+        store.record('inventory', {'gold': 5}, 'a.log', 1000, 10)
+        store.record('collection', {'67682': '2', '69259': '1'}, 'a.log', 2000, 20)
+        old_counts, old_inventory = snapshot_counts(store, 1500)
+        new_counts, new_inventory = snapshot_counts(store)
+        diff = MtgaCollectionDiff(old_counts, new_counts, old_inventory, new_inventory)
+        self.assertEqual(diff.deltas, {67682: (1, 2), 69259: (0, 1)})
+        self.assertEqual(diff.inventory_changes(), {})
+
+
+class Test_MtgaWriters(MtgaTestCase):
+    """Test the streaming export writers"""
+
+    def setUp(self):
+        super(Test_MtgaWriters, self).setUp()
+        self.mlog = MtgaLog(self.MTGA_LOG)
+        self.mlog.scryfall_fallback(False)
+        self.collection = [(card, count) for mtga_id, card, count in self.mlog.get_collection()
+                           if not isinstance(card, MtgaUnknownCard)]
+        self.out = io.StringIO()
+
+    def test_goldfish(self):
+        GoldfishWriter(self.out).write(self.collection)
+        lines = self.out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Card,Set ID,Set Name,Quantity,Foil')
+        self.assertIn('"Aegis of the Heavens","M19","",3,""', lines)
+        self.assertIn('"Angelic Reward","ARENA","",1,""', lines)
+        self.assertEqual(len(lines), len(self.collection) + 1)
+
+    def test_deckstats(self):
+        DeckstatsWriter(self.out).write(self.collection)
+        lines = self.out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'card_name,amount,set_code,is_foil,is_pinned')
+        self.assertIn('"Ajani\'s Last Stand",4,"M19",0,0', lines)
+        self.assertIn('"Angelic Reward",1,"MTGA",0,0', lines)
+
+    def test_custom(self):
+        CustomWriter(self.out, ['name', 'count']).write(self.collection)
+        lines = self.out.getvalue().splitlines()
+        self.assertEqual(lines[:2], ['name,count', 'aegis_of_the_heavens,3'])
+
+    def test_quoting(self):
+        card = mock.Mock(pretty_name='Kenrith, the "Returned" King', set='M19')
+        DeckstatsWriter(self.out).write([(card, 1)])
+        self.assertEqual(self.out.getvalue().splitlines()[1], '"Kenrith, the ""Returned"" King",1,"M19",0,0')
+        self.assertRaises(TypeError, CollectionWriter, self.out)
+
+    def test_arena_deck(self):
+        deck = [d for d in self.mlog.get_deck_lists() if d.name == 'Kethis Combo'][0]
+        ArenaDeckWriter(self.out).write(deck)
+        self.assertEqual(self.out.getvalue(), deck.export_arena() + '\n')
+
+    def test_decks_repr(self):
+        deck_lists = list(self.mlog.get_deck_lists())
+        write_decks_repr(self.out, deck_lists)
+        self.assertEqual(self.out.getvalue(), str(dict((d.name, d.deck()) for d in deck_lists)) + '\n')
+
+
+class Test_MtgaStats(MtgaTestCase):
+    """Test timers and counters of --stats"""
+
+    def setUp(self):
+        super(Test_MtgaStats, self).setUp()
+        mtga_stats.enable()
+
+    def tearDown(self):
+        mtga_stats.enable(False)
+        scryfall.set_cache(None)
+        scryfall.set_client(None)
+
+    def test_disabled(self):
+        mtga_stats.enable(False)
+        with mtga_stats.timer('test.timer'):
+            mtga_stats.count('test.counter')
+        self.assertIs(mtga_stats.timer('test.timer'), mtga_stats.timer('other.timer'))
+        stats = mtga_stats.get_stats()
+        self.assertEqual(stats['timers'], {})
+        self.assertEqual(stats['counters'], {})
+
+    def test_log_stages(self):
+        mlog = MtgaLog(self.MTGA_LOG)
+        mlog.scryfall_fallback(False)
+        collection = list(mlog.get_collection())
+        stats = mtga_stats.get_stats()
+        for name in ['log.scan', 'log.parse', 'lookup.python_mtga']:
+            self.assertIn(name, stats['timers'])
+        self.assertEqual(stats['counters']['lookup.cards'], len(collection))
+        unknown = [card for mtga_id, card, count in collection if isinstance(card, MtgaUnknownCard)]
+        self.assertEqual(stats['counters']['lookup.unknown_cards'], len(unknown))
+        self.assertEqual(stats['counters']['log.scanned_bytes'], os.path.getsize(self.MTGA_LOG))
+
+        out = io.StringIO()
+        mtga_stats.print_stats(stats, out)
+        self.assertIn('log.scan', out.getvalue())
+        self.assertIn('lookup.cards', out.getvalue())
+
+    def test_scryfall(self):
+        with FakeScryfallServer({70001: card_json(70001)}) as server:
+            cards_api = scryfall.SCRYFALL_CARDS_API
+            scryfall.SCRYFALL_CARDS_API = server.url + '/cards'
+            self.addCleanup(setattr, scryfall, 'SCRYFALL_CARDS_API', cards_api)
+            cache = scryfall.ScryfallCache(os.path.join(self.tmp_dir, 'cache.sqlite'))
+            self.addCleanup(cache.close)
+            scryfall.set_cache(cache)
+            scryfall.set_client(scryfall.ScryfallClient(rate=1000))
+            scryfall.get_mtga_card(70001)
+            scryfall.get_mtga_card(70001)
+
+        stats = mtga_stats.get_stats()
+        self.assertEqual(stats['timers']['scryfall.request']['calls'], 1)
+        self.assertEqual(stats['counters']['scryfall.cache_misses'], 1)
+        self.assertEqual(stats['counters']['scryfall.cache_hits'], 1)
+
+
+class Test_MtgaCardIndex(MtgaTestCase):
+    """Test the card index snapshot"""
+
+    def setUp(self):
+        super(Test_MtgaCardIndex, self).setUp()
+        self.filename = os.path.join(self.tmp_dir, mtga_card_index.MTGA_CARD_INDEX_FILENAME)
+        self.card_index = mtga_card_index.build_card_index()
+
+    def test_version(self):
+        from mtga import __version__
+        self.assertEqual(mtga_card_index.get_mtga_version(), __version__)
+
+    def test_snapshot_roundtrip(self):
+        mtga_card_index.save_snapshot(self.filename, '1.0', self.card_index)
+        loaded = mtga_card_index.load_snapshot(self.filename, '1.0')
+        self.assertEqual(sorted(loaded), sorted(self.card_index))
+        for mtga_id in [66679, 67682, 68369]:
+            card, expected = loaded[mtga_id], self.card_index[mtga_id]
+            self.assertIsInstance(card, mtga_card_index.Card)
+            self.assertEqual(str(card), str(expected))
+            self.assertEqual(card.to_serializable(), expected.to_serializable())
+            self.assertEqual(card.cmc, expected.cmc)
+            self.assertTrue(mtga_card_index.is_card(card))
+            self.assertTrue(mtga_card_index.is_card(expected))
+
+    def test_snapshot_temp_file(self):
+        mtga_card_index.save_snapshot(self.filename, '1.0', self.card_index)
+        with mock.patch('marshal.dumps', side_effect=ValueError('unmarshallable')):
+            self.assertRaises(ValueError, mtga_card_index.save_snapshot, self.filename, '2.0', self.card_index)
+        self.assertEqual(os.listdir(self.tmp_dir), [mtga_card_index.MTGA_CARD_INDEX_FILENAME])
+        self.assertIsNotNone(mtga_card_index.load_snapshot(self.filename, '1.0'))
+
+    def test_outdated_snapshot(self):
+        mtga_card_index.save_snapshot(self.filename, '1.0', self.card_index)
+        self.assertIsNone(mtga_card_index.load_snapshot(self.filename, '2.0'))
+        self.assertIsNone(mtga_card_index.load_snapshot(os.path.join(self.tmp_dir, 'missing'), '1.0'))
+        with open(self.filename, 'wb') as snapshot_file:
+            snapshot_file.write(b'broken')
+        self.assertIsNone(mtga_card_index.load_snapshot(self.filename, '1.0'))
+
+    def test_load_card_index(self):
+        filename = mtga_cache.get_cache_file_path(mtga_card_index.MTGA_CARD_INDEX_FILENAME)
+        if os.path.exists(filename):
+            os.remove(filename)
+        card_index = mtga_card_index.load_card_index()
+        self.assertTrue(os.path.isfile(filename))
+        self.assertEqual(str(mtga_card_index.load_card_index()[67682]), str(card_index[67682]))
+        self.assertFalse(mtga_card_index.is_card(MtgaUnknownCard('67682')))
+
+    def test_card_interface(self):
+        from mtga.models.card import Card as MtgaCard
+        public = lambda card: set(name for name in dir(card) if not name.startswith('_'))
+        self.assertLessEqual(public(MtgaCard()), public(mtga_card_index.Card()))
+        # Not a python-mtga Card, is_card() accepts both
+        self.assertNotIsInstance(self.card_index[67682], MtgaCard)
+        self.assertTrue(mtga_card_index.is_card(MtgaCard()))
+        card = get_card_index()[67682]
+        self.assertIs(mtga_card_index.Card.from_dict(card.to_serializable()), card)
+        self.assertEqual(mtga_card_index.Card.from_dict({'mtga_id': 1}).pretty_name, '1: Unknown MTGA ID')
+
+    def test_card_type_without_snapshot(self):
+        mtga_card_index.set_use_snapshot(False)
+        self.addCleanup(mtga_card_index.set_use_snapshot, True)
+        self.assertIsInstance(mtga_card_index.load_card_index()[67682], mtga_card_index.Card)
+
+    def test_arena_data_fingerprint(self):
+        self.assertIsNone(mtga_card_index.get_arena_data_fingerprint(os.path.join(self.tmp_dir, 'missing')))
+        data_file = os.path.join(self.tmp_dir, 'data_cards_abc.mtga')
+        with open(data_file, 'w') as cards_file:
+            cards_file.write('[]')
+        with open(os.path.join(self.tmp_dir, 'readme.txt'), 'w') as other_file:
+            other_file.write('')
+        fingerprint = mtga_card_index.get_arena_data_fingerprint(self.tmp_dir)
+        self.assertEqual([entry[0] for entry in fingerprint], ['data_cards_abc.mtga'])
+
+        with open(data_file, 'w') as cards_file:
+            cards_file.write('[{}]')
+        self.assertNotEqual(mtga_card_index.get_arena_data_fingerprint(self.tmp_dir), fingerprint)
+
+    def test_snapshot_outdated_by_arena_data(self):
+        mtga_card_index.save_snapshot(self.filename, ['1.0', [['data_cards_abc.mtga', 2, 1.0]]], self.card_index)
+        self.assertIsNotNone(mtga_card_index.load_snapshot(self.filename, ['1.0', [['data_cards_abc.mtga', 2, 1.0]]]))
+        self.assertIsNone(mtga_card_index.load_snapshot(self.filename, ['1.0', [['data_cards_def.mtga', 2, 1.0]]]))
+
+
+class Test_Scryfall(MtgaTestCase):
     """Test the scryfall module"""
 
     @parameterized.expand([
@@ -161,3 +943,495 @@ class Test_Scryfall(unittest.TestCase):
             self.assertEqual(card.pretty_name, expected_card_name)
         except Exception as exception:
             self.assertIsInstance(exception, expected_card_name)
+
+
+class Test_ScryfallCache(MtgaTestCase):
+    """Test the local Scryfall card cache against a fake server"""
+
+    def setUp(self):
+        super(Test_ScryfallCache, self).setUp()
+        self.server = FakeScryfallServer({70001: card_json(70001, "Cached Card")}).__enter__()
+        self.cards_api = scryfall.SCRYFALL_CARDS_API
+        scryfall.SCRYFALL_CARDS_API = self.server.url + '/cards'
+        self.cache = scryfall.ScryfallCache(os.path.join(self.tmp_dir, 'cache.sqlite'))
+        scryfall.set_cache(self.cache)
+        scryfall.set_client(scryfall.ScryfallClient(rate=1000))
+
+    def tearDown(self):
+        scryfall.SCRYFALL_CARDS_API = self.cards_api
+        scryfall.set_cache(None)
+        scryfall.set_client(None)
+        self.cache.close()
+        self.server.__exit__()
+
+    def test_cache_hit(self):
+        self.assertEqual(scryfall.get_mtga_card(70001).pretty_name, "Cached Card")
+        self.assertEqual(scryfall.get_mtga_card(70001).pretty_name, "Cached Card")
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_cache_negative(self):
+        for _ in range(2):
+            with self.assertRaises(scryfall.ScryfallError):
+                scryfall.get_arena_card_json(70002)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_cache_ttl(self):
+        self.cache.ttl = -1
+        scryfall.get_arena_card_json(70001)
+        scryfall.get_arena_card_json(70001)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_cache_lru_eviction(self):
+        self.cache.max_entries = 2
+        self.cache.put(1, {'arena_id': 1})
+        self.cache.put(2, {'arena_id': 2})
+        time.sleep(0.01)
+        self.assertEqual(self.cache.get(1), (True, {'arena_id': 1}))
+        self.cache.put(3, {'arena_id': 3})
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.get(2), (False, None))
+        self.assertEqual(self.cache.get(1)[0], True)
+
+
+class Test_ScryfallBulk(MtgaTestCase):
+    """Test the offline card database"""
+
+    def setUp(self):
+        super(Test_ScryfallBulk, self).setUp()
+        double_faced = card_json(68411, 'Front // Back', 'thb')
+        del double_faced['mana_cost']
+        double_faced['card_faces'] = [{'mana_cost': '{2}{G}', 'type_line': 'Creature'}, {'mana_cost': ''}]
+        broken = card_json(777)
+        del broken['type_line']
+        paper = card_json(1, 'Paper Only')
+        del paper['arena_id']
+        self.cards = [card_json(123, 'Offline Card', 'm20'), paper, double_faced, broken]
+        self.bulk_filename = os.path.join(self.tmp_dir, 'default-cards.json')
+        with open(self.bulk_filename, 'w') as bulk_file:
+            json.dump(self.cards, bulk_file, indent=2)
+        self.offline_db = scryfall_bulk.ScryfallOfflineDb(os.path.join(self.tmp_dir, 'cards.sqlite'))
+
+    def tearDown(self):
+        scryfall_bulk.set_offline_db(None)
+        self.offline_db.close()
+
+    @parameterized.expand([[1], [5], [1000]])
+    def test_iter_json_array(self, chunk_size):
+        with io.open(self.bulk_filename, encoding='utf-8') as stream:
+            self.assertEqual(list(scryfall_bulk.iter_json_array(stream, chunk_size)), self.cards)
+        self.assertEqual(list(scryfall_bulk.iter_json_array(io.StringIO(u' [ ] '))), [])
+
+    def test_iter_json_array_invalid(self):
+        with self.assertRaises(ValueError):
+            list(scryfall_bulk.iter_json_array(io.StringIO(u'[{"a": 1}, {"b": ')))
+        with self.assertRaises(ValueError):
+            list(scryfall_bulk.iter_json_array(io.StringIO(u'{"a": 1}')))
+
+    def test_import(self):
+        self.assertEqual(self.offline_db.import_bulk_file(self.bulk_filename), (2, 1))
+        self.assertEqual(len(self.offline_db), 2)
+        self.assertEqual(self.offline_db.get(123).pretty_name, 'Offline Card')
+        self.assertEqual(self.offline_db.get(68411).cost, ['2', 'G'])
+        self.assertIsNone(self.offline_db.get(777))
+
+    def test_lookup_tier(self):
+        self.offline_db.import_bulk_file(self.bulk_filename)
+        scryfall_bulk.set_offline_db(self.offline_db)
+        mlog = MtgaLog(self.MTGA_LOG)
+        mlog._fetch_cards_from_scryfall = lambda mtga_ids: self.fail('Scryfall used for %s' % mtga_ids)
+        cards = dict((mtga_id, card) for mtga_id, card, count in mlog.lookup_cards([('123', '1'), ('67682', '2')]))
+        self.assertEqual(cards['123'].set, 'M20')
+        self.assertEqual(mlog.lookup_card(68411).pretty_name, 'Front // Back')
+
+
+class Test_ScryfallBatch(MtgaTestCase):
+    """Test batched resolution of unknown cards against a fake server"""
+
+    def setUp(self):
+        super(Test_ScryfallBatch, self).setUp()
+        cards = dict((arena_id, card_json(arena_id)) for arena_id in range(900000, 900080))
+        self.server = FakeScryfallServer(cards).__enter__()
+        self.cards_api = scryfall.SCRYFALL_CARDS_API
+        scryfall.SCRYFALL_CARDS_API = self.server.url + '/cards'
+        self.cache = scryfall.ScryfallCache(os.path.join(self.tmp_dir, 'cache.sqlite'))
+        scryfall.set_cache(self.cache)
+        scryfall.set_client(scryfall.ScryfallClient(rate=1000))
+        self.mlog = MtgaLog(self.MTGA_LOG)
+
+    def tearDown(self):
+        scryfall.SCRYFALL_CARDS_API = self.cards_api
+        scryfall.set_cache(None)
+        scryfall.set_client(None)
+        self.cache.close()
+        self.server.__exit__()
+
+    def test_lookup_cards_order(self):
+        pairs = [("900001", 1), ("67682", 2), ("900002", 3), ("123", 4)]
+        result = [(mtga_id, type(card).__name__, count) for mtga_id, card, count in self.mlog.lookup_cards(pairs)]
+        self.assertEqual(result, [
+            ("900001", "MtgaUnknownCard", 1), ("900001", "Card", 1),
+            ("67682", "Card", 2),
+            ("900002", "MtgaUnknownCard", 3), ("900002", "Card", 3),
+            ("123", "MtgaUnknownCard", 4), ("123", "ScryfallError", 4),
+        ])
+
+    def test_lookup_cards_concurrent(self):
+        self.server.latency = 0.2
+        self.mlog.scryfall_workers = 8
+        pairs = [(str(arena_id), 1) for arena_id in range(900000, 900008)]
+        start = time.monotonic()
+        cards = [card for mtga_id, card, count in self.mlog.lookup_cards(pairs)]
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual([card.mtga_id for card in cards[1::2]], list(range(900000, 900008)))
+
+    def test_stale_cards_refreshed_in_batches(self):
+        arena_ids = list(range(900000, 900080))
+        scryfall.get_arena_cards_json(arena_ids)
+        self.assertEqual(len(self.server.requests), 80)
+
+        self.cache.ttl = -1
+        del self.server.requests[:]
+        cards = scryfall.get_mtga_cards(arena_ids)
+        self.assertEqual(self.server.requests, ['/cards/collection', '/cards/collection'])
+        self.assertEqual(cards[900079].mtga_id, 900079)
+
+    def test_fresh_cards_from_cache(self):
+        scryfall.get_arena_cards_json([900001, 900002, 123])
+        del self.server.requests[:]
+        results = scryfall.get_arena_cards_json([900001, 900002, 123])
+        self.assertEqual(self.server.requests, [])
+        self.assertIsInstance(results[123], scryfall.ScryfallError)
+
+
+class Test_ScryfallClient(MtgaTestCase):
+    """Test rate limiting and retries of the Scryfall client"""
+
+    def setUp(self):
+        super(Test_ScryfallClient, self).setUp()
+        self.server = FakeScryfallServer({70001: card_json(70001)}).__enter__()
+        self.client = scryfall.ScryfallClient(rate=100, backoff=0.01)
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def test_retry_on_busy(self):
+        self.server.fail_next = [429, 503]
+        response = self.client.get(self.server.url + '/cards/arena/70001')
+        self.assertEqual(response.status_code, 200)
+        stats = self.client.stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['retries'], 2)
+        self.assertGreater(stats['max_latency'], 0)
+
+    def test_retries_exhausted(self):
+        self.client.retries = 1
+        self.server.fail_next = [500, 500, 500]
+        response = self.client.get(self.server.url + '/cards/arena/70001')
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.client.stats()['requests'], 2)
+
+    def test_no_retry_on_not_found(self):
+        response = self.client.get(self.server.url + '/cards/arena/1')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.client.stats()['retries'], 0)
+
+    def test_rate_limiter(self):
+        limiter = scryfall.RateLimiter(50, capacity=1)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class Test_ScryfallSets(MtgaTestCase):
+    """Test cached set info against a fake server"""
+
+    def setUp(self):
+        super(Test_ScryfallSets, self).setUp()
+        sets = {'m19': set_json('m19', 280), 'dom': set_json('dom', 269)}
+        self.server = FakeScryfallServer(sets=sets).__enter__()
+        self.sets_api = scryfall.SCRYFALL_SETS_API
+        scryfall.SCRYFALL_SETS_API = self.server.url + '/sets'
+        self.cache = scryfall.ScryfallCache(os.path.join(self.tmp_dir, 'cache.sqlite'))
+        scryfall.set_cache(self.cache)
+        scryfall.set_client(scryfall.ScryfallClient(rate=1000))
+
+    def tearDown(self):
+        scryfall.SCRYFALL_SETS_API = self.sets_api
+        scryfall.set_cache(None)
+        scryfall.set_client(None)
+        self.cache.close()
+        self.server.__exit__()
+
+    def test_prefetch_single_request(self):
+        mformats = MtgaFormats(mtga_log=None)
+        mformats.prefetch_set_info(['M19', 'DOM', 'XXX', 'M19'])
+        self.assertEqual(self.server.requests, ['/sets'])
+        self.assertEqual(mformats.get_set_card_count('M19'), 280)
+        self.assertEqual(mformats.get_set_card_count('XXX'), 0)
+        self.assertEqual(self.server.requests, ['/sets'])
+
+    def test_warm_cache_no_request(self):
+        scryfall.get_sets_info(['M19', 'XXX'])
+        del self.server.requests[:]
+        self.assertEqual(scryfall.get_sets_info(['DOM', 'XXX'])['DOM']['card_count'], 269)
+        self.assertEqual(scryfall.get_set_info('m19')['card_count'], 280)
+        self.assertEqual(self.server.requests, [])
+
+    def test_set_info_cached(self):
+        self.assertEqual(scryfall.get_set_info('DOM')['card_count'], 269)
+        self.assertEqual(scryfall.get_set_info('DOM')['card_count'], 269)
+        self.assertEqual(self.server.requests, ['/sets/DOM'])
+
+
+class Test_MtgaServer(MtgaTestCase):
+    """Test json queries of the serve mode"""
+
+    def setUp(self):
+        super(Test_MtgaServer, self).setUp()
+        self.log_filename = os.path.join(self.tmp_dir, 'Player.log')
+        shutil.copy(self.MTGA_LOG, self.log_filename)
+        mlog = MtgaLog(self.log_filename)
+        mlog.scryfall_fallback(False)
+        self.queries = MtgaQueries(MtgaSession(mlog))
+
+    def query(self, path):
+        status, body = self.queries.query(path)
+        return status, json.loads(body.decode('utf-8'))
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('localhost:8000'), ('tcp', ('localhost', 8000)))
+        self.assertEqual(parse_address('8000'), ('tcp', ('127.0.0.1', 8000)))
+        self.assertEqual(parse_address('/tmp/mtga.sock'), ('unix', '/tmp/mtga.sock'))
+        self.assertEqual(parse_address('unix:mtga.sock'), ('unix', 'mtga.sock'))
+        self.assertRaises(ValueError, parse_address, 'localhost')
+
+    def test_queries(self):
+        status, inventory = self.query('/inventory')
+        self.assertEqual(status, 200)
+        self.assertEqual(inventory['Gold'], 2)
+
+        status, collection = self.query('/collection')
+        self.assertEqual(status, 200)
+        names = [card['pretty_name'] for card in collection['cards']]
+        self.assertIn('Aegis of the Heavens', names)
+
+        status, decks = self.query('/decks')
+        self.assertEqual([deck['name'] for deck in decks], ['Kethis Combo', 'Empty Deck'])
+
+        status, deck = self.query('/decks/Kethis%20Combo')
+        self.assertEqual(status, 200)
+        self.assertTrue(deck['export'].startswith('Deck\n'))
+        self.assertEqual(sum(card['count'] for card in deck['maindeck']), 7)
+
+        self.assertEqual(self.query('/decks/Missing')[0], 404)
+        self.assertEqual(self.query('/unknown')[0], 404)
+
+    def test_cached_query(self):
+        status, body = self.queries.query('/collection')
+        self.assertIs(self.queries.query('/collection')[1], body)
+
+        start = time.perf_counter()
+        for _ in range(100):
+            self.queries.query('/collection')
+        self.assertLess((time.perf_counter() - start) / 100, 0.001)
+
+    def test_invalidation(self):
+        collection = self.queries.query('/collection')[1]
+        decks = self.queries.query('/decks')[1]
+        self.assertEqual(self.query('/inventory')[1]['Gold'], 2)
+
+        with open(self.log_filename, 'a') as logfile:
+            logfile.write('<== PlayerInventory.GetPlayerInventory {"id":580,"payload":{"wcCommon":7,"wcUncommon":8,'
+                          '"wcRare":9,"wcMythic":10,"gold":500,"gems":1,"draftTokens":3,"sealedTokens":4,'
+                          '"vaultProgress":5.6,"starterDecks":[]}}\n')
+
+        self.assertEqual(self.query('/inventory')[1]['Gold'], 500)
+        self.assertIs(self.queries.query('/collection')[1], collection)
+        self.assertIs(self.queries.query('/decks')[1], decks)
+
+    def test_restarted_arena(self):
+        self.assertEqual(self.query('/inventory')[1]['Gold'], 2)
+        self.assertEqual(self.query('/collection')[0], 200)
+
+        os.rename(self.log_filename, self.log_filename + '.old')
+        status, error = self.query('/inventory')
+        self.assertEqual(status, 503)
+
+        with open(self.log_filename, 'w') as logfile:
+            logfile.write('<== PlayerInventory.GetPlayerInventory {"payload":{"wcCommon":7,"wcUncommon":8,'
+                          '"wcRare":9,"wcMythic":10,"gold":500,"gems":1,"draftTokens":3,"sealedTokens":4,'
+                          '"vaultProgress":5.6}}\n')
+        self.assertEqual(self.query('/inventory')[1]['Gold'], 500)
+        self.assertEqual(self.query('/collection')[0], 404)
+        self.assertEqual(self.query('/status')[1]['indexed_size'], os.path.getsize(self.log_filename))
+
+    def test_http(self):
+        import requests
+        with MtgaServer(self.queries, '127.0.0.1:0') as server:
+            response = requests.get(server.url + '/inventory')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Type'], 'application/json')
+            self.assertEqual(response.json()['Gems'], 1)
+            self.assertEqual(requests.get(server.url + '/status').json()['log_file'], self.log_filename)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets not supported')
+    def test_unix_socket(self):
+        path = os.path.join(self.tmp_dir, 'mtga.sock')
+        with MtgaServer(self.queries, path):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall(b'GET /inventory HTTP/1.0\r\n\r\n')
+            response = b''
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                response += data
+            client.close()
+        headers, _, body = response.partition(b'\r\n\r\n')
+        self.assertEqual(headers.split(b'\r\n')[0].split()[1], b'200')
+        self.assertEqual(json.loads(body.decode('utf-8'))['Gold'], 2)
+        self.assertFalse(os.path.exists(path))
+
+
+class Test_MtgaExportMain(MtgaTestCase):
+    """Test mtga-export.py main() with the flags of each action"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mtga_export = load_mtga_export()
+
+    def setUp(self):
+        super(Test_MtgaExportMain, self).setUp()
+        self.log_filename = self.write_log('Player.log')
+        self.output = os.path.join(self.tmp_dir, 'export.txt')
+        cache_dir = mock.patch.dict(os.environ, {mtga_cache.MTGA_CACHE_DIR_ENV: os.path.join(self.tmp_dir, 'cache')})
+        cache_dir.start()
+        self.addCleanup(cache_dir.stop)
+
+    def tearDown(self):
+        scryfall.set_cache(None)
+        scryfall.set_client(None)
+        mtga_card_index.set_use_snapshot(True)
+
+    def write_log(self, name, text=None):
+        """Write a log with detailed logs enabled, by default with the test log blocks"""
+        filename = os.path.join(self.tmp_dir, name)
+        if text is None:
+            with open(self.MTGA_LOG) as test_log:
+                text = test_log.read()
+        with open(filename, 'w') as logfile:
+            logfile.write('DETAILED LOGS: ENABLED\n' + text)
+        return filename
+
+    @staticmethod
+    def inventory_block(gold):
+        return ('<== PlayerInventory.GetPlayerInventory {"payload": {'
+                '"wcCommon": 7, "wcUncommon": 8, "wcRare": 9, "wcMythic": 10, '
+                '"gold": %d, "gems": 1, "draftTokens": 3, "sealedTokens": 4, "vaultProgress": 5.6}}\n' % gold)
+
+    def main(self, args, log_file=None):
+        """Run main(), returns (exit code, stdout)"""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            result = self.mtga_export.main('-l "%s" --nocache %s' % (log_file or self.log_filename, args))
+        return result, out.getvalue()
+
+    def read_output(self):
+        with open(self.output) as output:
+            return output.read()
+
+    def test_follow_restarted_arena(self):
+        steps = []
+
+        def sleep(seconds):
+            steps.append(seconds)
+            if len(steps) == 1:
+                # Arena deletes the log while restarting
+                os.rename(self.log_filename, self.log_filename + '.old')
+            elif len(steps) == 2:
+                self.write_log('Player.log', self.inventory_block(500))
+            else:
+                raise KeyboardInterrupt()
+
+        with mock.patch.object(self.mtga_export.time, 'sleep', side_effect=sleep):
+            result, output = self.main('-ij -f "%s" --follow 0.5' % self.output)
+        self.assertEqual(result, 0)
+        self.assertEqual(steps, [0.5, 0.5, 0.5])
+        self.assertEqual(json.loads(self.read_output())['Gold'], 500)
+
+    def test_serve(self):
+        responses = []
+
+        def serve_forever(server):
+            thread = threading.Thread(target=server.httpd.serve_forever)
+            thread.start()
+            try:
+                with urllib.request.urlopen(server.url + '/inventory') as response:
+                    responses.append(json.loads(response.read().decode('utf-8')))
+            finally:
+                server.httpd.shutdown()
+                thread.join()
+            raise KeyboardInterrupt()
+
+        with mock.patch.object(MtgaServer, 'serve_forever', autospec=True, side_effect=serve_forever):
+            result, output = self.main('--serve 127.0.0.1:0')
+        self.assertEqual(result, 0)
+        self.assertIn('Serving %s on http://127.0.0.1:' % self.log_filename, output)
+        self.assertEqual(responses[0]['Gold'], 2)
+
+    def test_batch(self):
+        for account in ['acct1', 'acct2']:
+            os.makedirs(os.path.join(self.tmp_dir, 'logs', account))
+            self.write_log(os.path.join('logs', account, 'Player.log'))
+        output_dir = os.path.join(self.tmp_dir, 'out')
+        result, output = self.main('-ij -f inventory.json --output_dir "%s" --batch_workers 2' % output_dir,
+                                   os.path.join(self.tmp_dir, 'logs'))
+        self.assertEqual(result, 0)
+        self.assertIn('Exported 2 logs (0 failed)', output)
+        for name in ['acct1_Player', 'acct2_Player']:
+            with open(os.path.join(output_dir, name, 'inventory.json')) as inventory_file:
+                self.assertEqual(json.load(inventory_file)['Gold'], 2)
+        with open(os.path.join(output_dir, 'summary.json')) as summary_file:
+            self.assertEqual(json.load(summary_file)['logs'], 2)
+
+    def test_stats(self):
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            result, output = self.main('-ij --stats')
+        self.assertEqual(json.loads(output)['Gold'], 2)
+        self.assertIn('export.inventoryjson', err.getvalue())
+        self.assertIn('log.scanned_bytes', err.getvalue())
+        self.assertFalse(mtga_stats.is_enabled())
+
+    def test_profile(self):
+        import pstats
+        profile_file = os.path.join(self.tmp_dir, 'export.prof')
+        result, output = self.main('-ij --profile "%s"' % profile_file)
+        self.assertEqual(json.loads(output)['Gold'], 2)
+        functions = [name for (filename, line, name) in pstats.Stats(profile_file).stats]
+        self.assertIn('export', functions)
+
+    def test_diff(self):
+        with open(self.MTGA_LOG) as test_log:
+            old_log = self.write_log('old.log', test_log.read() + self.inventory_block(500))
+        result, output = self.main('--diff "%s"' % old_log)
+        self.assertEqual(result, 0)
+        self.assertEqual(output.splitlines(), ['Inventory:Gold=-498'])
+
+    def test_snapshots(self):
+        self.assertIn('Recorded 3 new snapshots', self.main('--snapshot')[1])
+        with open(self.log_filename, 'a') as logfile:
+            logfile.write(self.inventory_block(500))
+        self.assertIn('Recorded 1 new snapshots', self.main('--snapshot')[1])
+
+        result, output = self.main('--snapshots')
+        self.assertEqual(result, 0)
+        self.assertEqual([line.split()[3] for line in output.splitlines()],
+                         ['collection', 'collection', 'inventory', 'inventory'])
+
+        result, output = self.main('--changes_since "2000-01-01"')
+        self.assertIn('+2 Aegis of the Heavens (M19) 67682', output.splitlines())
+        self.assertIn('gold=498', output.splitlines())
+        self.assertEqual(self.main('--changes_since yesterday')[0], 1)